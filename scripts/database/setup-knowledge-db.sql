@@ -32,6 +32,19 @@ CREATE EXTENSION IF NOT EXISTS vector;
 -- Enable UUID generation
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
+-- Lets the retrieval service load the ANN index into shared buffers at startup
+-- (on Azure, allow-list it in azure.extensions first). Optional: without it the
+-- warm-up runs probe queries only, so a missing or refused extension is skipped
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_prewarm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_prewarm;
+    END IF;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_prewarm not installed: %', SQLERRM;
+END;
+$$;
+
 -- Enable full-text search (already built-in, just confirming)
 -- CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
@@ -42,21 +55,75 @@ COMMENT ON EXTENSION "uuid-ossp" IS 'UUID generation functions';
 -- Step 3: Create tables
 -- ============================================================================
 
--- Main knowledge chunks table with vector embeddings
-CREATE TABLE knowledge_chunks (
+-- The chunk tables are partitioned by repository (see create_repository_partitions):
+-- every repository has its own ANN index partition, searches filtered on a
+-- repository only read its partition, and dropping or reindexing a repository
+-- leaves the others alone.
+
+-- Content-addressed chunk store: one row (and one embedding) per distinct chunk
+-- text within a repository
+CREATE TABLE chunk_contents (
     -- Primary key
-    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    repository VARCHAR(255) NOT NULL,  -- partition key
+    content_hash VARCHAR(64) NOT NULL,  -- SHA-256 of content
     
     -- Content
     content TEXT NOT NULL,
-    content_hash VARCHAR(64) NOT NULL,  -- SHA-256 for deduplication
     embedding vector(1536),  -- text-embedding-3-large (1536 dimensions)
+    embedding_model VARCHAR(100),
+    duplicate_of VARCHAR(64),  -- near-duplicate (same repository) sharing its embedding
+    
+    -- Quality metrics (derived from content only)
+    quality_score FLOAT CHECK (quality_score >= 0 AND quality_score <= 1),
+    usage_count INTEGER DEFAULT 0,
+    last_used_at TIMESTAMP WITH TIME ZONE,
+    
+    -- Full-text search vector (auto-generated)
+    search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('english', content)
+    ) STORED,
+    
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    
+    PRIMARY KEY (repository, content_hash),
+    FOREIGN KEY (repository, duplicate_of) REFERENCES chunk_contents (repository, content_hash)
+) PARTITION BY LIST (repository);
+
+-- SimHash signatures of embedded contents, for near-duplicate detection
+CREATE TABLE chunk_signatures (
+    repository VARCHAR(255) NOT NULL,
+    content_hash VARCHAR(64) NOT NULL,
+    simhash BIGINT NOT NULL,  -- 64-bit SimHash of normalized word shingles
+    
+    PRIMARY KEY (repository, content_hash),
+    FOREIGN KEY (repository, content_hash) REFERENCES chunk_contents (repository, content_hash) ON DELETE CASCADE
+) PARTITION BY LIST (repository);
+
+-- One index per 16-bit band (see NearDuplicateDetector)
+CREATE INDEX idx_simhash_band0 ON chunk_signatures ((simhash & 65535));
+CREATE INDEX idx_simhash_band1 ON chunk_signatures (((simhash >> 16) & 65535));
+CREATE INDEX idx_simhash_band2 ON chunk_signatures (((simhash >> 32) & 65535));
+CREATE INDEX idx_simhash_band3 ON chunk_signatures (((simhash >> 48) & 65535));
+
+-- Where each chunk appears: file, position and source metadata
+CREATE TABLE chunk_occurrences (
+    -- Primary key
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    repository VARCHAR(255) NOT NULL,  -- partition key
+    
+    -- Content reference
+    content_hash VARCHAR(64) NOT NULL,
+    
+    -- Position within the source file
+    file_path TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    total_chunks INTEGER,
+    char_start INTEGER,  -- character offsets in the file, NULL if the splitter altered the text
+    char_end INTEGER,
     
     -- Source metadata
     source_type VARCHAR(50) NOT NULL,  -- 'github', 'adr', 'code', 'runbook', 'confluence', etc.
     source_url TEXT,
-    file_path TEXT NOT NULL,
-    repository VARCHAR(255),
     
     -- Categorization
     category VARCHAR(100),  -- 'architecture', 'code', 'troubleshooting', 'guide', etc.
@@ -73,41 +140,74 @@ CREATE TABLE knowledge_chunks (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     
-    -- Quality metrics
-    quality_score FLOAT CHECK (quality_score >= 0 AND quality_score <= 1),
-    usage_count INTEGER DEFAULT 0,
-    last_used_at TIMESTAMP WITH TIME ZONE,
-    
-    -- Full-text search vector (auto-generated)
-    search_vector tsvector GENERATED ALWAYS AS (
-        to_tsvector('english', content)
-    ) STORED,
-    
     -- Constraints
-    CONSTRAINT unique_content_hash UNIQUE (content_hash, file_path)
-);
-
--- Indexes for knowledge_chunks
-CREATE INDEX idx_embedding ON knowledge_chunks 
-    USING ivfflat (embedding vector_cosine_ops)
-    WITH (lists = 100);
-
-CREATE INDEX idx_source_type ON knowledge_chunks(source_type);
-CREATE INDEX idx_category ON knowledge_chunks(category);
-CREATE INDEX idx_tags ON knowledge_chunks USING gin(tags);
-CREATE INDEX idx_search_vector ON knowledge_chunks USING gin(search_vector);
-CREATE INDEX idx_created_at ON knowledge_chunks(created_at DESC);
-CREATE INDEX idx_file_path ON knowledge_chunks(file_path);
-CREATE INDEX idx_repository ON knowledge_chunks(repository);
-CREATE INDEX idx_language ON knowledge_chunks(language);
-CREATE INDEX idx_usage_count ON knowledge_chunks(usage_count DESC);
+    PRIMARY KEY (repository, id),
+    FOREIGN KEY (repository, content_hash) REFERENCES chunk_contents (repository, content_hash),
+    CONSTRAINT unique_chunk_position UNIQUE (repository, file_path, chunk_index)
+) PARTITION BY LIST (repository);
+
+-- Indexes for chunk_contents (the ANN index only holds distinct vectors).
+-- Partitioned: each repository partition gets its own HNSW graph. HNSW needs
+-- no training data, so new (empty) partitions are searchable right away;
+-- scripts/knowledge/manage-vector-index.py resizes, rebuilds and calibrates it
+-- (and switches to a halfvec expression index above 2000 dimensions).
+CREATE INDEX idx_embedding ON chunk_contents 
+    USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+
+CREATE INDEX idx_search_vector ON chunk_contents USING gin(search_vector);
+CREATE INDEX idx_usage_count ON chunk_contents(usage_count DESC);
+-- Searches reach linked near-duplicates (and their occurrences) through this
+CREATE INDEX idx_duplicate_of ON chunk_contents(repository, duplicate_of) WHERE duplicate_of IS NOT NULL;
+
+-- Indexes for chunk_occurrences
+CREATE INDEX idx_occurrence_content_hash ON chunk_occurrences(content_hash);
+CREATE INDEX idx_source_type ON chunk_occurrences(source_type);
+CREATE INDEX idx_category ON chunk_occurrences(category);
+CREATE INDEX idx_tags ON chunk_occurrences USING gin(tags);
+CREATE INDEX idx_created_at ON chunk_occurrences(created_at DESC);
+CREATE INDEX idx_language ON chunk_occurrences(language);
 
 -- Comments
-COMMENT ON TABLE knowledge_chunks IS 'Vector embeddings and metadata for knowledge base chunks';
-COMMENT ON COLUMN knowledge_chunks.embedding IS 'Vector embedding (1536 dims) from text-embedding-3-large';
-COMMENT ON COLUMN knowledge_chunks.content_hash IS 'SHA-256 hash for deduplication';
-COMMENT ON COLUMN knowledge_chunks.quality_score IS 'Quality score 0-1 based on content analysis';
-COMMENT ON COLUMN knowledge_chunks.usage_count IS 'Number of times this chunk was retrieved in RAG queries';
+COMMENT ON TABLE chunk_contents IS 'Distinct chunk texts and their vector embeddings, keyed by repository and content hash';
+COMMENT ON TABLE chunk_occurrences IS 'Positions of chunks within source files, with source metadata';
+COMMENT ON COLUMN chunk_contents.embedding IS 'Vector embedding (1536 dims) from text-embedding-3-large';
+COMMENT ON COLUMN chunk_contents.content_hash IS 'SHA-256 hash, shared by every occurrence of the same text in a repository';
+COMMENT ON COLUMN chunk_contents.quality_score IS 'Quality score 0-1 based on content analysis';
+COMMENT ON COLUMN chunk_contents.duplicate_of IS 'Near-duplicate content whose embedding this row reuses (embedding left NULL)';
+COMMENT ON COLUMN chunk_contents.usage_count IS 'Number of times this chunk was retrieved in RAG queries';
+COMMENT ON COLUMN chunk_occurrences.char_start IS 'Start offset of the chunk in the source file; neighbours overlap by the splitter overlap';
+
+-- One row per occurrence, same columns as the former knowledge_chunks table
+CREATE VIEW knowledge_chunks AS
+SELECT 
+    o.id,
+    c.content,
+    o.content_hash,
+    c.embedding,
+    o.source_type,
+    o.source_url,
+    o.file_path,
+    o.repository,
+    o.category,
+    o.tags,
+    o.language,
+    o.version,
+    o.commit_sha,
+    o.branch,
+    o.author,
+    o.chunk_index,
+    o.total_chunks,
+    o.created_at,
+    o.updated_at,
+    c.quality_score,
+    c.usage_count,
+    c.last_used_at,
+    c.search_vector
+FROM chunk_occurrences o
+JOIN chunk_contents c ON c.repository = o.repository AND c.content_hash = o.content_hash;
+
+COMMENT ON VIEW knowledge_chunks IS 'Read-only compatibility view over chunk_occurrences and chunk_contents';
 
 -- ============================================================================
 -- Source documents tracking table
@@ -117,12 +217,16 @@ CREATE TABLE source_documents (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     
     -- File identification
-    file_path TEXT NOT NULL UNIQUE,
-    repository VARCHAR(255),
+    file_path TEXT NOT NULL,
+    repository VARCHAR(255) NOT NULL,
     
-    -- Content
-    content TEXT,
+    -- Content (see KnowledgeProcessor.SOURCE_STORAGE_MODES)
+    content TEXT COMPRESSION lz4,  -- plain body ('text' mode), lz4 TOAST on PG14+
+    content_compressed BYTEA,  -- zstd body ('zstd' mode)
+    content_encoding VARCHAR(10) DEFAULT 'text',  -- 'text', 'zstd', 'none'
+    chunk_layout JSONB,  -- chunk hashes/offsets to rebuild the body ('none' mode)
     content_hash VARCHAR(64) NOT NULL,  -- SHA-256 of full document
+    blob_sha VARCHAR(40),  -- git object ID, lets sync skip unchanged files unread
     
     -- Metadata
     file_size INTEGER,
@@ -144,12 +248,14 @@ CREATE TABLE source_documents (
     
     -- Timestamps
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    
+    -- The same path (e.g. README.md) exists in several repositories
+    CONSTRAINT unique_source_document UNIQUE (repository, file_path)
 );
 
--- Indexes for source_documents
+-- Indexes for source_documents (unique_source_document covers repository lookups)
 CREATE INDEX idx_source_file_path ON source_documents(file_path);
-CREATE INDEX idx_source_repository ON source_documents(repository);
 CREATE INDEX idx_source_sync_status ON source_documents(sync_status);
 CREATE INDEX idx_source_last_synced ON source_documents(last_synced DESC);
 
@@ -157,6 +263,40 @@ CREATE INDEX idx_source_last_synced ON source_documents(last_synced DESC);
 COMMENT ON TABLE source_documents IS 'Original source documents before chunking';
 COMMENT ON COLUMN source_documents.chunks_count IS 'Number of chunks generated from this document';
 COMMENT ON COLUMN source_documents.sync_status IS 'Sync status: synced, pending, failed';
+COMMENT ON COLUMN source_documents.content_encoding IS 'Body storage: text, zstd (content_compressed) or none (rebuilt from chunks)';
+COMMENT ON COLUMN source_documents.total_tokens IS 'Embedding tokens reported by Azure OpenAI for all chunks';
+
+-- ============================================================================
+-- Sync watermarks (last fully indexed commit per repository/branch)
+-- ============================================================================
+
+CREATE TABLE sync_watermarks (
+    repository VARCHAR(255) NOT NULL,
+    branch VARCHAR(100) NOT NULL,
+    commit_sha VARCHAR(40) NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    
+    PRIMARY KEY (repository, branch)
+);
+
+COMMENT ON TABLE sync_watermarks IS 'Last commit fully indexed by process-knowledge-documents.py --since-watermark';
+
+-- ============================================================================
+-- Query embedding cache (shared tier of QueryEmbeddingCache)
+-- ============================================================================
+
+CREATE TABLE query_embedding_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,  -- SHA-256 of model|dimensions|normalized query
+    model VARCHAR(100) NOT NULL,
+    dimensions INTEGER NOT NULL,
+    embedding BYTEA NOT NULL,  -- float32 array bytes
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Entries expire after QUERY_CACHE_TTL_DAYS; the retrieval processes prune by it
+CREATE INDEX idx_query_cache_created_at ON query_embedding_cache(created_at);
+
+COMMENT ON TABLE query_embedding_cache IS 'Query embeddings shared across retrieval processes';
 
 -- ============================================================================
 -- Query logs table (for analytics and improvement)
@@ -180,6 +320,8 @@ CREATE TABLE query_logs (
     
     -- Performance
     execution_time_ms INTEGER,
+    stage_timings JSONB,  -- ms per retrieval stage (embedding, sql, decode, ...)
+    query_plan JSONB,  -- sampled EXPLAIN (ANALYZE, BUFFERS) summary of slow queries
     
     -- User context
     user_id VARCHAR(255),
@@ -216,9 +358,9 @@ BEGIN
 END;
 $$ language 'plpgsql';
 
--- Trigger for knowledge_chunks
-CREATE TRIGGER update_knowledge_chunks_updated_at 
-    BEFORE UPDATE ON knowledge_chunks
+-- Trigger for chunk_occurrences
+CREATE TRIGGER update_chunk_occurrences_updated_at 
+    BEFORE UPDATE ON chunk_occurrences
     FOR EACH ROW
     EXECUTE FUNCTION update_updated_at_column();
 
@@ -228,6 +370,53 @@ CREATE TRIGGER update_source_documents_updated_at
     FOR EACH ROW
     EXECUTE FUNCTION update_updated_at_column();
 
+-- Partition name suffix of a repository: readable prefix plus a hash, so any
+-- repository name maps to a distinct, valid identifier within the 63-byte limit
+CREATE OR REPLACE FUNCTION repository_partition_suffix(repo TEXT)
+RETURNS TEXT AS $$
+    SELECT left(regexp_replace(lower(repo), '[^a-z0-9]+', '_', 'g'), 32) || '_' || left(md5(repo), 8);
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Create the chunk table partitions of a repository (idempotent); the
+-- partitioned indexes, including idx_embedding, cascade to them
+CREATE OR REPLACE FUNCTION create_repository_partitions(repo TEXT)
+RETURNS VOID AS $$
+DECLARE
+    suffix TEXT := repository_partition_suffix(repo);
+    parent TEXT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['chunk_contents', 'chunk_signatures', 'chunk_occurrences'] LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES IN (%L)',
+                       parent || '_' || suffix, parent, repo);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drop every chunk of a repository with its partitions and sync state;
+-- other repositories' rows are not scanned. A partition still attached is
+-- detached here, which takes ACCESS EXCLUSIVE on the parent and blocks every
+-- repository's searches and ingests until the transaction ends: the processor
+-- (--drop-repository) first detaches them CONCURRENTLY, outside a transaction
+CREATE OR REPLACE FUNCTION drop_repository_partitions(repo TEXT)
+RETURNS VOID AS $$
+DECLARE
+    suffix TEXT := repository_partition_suffix(repo);
+    parent TEXT;
+BEGIN
+    -- Referencing partitions go first, a referenced one detaches only when unreferenced
+    FOREACH parent IN ARRAY ARRAY['chunk_occurrences', 'chunk_signatures', 'chunk_contents'] LOOP
+        IF to_regclass(parent || '_' || suffix) IS NOT NULL THEN
+            IF EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(parent || '_' || suffix)) THEN
+                EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, parent || '_' || suffix);
+            END IF;
+            EXECUTE format('DROP TABLE %I', parent || '_' || suffix);
+        END IF;
+    END LOOP;
+    DELETE FROM source_documents WHERE repository = repo;
+    DELETE FROM sync_watermarks WHERE repository = repo;
+END;
+$$ LANGUAGE plpgsql;
+
 -- ============================================================================
 -- Helper views
 -- ============================================================================
@@ -282,26 +471,40 @@ GRANT ALL PRIVILEGES ON ALL FUNCTIONS IN SCHEMA public TO difyadmin;
 -- ============================================================================
 
 -- Insert a test chunk
-INSERT INTO knowledge_chunks (
+SELECT create_repository_partitions('DXC_PoC_Nirvana');
+
+INSERT INTO chunk_contents (
+    repository,
     content,
+    content_hash,
+    quality_score
+) VALUES (
+    'DXC_PoC_Nirvana',
+    'This is a test knowledge chunk for the Nirvana Knowledge Portal. It demonstrates how documentation is stored with vector embeddings.',
+    encode(sha256('test content'::bytea), 'hex'),
+    0.95
+);
+
+INSERT INTO chunk_occurrences (
     content_hash,
     source_type,
     file_path,
+    chunk_index,
+    total_chunks,
     repository,
     category,
     tags,
-    language,
-    quality_score
+    language
 ) VALUES (
-    'This is a test knowledge chunk for the Nirvana Knowledge Portal. It demonstrates how documentation is stored with vector embeddings.',
     encode(sha256('test content'::bytea), 'hex'),
     'test',
     'test/sample.md',
+    0,
+    1,
     'DXC_PoC_Nirvana',
     'test',
     ARRAY['test', 'sample'],
-    'markdown',
-    0.95
+    'markdown'
 );
 
 -- Verify tables were created
@@ -0,0 +1,2128 @@
+#!/usr/bin/env python3
+"""
+Knowledge Portal - Retrieval
+============================
+Vector, hybrid and batched search over the knowledge base (pgvector)
+
+Shared by the retrieval test script and the retrieval service; the
+caches and prepared statements live as long as a KnowledgeRetrieval
+instance, so long-running callers should keep instances around.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import threading
+import hashlib
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional, Iterator, Sequence, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+from openai import AzureOpenAI
+
+# Optional: vectorized similarity for the semantic result cache
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Optional: in-process search over a memory-mapped snapshot (needs numpy)
+try:
+    from vector_snapshot import VectorSnapshot
+except ImportError:
+    VectorSnapshot = None
+
+# Optional: exact token counts when packing context
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_token_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Tokens in text (cl100k_base with tiktoken, else ~4 characters per token)."""
+    global _token_encoding
+    if tiktoken is not None and _token_encoding is None:
+        try:
+            _token_encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            _token_encoding = False
+    if _token_encoding:
+        return len(_token_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def _text_overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of left that is a prefix of right."""
+    for size in range(min(len(left), len(right)), 0, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+def maximal_marginal_relevance(
+    vectors,
+    relevance,
+    top_k: int,
+    mmr_lambda: float = 0.7
+) -> List[int]:
+    """Indices of top_k candidates picked by maximal marginal relevance.
+    
+    Each step takes the candidate maximizing
+    mmr_lambda * relevance - (1 - mmr_lambda) * max similarity to the picks
+    so far. Vectors are normalized once and the redundancy term is updated
+    with one matrix-vector product per pick (O(top_k * N * D)).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    
+    redundancy = np.zeros(len(vectors), dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    picked = []
+    for _ in range(min(top_k, len(vectors))):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(redundancy, vectors @ vectors[best], out=redundancy)
+    return picked
+
+class QueryEmbeddingCache:
+    """Two-tier cache for query embeddings.
+    
+    Tier 1 is an in-process LRU; tier 2 is the optional shared
+    query_embedding_cache table, so repeated questions skip Azure OpenAI
+    across processes and restarts. Keys cover the normalized query text,
+    model and dimensions. Shared entries expire after ttl_days; every
+    PRUNE_EVERY stores, expired rows are deleted.
+    """
+    
+    PRUNE_EVERY = 100
+    
+    def __init__(self, conn=None, max_entries: int = 1024, ttl_days: float = 30):
+        self.conn = conn  # None disables the persistent tier
+        self.max_entries = max_entries
+        self.ttl_days = ttl_days
+        self.stores = 0
+        self.entries = OrderedDict()
+        self.stats = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0}
+    
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Canonical form used for cache keys."""
+        return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+    
+    @classmethod
+    def make_key(cls, query: str, model: str, dimensions: Optional[int]) -> str:
+        """Cache key for a query under a given model and dimension count."""
+        raw = f"{model}|{dimensions or ''}|{cls.normalize(query)}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[List[float]]:
+        """Return a cached embedding, promoting persistent hits to memory."""
+        embedding = self.entries.get(key)
+        if embedding is not None:
+            self.entries.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return embedding
+        
+        if self.conn is not None:
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute("""
+                    SELECT embedding FROM query_embedding_cache
+                    WHERE cache_key = %s AND created_at > NOW() - %s * INTERVAL '1 day'
+                """, (key, self.ttl_days))
+                row = cursor.fetchone()
+                cursor.close()
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                print(f"⚠️  Query cache lookup failed: {e}")
+                row = None
+            if row:
+                embedding = array('f', bytes(row[0])).tolist()
+                self._remember(key, embedding)
+                self.stats['persistent_hits'] += 1
+                return embedding
+        
+        self.stats['misses'] += 1
+        return None
+    
+    def put(self, key: str, embedding: List[float], model: str):
+        """Store an embedding in both tiers; the shared row records its length."""
+        self._remember(key, embedding)
+        if self.conn is None:
+            return
+        try:
+            cursor = self.conn.cursor()
+            # An expired row is replaced, a live one kept
+            cursor.execute("""
+                INSERT INTO query_embedding_cache (cache_key, model, dimensions, embedding)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    embedding = EXCLUDED.embedding,
+                    created_at = NOW()
+                WHERE query_embedding_cache.created_at <= NOW() - %s * INTERVAL '1 day'
+            """, (key, model, len(embedding), psycopg2.Binary(array('f', embedding).tobytes()), self.ttl_days))
+            self.stores += 1
+            if self.stores % self.PRUNE_EVERY == 0:
+                cursor.execute(
+                    "DELETE FROM query_embedding_cache WHERE created_at <= NOW() - %s * INTERVAL '1 day'",
+                    (self.ttl_days,)
+                )
+            cursor.close()
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            print(f"⚠️  Query cache store failed: {e}")
+    
+    def preload(self, entries: Dict[str, List[float]]):
+        """Copy embeddings into the in-process tier (e.g. from another instance)."""
+        for key, embedding in entries.items():
+            self._remember(key, embedding)
+    
+    def _remember(self, key: str, embedding: List[float]):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def summary(self) -> str:
+        """One-line hit/miss report."""
+        total = sum(self.stats.values())
+        hits = self.stats['memory_hits'] + self.stats['persistent_hits']
+        rate = (hits / total * 100) if total else 0.0
+        return (f"memory hits={self.stats['memory_hits']}, "
+                f"persistent hits={self.stats['persistent_hits']}, "
+                f"misses={self.stats['misses']} ({rate:.0f}% hit rate)")
+
+class SemanticResultCache:
+    """Result cache matched by query-embedding proximity.
+    
+    A lookup hits when a cached query with identical search parameters lies
+    within max_distance (cosine) of the new one. Entries are dropped when the
+    ingestion pipeline announces, via NOTIFY knowledge_sync, a change to one of
+    the files they returned or to the category they were filtered on;
+    unfiltered entries are dropped on any change since new chunks may outrank
+    them. Requires numpy and a LISTEN-capable (autocommit) connection.
+    """
+    
+    CHANNEL = 'knowledge_sync'
+    
+    def __init__(self, conn, max_distance: float, max_entries: int = 256):
+        self.conn = conn
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.entries = []  # dicts with vector, params, results, files
+        self.matrix = None
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+        cursor = conn.cursor()
+        cursor.execute(f"LISTEN {self.CHANNEL}")
+        cursor.close()
+    
+    def lookup(self, embedding: List[float], params: tuple) -> Optional[List[Dict[str, Any]]]:
+        """Return cached results for a nearby query with the same parameters."""
+        self._drain_notifications()
+        candidates = [i for i, entry in enumerate(self.entries) if entry['params'] == params]
+        if candidates:
+            if self.matrix is None:
+                self.matrix = np.stack([entry['vector'] for entry in self.entries])
+            query = self._unit(embedding)
+            similarities = self.matrix[candidates] @ query
+            best = int(np.argmax(similarities))
+            if 1.0 - float(similarities[best]) <= self.max_distance:
+                self.stats['hits'] += 1
+                return list(self.entries[candidates[best]]['results'])
+        self.stats['misses'] += 1
+        return None
+    
+    def store(self, embedding: List[float], params: tuple, results: List[Dict[str, Any]]):
+        """Cache results for a query."""
+        self.entries.append({
+            'vector': self._unit(embedding),
+            'params': params,
+            'results': list(results),
+            'files': {r['file_path'] for r in results},
+        })
+        if len(self.entries) > self.max_entries:
+            self.entries.pop(0)
+        self.matrix = None
+    
+    def _drain_notifications(self):
+        """Apply pending knowledge_sync notifications."""
+        self.conn.poll()
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            try:
+                change = json.loads(notify.payload)
+            except ValueError:
+                change = {}
+            self.invalidate(change.get('file_path'), change.get('categories') or [])
+    
+    def invalidate(self, file_path: Optional[str], categories: List[str]):
+        """Drop entries affected by a change to file_path / categories."""
+        category_set = set(categories)
+        kept = []
+        for entry in self.entries:
+            category = dict(entry['params']).get('category_filter')
+            stale = (
+                file_path in entry['files']
+                or category is None
+                or category in category_set
+            )
+            if not stale:
+                kept.append(entry)
+        self.stats['invalidated'] += len(self.entries) - len(kept)
+        if len(kept) != len(self.entries):
+            self.entries = kept
+            self.matrix = None
+    
+    @staticmethod
+    def _unit(embedding: List[float]):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def summary(self) -> str:
+        """One-line hit/miss report."""
+        return (f"hits={self.stats['hits']}, misses={self.stats['misses']}, "
+                f"invalidated={self.stats['invalidated']}, entries={len(self.entries)}")
+
+class QueryTrace:
+    """Wall-clock time of each retrieval stage of one search, in ms"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.statement = None  # (sql, params, settings) of the last SQL stage
+        self.plan: Optional[Dict[str, Any]] = None
+        self.explain_sampled = False  # plan captured later by the usage recorder
+        self.degraded: Optional[str] = None  # why the vector path was skipped
+    
+    @contextmanager
+    def span(self, stage: str):
+        """Time a stage; repeated stages (retries) add up."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[stage] = self.spans.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+    
+    @property
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+    
+    def timings(self) -> Dict[str, float]:
+        timings = {stage: round(ms, 2) for stage, ms in self.spans.items()}
+        timings['total'] = round(self.total_ms, 2)
+        return timings
+    
+    def summary(self) -> str:
+        return ', '.join(f"{stage} {ms:.0f} ms" for stage, ms in self.timings().items())
+    
+    @staticmethod
+    def summarize_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+        """Timings, buffers and scans of an EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) plan."""
+        indexes, seq_scans = [], []
+        nodes = [plan['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Index Name') and node['Index Name'] not in indexes:
+                indexes.append(node['Index Name'])
+            if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') not in seq_scans:
+                seq_scans.append(node.get('Relation Name'))
+            nodes.extend(node.get('Plans', []))
+        root = plan['Plan']
+        return {
+            'planning_ms': plan.get('Planning Time'),
+            'execution_ms': plan.get('Execution Time'),
+            'shared_hit': root.get('Shared Hit Blocks'),
+            'shared_read': root.get('Shared Read Blocks'),
+            'indexes': indexes,
+            'seq_scans': seq_scans,
+            # The ANN index was skipped: the embeddings were scored by a full scan
+            'embedding_seq_scan': 'chunk_contents' in seq_scans and 'idx_embedding' not in indexes,
+            'plan': plan,
+        }
+    
+    @classmethod
+    def explain(
+        cls,
+        cursor,
+        sql: str,
+        params: Dict[str, Any],
+        settings: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Run a statement under EXPLAIN (ANALYZE, BUFFERS) in the caller's transaction."""
+        for name, value in (settings or {}).items():
+            cursor.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+        cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return cls.summarize_plan(plan[0])
+    
+    @staticmethod
+    def describe_plan(plan: Dict[str, Any]):
+        """Print the highlights of a summarized plan."""
+        print(f"   📋 Plan: planning {plan['planning_ms']:.1f} ms, execution {plan['execution_ms']:.1f} ms, "
+              f"buffers hit={plan['shared_hit']} read={plan['shared_read']}, "
+              f"indexes={','.join(plan['indexes']) or 'none'}")
+        if plan['embedding_seq_scan']:
+            print("   ⚠️  Embeddings were scored by a sequential scan, not the ANN index")
+
+
+class UsageRecorder:
+    """Background writer for query_logs and chunk usage counters.
+    
+    record() only appends to in-memory buffers; a daemon thread flushes them
+    every flush_interval seconds (or when max_pending queries are waiting)
+    as one multi-row INSERT into query_logs and one aggregated UPDATE of
+    chunk_contents.usage_count/last_used_at, on its own connection. Slow
+    queries sampled for a plan are re-run under EXPLAIN ANALYZE by the same
+    thread before the insert, filling query_plan. A failed flush drops that
+    batch: analytics never block or fail a search.
+    """
+    
+    def __init__(self, flush_interval: float = 5.0, max_pending: int = 500, source: str = 'api'):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.source = source
+        self.lock = threading.Lock()
+        self.logs = []
+        self.explains = []  # (index in logs, (sql, params, settings)) awaiting a plan
+        self.usage = {}  # (repository, content_hash) -> [count, last_used]
+        self.stats = {'logged': 0, 'dropped': 0, 'flushes': 0, 'plans': 0}
+        self.conn = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name='usage-recorder', daemon=True)
+        self.thread.start()
+    
+    def record(
+        self,
+        query: str,
+        results: List[Dict[str, Any]],
+        execution_time_ms: float,
+        query_type: str = 'search',
+        trace: Optional[QueryTrace] = None
+    ):
+        """Buffer one answered query, its stage timings and its chunks' usage."""
+        now = time.time()
+        scores = [r['similarity_score'] for r in results]
+        log = (
+            query,
+            query_type,
+            [r['chunk_id'] for r in results if r.get('chunk_id')],
+            len(results),
+            sum(scores) / len(scores) if scores else None,
+            int(execution_time_ms),
+            self.source,
+            json.dumps(trace.timings()) if trace else None,
+            json.dumps(trace.plan) if trace and trace.plan else None,
+        )
+        with self.lock:
+            if trace and trace.explain_sampled and trace.statement is not None:
+                self.explains.append((len(self.logs), trace.statement))
+            self.logs.append(log)
+            for r in results:
+                entry = self.usage.setdefault((r['repository'], r['content_hash']), [0, now])
+                entry[0] += 1
+                entry[1] = max(entry[1], now)
+            pending = len(self.logs)
+        if pending >= self.max_pending:
+            self.wakeup.set()
+    
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+    
+    def _connect(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(
+                host=os.getenv('POSTGRES_HOST'),
+                port=int(os.getenv('POSTGRES_PORT', '5432')),
+                database=os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
+                user=os.getenv('POSTGRES_USER'),
+                password=os.getenv('POSTGRES_PASSWORD')
+            )
+        return self.conn
+    
+    def flush(self):
+        """Write everything buffered so far in one transaction."""
+        with self.lock:
+            logs, self.logs = self.logs, []
+            explains, self.explains = self.explains, []
+            usage, self.usage = self.usage, {}
+        if not logs and not usage:
+            return
+        
+        try:
+            conn = self._connect()
+            for index, statement in explains:
+                plan = self._explain(conn, statement)
+                if plan is not None:
+                    logs[index] = logs[index][:-1] + (json.dumps(plan),)
+            with conn, conn.cursor() as cursor:
+                if logs:
+                    execute_values(cursor, """
+                        INSERT INTO query_logs (
+                            query_text, query_type, top_chunks_ids, chunks_used,
+                            avg_similarity_score, execution_time_ms, source,
+                            stage_timings, query_plan
+                        ) VALUES %s
+                    """, logs, template="(%s, %s, %s::uuid[], %s, %s, %s, %s, %s::jsonb, %s::jsonb)")
+                if usage:
+                    # Sorted keys: concurrent writers lock rows in the same order
+                    execute_values(cursor, """
+                        UPDATE chunk_contents c
+                        SET usage_count = COALESCE(c.usage_count, 0) + u.uses,
+                            last_used_at = GREATEST(c.last_used_at, u.last_used)
+                        FROM (VALUES %s) AS u(repository, content_hash, uses, last_used)
+                        WHERE c.repository = u.repository AND c.content_hash = u.content_hash
+                    """, [
+                        (repository, content_hash, count, last_used)
+                        for (repository, content_hash), (count, last_used) in sorted(usage.items())
+                    ], template="(%s, %s, %s, to_timestamp(%s))")
+            self.stats['logged'] += len(logs)
+            self.stats['flushes'] += 1
+        except Exception as e:
+            self.stats['dropped'] += len(logs)
+            print(f"⚠️  Dropped {len(logs)} query log records: {e}")
+            if self.conn is not None and not self.conn.closed:
+                self.conn.close()
+            self.conn = None
+    
+    def _explain(self, conn, statement) -> Optional[Dict[str, Any]]:
+        """Capture the plan of a sampled slow query; None when it fails."""
+        try:
+            with conn.cursor() as cursor:
+                plan = QueryTrace.explain(cursor, *statement)
+        except Exception as e:
+            print(f"   ⚠️  EXPLAIN capture failed: {e}")
+            return None
+        finally:
+            conn.rollback()
+        self.stats['plans'] += 1
+        QueryTrace.describe_plan(plan)
+        return plan
+    
+    def close(self):
+        """Flush what is left and stop the writer thread."""
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+    
+    def summary(self) -> str:
+        """One-line writer report."""
+        return (f"logged={self.stats['logged']}, dropped={self.stats['dropped']}, "
+                f"flushes={self.stats['flushes']}, plans={self.stats['plans']}")
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embeddings.create calls into batched requests.
+    
+    Wraps an Azure OpenAI client and exposes the same embeddings.create, so
+    it can be handed to several KnowledgeRetrieval workers as their shared
+    openai_client. The first caller to find no open batch for its model and
+    dimensions leads one: it waits window_ms for other callers to add their
+    inputs (or until max_inputs are gathered), sends them as one request and
+    every caller receives the embeddings of its own inputs. A failed request
+    raises the same error in all of its callers.
+    """
+    
+    def __init__(self, client, window_ms: float = 5.0, max_inputs: int = 2048):
+        self.client = client
+        self.window = window_ms / 1000
+        self.max_inputs = max_inputs
+        self.embeddings = self  # mimics client.embeddings
+        self.lock = threading.Lock()
+        self.open_batches = {}  # (model, dimensions) -> batch gathering inputs
+        self.stats = {'calls': 0, 'requests': 0, 'inputs': 0, 'errors': 0}
+    
+    def create(self, model: str, input, dimensions: Optional[int] = None, **kwargs):
+        """embeddings.create, answered from a shared batched request."""
+        if kwargs or self.window <= 0:
+            params = {'model': model, 'input': input, **kwargs}
+            if dimensions:
+                params['dimensions'] = dimensions
+            return self.client.embeddings.create(**params)
+        
+        inputs = [input] if isinstance(input, str) else list(input)
+        key = (model, dimensions)
+        with self.lock:
+            self.stats['calls'] += 1
+            batch = self.open_batches.get(key)
+            leader = batch is None or len(batch.inputs) + len(inputs) > self.max_inputs
+            if leader:
+                batch = SimpleNamespace(
+                    inputs=[], full=threading.Event(), done=threading.Event(), response=None, error=None
+                )
+                self.open_batches[key] = batch
+            offset = len(batch.inputs)
+            batch.inputs.extend(inputs)
+            if len(batch.inputs) >= self.max_inputs:
+                batch.full.set()
+        
+        if leader:
+            self._send(key, batch, model, dimensions)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        
+        by_index = {item.index: item.embedding for item in batch.response.data}
+        return SimpleNamespace(model=model, data=[
+            SimpleNamespace(index=i, embedding=by_index[offset + i]) for i in range(len(inputs))
+        ])
+    
+    def _send(self, key: tuple, batch, model: str, dimensions: Optional[int]):
+        """Close the batch after the window and request all of its inputs at once."""
+        try:
+            batch.full.wait(self.window)
+            with self.lock:
+                # A full batch may already have been replaced by a newer one
+                if self.open_batches.get(key) is batch:
+                    del self.open_batches[key]
+            params = {'model': model, 'input': batch.inputs}
+            if dimensions:
+                params['dimensions'] = dimensions
+            batch.response = self.client.embeddings.create(**params)
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['inputs'] += len(batch.inputs)
+        except Exception as e:
+            batch.error = e
+            with self.lock:
+                self.stats['errors'] += 1
+        finally:
+            # Waiting callers must never hang on a leader that failed
+            if batch.response is None and batch.error is None:
+                batch.error = RuntimeError('Embedding batch was not sent')
+            batch.done.set()
+    
+    def summary(self) -> str:
+        """One-line coalescing report."""
+        requests = self.stats['requests']
+        per_request = self.stats['inputs'] / requests if requests else 0.0
+        return (f"calls={self.stats['calls']}, requests={requests}, "
+                f"inputs/request={per_request:.1f}, errors={self.stats['errors']}")
+
+class KnowledgeRetrieval:
+    def __init__(
+        self,
+        openai_client: Optional[AzureOpenAI] = None,
+        usage_recorder: Optional[UsageRecorder] = None
+    ):
+        """Initialize connections to PostgreSQL and Azure OpenAI.
+        
+        Long-running callers pass one openai_client and one usage_recorder
+        to share them between instances.
+        """
+        # PostgreSQL connection
+        self.conn = psycopg2.connect(
+            host=os.getenv('POSTGRES_HOST'),
+            port=int(os.getenv('POSTGRES_PORT', '5432')),
+            database=os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
+            user=os.getenv('POSTGRES_USER'),
+            password=os.getenv('POSTGRES_PASSWORD')
+        )
+        # Read-only workload; autocommit also lets LISTEN notifications through
+        self.conn.autocommit = True
+        self.pgvector_version = self._pgvector_version()
+        
+        # Build/search settings stored with the ANN index by manage-vector-index.py
+        self.index_settings = self._index_settings()
+        self.index_halfvec = self.index_settings.get('halfvec')
+        
+        # Filters matching at most this many contents are searched exactly
+        self.exact_filter_limit = int(os.getenv('FILTER_EXACT_LIMIT', '5000'))
+        
+        # Server-side prepared search statements of this session: SQL -> (name, params)
+        self.prepared = {}
+        
+        # Stage tracing; the usage recorder re-runs a sample of slow searches
+        # under EXPLAIN ANALYZE, off the request path
+        self.trace: Optional[QueryTrace] = None
+        self.slow_query_ms = float(os.getenv('TRACE_SLOW_QUERY_MS', '1000'))
+        self.explain_sample_rate = float(os.getenv('TRACE_EXPLAIN_SAMPLE_RATE', '0'))
+        
+        # Per-stage search budgets in ms (0: unbounded); a search whose embedding
+        # or vector SQL would run over them is answered by full-text search only
+        self.embedding_timeout_ms = float(os.getenv('SEARCH_EMBEDDING_TIMEOUT_MS', '0'))
+        self.sql_timeout_ms = float(os.getenv('SEARCH_SQL_TIMEOUT_MS', '0'))
+        self.fallback_timeout_ms = float(os.getenv('SEARCH_FALLBACK_TIMEOUT_MS', '1000'))
+        self.deadline: Optional[float] = None  # perf_counter() limit of the running SQL stage
+        self.embedding_executor: Optional[ThreadPoolExecutor] = None
+        self.embedding_call = None  # (cache key, future) of the last time-bounded API call
+        
+        # Azure OpenAI client for generating query embeddings
+        self.openai_client = openai_client or AzureOpenAI(
+            api_key=os.getenv('AZURE_OPENAI_API_KEY'),
+            azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
+            api_version='2024-02-01'
+        )
+        
+        self.embedding_model = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-large')
+        # Shortened embeddings; ingestion reads the same variable, so stored and
+        # query vectors match the embedding column
+        dimensions = os.getenv('EMBEDDING_DIMENSIONS')
+        self.embedding_dimensions = int(dimensions) if dimensions else None
+        
+        # Query embedding cache (QUERY_CACHE_PERSIST=true adds the shared table tier)
+        persist = os.getenv('QUERY_CACHE_PERSIST', 'false').lower() == 'true'
+        self.query_cache = QueryEmbeddingCache(
+            conn=self.conn if persist else None,
+            max_entries=int(os.getenv('QUERY_CACHE_SIZE', '1024')),
+            ttl_days=float(os.getenv('QUERY_CACHE_TTL_DAYS', '30'))
+        )
+        
+        # Local snapshot (VECTOR_SNAPSHOT_DIR) serves vector searches without SQL
+        self.snapshot = None
+        snapshot_dir = os.getenv('VECTOR_SNAPSHOT_DIR')
+        if snapshot_dir:
+            if VectorSnapshot is None:
+                print("⚠️  Vector snapshot requires numpy, searching PostgreSQL instead")
+            elif not os.path.exists(os.path.join(snapshot_dir, 'manifest.json')):
+                print(f"⚠️  No vector snapshot in {snapshot_dir}, searching PostgreSQL instead")
+            else:
+                self.snapshot = VectorSnapshot(snapshot_dir)
+                print(f"📦 Vector snapshot v{self.snapshot.version}: {self.snapshot.manifest['count']} vectors")
+        
+        # Query logs and usage counters, written in the background (QUERY_LOGGING=false disables)
+        self.usage_recorder = usage_recorder
+        if usage_recorder is None and os.getenv('QUERY_LOGGING', 'true').lower() == 'true':
+            self.usage_recorder = UsageRecorder(
+                flush_interval=float(os.getenv('QUERY_LOG_FLUSH_SECONDS', '5')),
+                source=os.getenv('QUERY_LOG_SOURCE', 'api')
+            )
+        
+        # Semantic result cache (SEMANTIC_CACHE_MAX_DISTANCE > 0 enables it)
+        self.result_cache = None
+        max_distance = float(os.getenv('SEMANTIC_CACHE_MAX_DISTANCE', '0'))
+        if max_distance > 0:
+            if np is None:
+                print("⚠️  Semantic result cache requires numpy, running without it")
+            else:
+                self.result_cache = SemanticResultCache(
+                    self.conn,
+                    max_distance,
+                    max_entries=int(os.getenv('SEMANTIC_CACHE_SIZE', '256'))
+                )
+        
+    def _pgvector_version(self) -> tuple:
+        """Installed pgvector version as a tuple, (0,) when unknown."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cursor.fetchone()
+        cursor.close()
+        if not row:
+            return (0,)
+        return tuple(int(part) for part in row[0].split('.') if part.isdigit())
+    
+    def _index_settings(self) -> Dict[str, Any]:
+        """Settings recorded in the idx_embedding comment, {} when absent."""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT indexdef, obj_description(indexname::text::regclass, 'pg_class')
+            FROM pg_indexes
+            WHERE tablename = 'chunk_contents' AND indexname = 'idx_embedding'
+        """)
+        row = cursor.fetchone()
+        cursor.close()
+        if not row:
+            return {}
+        try:
+            settings = json.loads(row[1]) if row[1] else {}
+        except ValueError:
+            settings = {}
+        settings.setdefault('method', 'hnsw' if 'USING hnsw' in row[0] else 'ivfflat')
+        return settings
+    
+    def _search_settings(self, limit: int, widen: int = 1) -> Dict[str, Any]:
+        """Per-query ANN settings: calibrated probes/ef_search, scaled by widen."""
+        if self.index_settings.get('method') == 'hnsw':
+            # ef_search bounds how many rows an HNSW scan can return
+            ef_search = max(self.index_settings.get('ef_search', 40), limit) * widen
+            return {'hnsw.ef_search': min(ef_search, 1000)}
+        probes = self.index_settings.get('probes')
+        if probes is None:
+            return {'ivfflat.probes': 10 * widen} if widen > 1 else {}
+        return {'ivfflat.probes': probes * widen}
+    
+    def _distance(self, operand: str = "%(embedding)s::vector") -> str:
+        """Distance expression matching the indexed expression (vector or halfvec)."""
+        if self.index_halfvec:
+            cast = f"halfvec({self.index_halfvec})"
+            return f"c.embedding::{cast} <=> ({operand})::{cast}"
+        return f"c.embedding <=> {operand}"
+    
+    @property
+    def supports_iterative_scan(self) -> bool:
+        """pgvector 0.8+ keeps scanning the ANN index until filters are satisfied."""
+        return self.pgvector_version >= (0, 8)
+    
+    # Azure OpenAI accepts up to 2048 inputs per embeddings request
+    EMBEDDING_BATCH_SIZE = 2048
+    
+    def generate_query_embedding(self, query: str) -> List[float]:
+        """Generate embedding for search query, served from cache when possible."""
+        return self.generate_query_embeddings([query])[0]
+    
+    def generate_query_embeddings(self, queries: List[str]) -> List[Optional[List[float]]]:
+        """Embed several queries with batched requests; cached ones skip the API."""
+        keys = [
+            QueryEmbeddingCache.make_key(query, self.embedding_model, self.embedding_dimensions)
+            for query in queries
+        ]
+        embeddings = {}
+        pending = {}  # key -> query text, one API input per distinct key
+        for key, query in zip(keys, queries):
+            if key in embeddings or key in pending:
+                continue
+            cached = self.query_cache.get(key)
+            if cached is not None:
+                embeddings[key] = cached
+            else:
+                pending[key] = query
+        
+        pending_keys = list(pending)
+        for start in range(0, len(pending_keys), self.EMBEDDING_BATCH_SIZE):
+            batch = pending_keys[start:start + self.EMBEDDING_BATCH_SIZE]
+            try:
+                response = self.openai_client.embeddings.create(
+                    **self._embedding_params([pending[key] for key in batch])
+                )
+            except Exception as e:
+                print(f"❌ Error generating embedding: {e}")
+                continue
+            for item in response.data:
+                key = batch[item.index]
+                embeddings[key] = item.embedding
+                self.query_cache.put(key, item.embedding, self.embedding_model)
+        
+        return [embeddings.get(key) for key in keys]
+    
+    def _embedding_params(self, inputs: List[str]) -> Dict[str, Any]:
+        params = {'model': self.embedding_model, 'input': inputs}
+        if self.embedding_dimensions:
+            params['dimensions'] = self.embedding_dimensions
+        return params
+    
+    def _bounded_query_embedding(self, query: str, timeout_ms: float) -> Optional[List[float]]:
+        """Query embedding, or None when the API does not answer within timeout_ms.
+        
+        The API call runs on a helper thread so the search can stop waiting;
+        an abandoned call keeps running and its embedding is cached when it
+        lands. While it is outstanding (API throttled or slow) further
+        queries needing the API do not queue behind it and get None at once.
+        """
+        key = QueryEmbeddingCache.make_key(query, self.embedding_model, self.embedding_dimensions)
+        if self.embedding_call is not None:
+            late_key, late_call = self.embedding_call
+            if not late_call.done():
+                cached = self.query_cache.get(key)
+                if cached is None:
+                    print("   ⏳ Previous embedding request still pending")
+                return cached
+            self.embedding_call = None
+            if late_call.exception() is None:
+                self.query_cache.put(late_key, late_call.result().data[0].embedding, self.embedding_model)
+        
+        cached = self.query_cache.get(key)
+        if cached is not None or timeout_ms <= 0:
+            return cached
+        
+        if self.embedding_executor is None:
+            self.embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-embedding')
+        call = self.embedding_executor.submit(self.openai_client.embeddings.create, **self._embedding_params([query]))
+        try:
+            embedding = call.result(timeout=timeout_ms / 1000).data[0].embedding
+        except FutureTimeoutError:
+            self.embedding_call = (key, call)
+            print(f"   ⏱️  Embedding exceeded its {timeout_ms:.0f} ms budget")
+            return None
+        except Exception as e:
+            print(f"❌ Error generating embedding: {e}")
+            return None
+        self.query_cache.put(key, embedding, self.embedding_model)
+        return embedding
+    
+    def _stage_budget(self, stage_timeout_ms: float, deadline: Optional[float]) -> Optional[float]:
+        """ms a search stage may take, None when unbounded.
+        
+        The stage's own timeout, capped so that the full-text fallback still
+        fits before the query deadline.
+        """
+        budgets = [stage_timeout_ms] if stage_timeout_ms > 0 else []
+        if deadline is not None:
+            budgets.append((deadline - time.perf_counter()) * 1000 - self.fallback_timeout_ms)
+        return max(min(budgets), 0.0) if budgets else None
+    
+    # Occurrences of a content: its own and those of the near-duplicates linked
+    # to it (duplicate_of), which have no embedding and are only found through it
+    OCCURRENCE_MATCH = """o.repository = c.repository AND o.content_hash = ANY(ARRAY(
+                SELECT c.content_hash
+                UNION ALL
+                SELECT d.content_hash FROM chunk_contents d
+                WHERE d.repository = c.repository AND d.duplicate_of = c.content_hash
+            ))"""
+    
+    # Shared by all search modes: one representative occurrence per content,
+    # preferring the content's own occurrences; a linked near-duplicate's
+    # occurrence (only picked when the filters leave no other) brings its own
+    # text as linked_content
+    OCCURRENCE_JOIN = f"""
+        CROSS JOIN LATERAL (
+            SELECT o.id, o.file_path, o.repository, o.category, o.tags, o.language,
+                   o.chunk_index, o.char_start, o.char_end, o.content_hash,
+                   CASE WHEN o.content_hash <> c.content_hash THEN (
+                       SELECT d.content FROM chunk_contents d
+                       WHERE d.repository = o.repository AND d.content_hash = o.content_hash
+                   ) END AS linked_content
+            FROM chunk_occurrences o
+            WHERE {OCCURRENCE_MATCH}{{filters}}
+            ORDER BY (o.content_hash <> c.content_hash), o.file_path, o.chunk_index
+            LIMIT 1
+        ) o
+    """
+    
+    # Restricts contents to those with at least one occurrence matching the filters
+    CONTENT_FILTER = f"""
+            AND EXISTS (
+                SELECT 1 FROM chunk_occurrences o
+                WHERE {OCCURRENCE_MATCH}{{filters}}
+            )"""
+    
+    ITERATIVE_SCAN_SETTINGS = {
+        'hnsw.iterative_scan': 'relaxed_order',
+        'ivfflat.iterative_scan': 'relaxed_order',
+    }
+    
+    def search_chunks(
+        self, 
+        query: str, 
+        top_k: int = 5, 
+        score_threshold: float = 0.70,
+        category_filter: str = None,
+        search_mode: str = 'vector',
+        vector_weight: float = 1.0,
+        text_weight: float = 1.0,
+        tags_filter: Optional[List[str]] = None,
+        language_filter: str = None,
+        mmr_lambda: Optional[float] = None,
+        repository_filter: str = None,
+        deadline_ms: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Search for relevant chunks using vector similarity.
+        
+        Args:
+            query: Search query text
+            top_k: Number of results to return
+            score_threshold: Minimum similarity score (0-1)
+            category_filter: Optional category to filter by
+            search_mode: 'vector' (ANN only) or 'hybrid' (ANN + full-text,
+                fused with reciprocal rank fusion in a single statement)
+            vector_weight: Hybrid mode weight of the ANN ranking
+            text_weight: Hybrid mode weight of the full-text ranking
+            tags_filter: Optional tags; chunks carrying any of them match
+            language_filter: Optional language to filter by
+            mmr_lambda: Optional relevance/diversity trade-off (0-1); when set,
+                MMR_CANDIDATES_FACTOR x top_k candidates are re-ranked with
+                maximal marginal relevance so near-identical chunks (e.g.
+                overlapping neighbours of one file) do not crowd the top_k
+            repository_filter: Optional repository; only its partition of
+                chunk_contents (and its own ANN index) is searched
+            deadline_ms: Optional budget for the whole search. The embedding
+                and vector SQL stages are also bounded by SEARCH_EMBEDDING_TIMEOUT_MS
+                and SEARCH_SQL_TIMEOUT_MS (statement_timeout); when the embedding
+                is unavailable or a stage runs out of budget, a full-text-only
+                search answers instead and self.trace.degraded says why
+        """
+        if search_mode not in ('vector', 'hybrid'):
+            raise ValueError(f"Unknown search mode: {search_mode}")
+        started = time.perf_counter()
+        trace = self.trace = QueryTrace()
+        deadline = started + deadline_ms / 1000 if deadline_ms else None
+        
+        print(f"\n🔍 Searching for: '{query}'")
+        print(f"   Parameters: top_k={top_k}, threshold={score_threshold}, mode={search_mode}")
+        
+        diversify = mmr_lambda is not None
+        if diversify and np is None:
+            print("⚠️  MMR diversification requires numpy, returning plain ranking")
+            diversify = False
+        fetch_k = max(top_k * self.MMR_CANDIDATES_FACTOR, 20) if diversify else top_k
+        
+        params = {'top_k': fetch_k}
+        occurrence_filter = self._occurrence_filter(params, category_filter, tags_filter, language_filter)
+        
+        # Generate query embedding
+        embedding_budget = self._stage_budget(self.embedding_timeout_ms, deadline)
+        with trace.span('embedding'):
+            if embedding_budget is None:
+                query_embedding = self.generate_query_embedding(query)
+            else:
+                query_embedding = self._bounded_query_embedding(query, embedding_budget)
+        if not query_embedding:
+            return self._text_search(
+                query, dict(params, top_k=top_k), occurrence_filter, repository_filter,
+                'embedding_unavailable', deadline, started
+            )
+        
+        # Paraphrases of recent queries with the same parameters
+        cache_params = self._cache_params(
+            top_k, category_filter, tags_filter, language_filter, search_mode, vector_weight, text_weight,
+            mmr_lambda, repository_filter
+        )
+        if self.result_cache:
+            with trace.span('result_cache'):
+                cached = self.result_cache.lookup(query_embedding, cache_params)
+            if cached is not None:
+                print(f"   ♻️  Served {len(cached)} results from semantic cache")
+                self._record_usage(query, cached, started)
+                return cached
+        
+        params['embedding'] = self._vector_literal(query_embedding)
+        
+        # Every statement of the vector stage shares its budget
+        sql_budget = self._stage_budget(self.sql_timeout_ms, deadline)
+        if sql_budget is not None:
+            self.deadline = time.perf_counter() + sql_budget / 1000
+        try:
+            if search_mode == 'hybrid':
+                results = self._hybrid_search(
+                    query, params, occurrence_filter, vector_weight, text_weight, repository_filter
+                )
+            elif self.snapshot:
+                with trace.span('snapshot'):
+                    results = self._snapshot().search(
+                        query_embedding, fetch_k, category_filter, tags_filter, language_filter,
+                        repository_filter
+                    )
+            else:
+                results = self._vector_search(params, occurrence_filter, repository_filter)
+        except (psycopg2.extensions.QueryCanceledError, TimeoutError):
+            print("   ⏱️  Vector search ran out of time")
+            return self._text_search(
+                query, dict(params, top_k=top_k), occurrence_filter, repository_filter,
+                'vector_search_timeout', deadline, started
+            )
+        finally:
+            self.deadline = None
+        
+        if diversify and len(results) > top_k:
+            with trace.span('mmr'):
+                results = self._diversify(query_embedding, results, top_k, mmr_lambda)
+        
+        if self.result_cache:
+            self.result_cache.store(query_embedding, cache_params, results)
+        
+        # Filter by score threshold
+        filtered_results = [r for r in results if r['similarity_score'] >= score_threshold]
+        
+        print(f"   Found {len(results)} results, {len(filtered_results)} above threshold")
+        
+        # Show top scores even if below threshold for debugging
+        if results and not filtered_results:
+            top_scores = [r['similarity_score'] for r in results[:3]]
+            print(f"   ⚠️  Top scores: {', '.join([f'{s:.4f}' for s in top_scores])}")
+        
+        if trace.total_ms >= self.slow_query_ms:
+            self._trace_slow_query(trace)
+        self._record_usage(query, results, started)
+        
+        # Return all results for display (threshold filter for production use)
+        return results
+    
+    # Candidates re-ranked by MMR, as a multiple of top_k
+    MMR_CANDIDATES_FACTOR = 4
+    
+    def _diversify(
+        self,
+        query_embedding: List[float],
+        results: List[Dict[str, Any]],
+        top_k: int,
+        mmr_lambda: float
+    ) -> List[Dict[str, Any]]:
+        """Re-rank candidates with MMR using their stored embeddings."""
+        hashes = [r['content_hash'] for r in results]
+        if self.snapshot and all(h in self.snapshot.row_of for h in hashes):
+            vectors = self.snapshot.vectors[[self.snapshot.row_of[h] for h in hashes]]
+        else:
+            keys = [(r['repository'], r['content_hash']) for r in results]
+            cursor = self.conn.cursor()
+            cursor.execute(f"""
+                SELECT c.repository, c.content_hash, c.embedding::text
+                FROM chunk_contents c
+                JOIN {self.KEYS_UNNEST} USING (repository, content_hash)
+                WHERE c.embedding IS NOT NULL
+            """, self._key_arrays(keys))
+            by_key = {(repository, h): text for repository, h, text in cursor.fetchall()}
+            cursor.close()
+            vectors = np.array(
+                [by_key[key].strip('[]').split(',') for key in keys], dtype=np.float32
+            )
+        relevance = np.array([r['similarity_score'] for r in results], dtype=np.float32)
+        order = maximal_marginal_relevance(vectors, relevance, top_k, mmr_lambda)
+        return [results[i] for i in order]
+    
+    def assemble_context(
+        self,
+        results: List[Dict[str, Any]],
+        token_budget: int = 3000,
+        separator: str = "\n\n---\n\n"
+    ) -> Dict[str, Any]:
+        """
+        Build an LLM context from search results.
+        
+        Hits that are neighbours in the same file (touching or overlapping
+        character offsets, or consecutive chunk_index when offsets are
+        unknown) are merged into one block and the text they share is kept
+        once. Blocks keep the rank of their best hit and are packed in
+        rank order; a block that does not fit the remaining budget is
+        dropped and smaller ones after it may still fit.
+        
+        Returns the context text, the sources packed (file, chunk indexes,
+        offsets), the token count and the number of dropped blocks.
+        """
+        by_file: Dict[str, List[tuple]] = {}
+        for rank, result in enumerate(results):
+            by_file.setdefault(result['file_path'], []).append((rank, result))
+        
+        blocks = []
+        for file_path, hits in by_file.items():
+            hits.sort(key=lambda hit: (
+                hit[1].get('chunk_index') is None, hit[1].get('chunk_index') or 0
+            ))
+            block = None
+            for rank, hit in hits:
+                start, end, index = hit.get('char_start'), hit.get('char_end'), hit.get('chunk_index')
+                if block is not None and start is not None and block['char_end'] is not None \
+                        and start <= block['char_end']:
+                    # Offsets known: append only what extends past the block
+                    if end > block['char_end']:
+                        block['text'] += hit['content'][block['char_end'] - start:]
+                        block['char_end'] = end
+                elif block is not None and index is not None and block['chunk_indexes'][-1] is not None \
+                        and index == block['chunk_indexes'][-1] + 1:
+                    overlap = _text_overlap(block['text'], hit['content'])
+                    block['text'] += hit['content'][overlap:] if overlap else "\n" + hit['content']
+                    block['char_end'] = end
+                else:
+                    block = {
+                        'file_path': file_path,
+                        'text': hit['content'],
+                        'chunk_indexes': [],
+                        'char_start': start,
+                        'char_end': end,
+                        'rank': rank,
+                    }
+                    blocks.append(block)
+                block['chunk_indexes'].append(index)
+                block['rank'] = min(block['rank'], rank)
+        
+        parts, sources = [], []
+        tokens = 0
+        separator_tokens = count_tokens(separator)
+        dropped = 0
+        for block in sorted(blocks, key=lambda b: b['rank']):
+            text = f"Source: {block['file_path']}\n{block['text']}"
+            block_tokens = count_tokens(text) + (separator_tokens if parts else 0)
+            if tokens + block_tokens > token_budget:
+                dropped += 1
+                continue
+            parts.append(text)
+            tokens += block_tokens
+            sources.append({
+                'file_path': block['file_path'],
+                'chunk_indexes': block['chunk_indexes'],
+                'char_start': block['char_start'],
+                'char_end': block['char_end'],
+            })
+        
+        return {
+            'context': separator.join(parts),
+            'sources': sources,
+            'tokens': tokens,
+            'dropped': dropped,
+        }
+    
+    def _record_usage(self, query: str, results: List[Dict[str, Any]], started: float):
+        """Hand the answered query to the background writer, if enabled."""
+        if self.usage_recorder:
+            self.usage_recorder.record(
+                query, results, (time.perf_counter() - started) * 1000, trace=self.trace
+            )
+    
+    def _trace_slow_query(self, trace: QueryTrace):
+        """Report a slow search by stage; sampled ones get their plan captured.
+        
+        The plan is captured by the usage recorder's thread, which writes it
+        to query_logs.query_plan; without query logging there is no capture.
+        """
+        print(f"   🐢 Slow query ({trace.total_ms:.0f} ms): {trace.summary()}")
+        if trace.statement is None or not self.usage_recorder:
+            return
+        trace.explain_sampled = random.random() < self.explain_sample_rate
+    
+    def explain(
+        self,
+        sql: str,
+        params: Dict[str, Any],
+        settings: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Run a search statement under EXPLAIN (ANALYZE, BUFFERS), summarized.
+        
+        The statement executes again with the same settings; run it for
+        sampled queries only.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            return QueryTrace.explain(cursor, sql, params, settings)
+        finally:
+            cursor.execute("ROLLBACK")
+            cursor.close()
+    
+    def search_many(
+        self,
+        queries: List[str],
+        top_k: int = 5,
+        category_filter: str = None,
+        tags_filter: Optional[List[str]] = None,
+        language_filter: str = None,
+        repository_filter: str = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Vector search for many queries at once.
+        
+        All queries are embedded with batched requests and searched in a
+        single SQL statement (unnest + LATERAL ANN subquery). Returns one
+        result list per query, in input order; a query whose embedding
+        failed gets an empty list.
+        """
+        started = time.perf_counter()
+        self.trace = None
+        print(f"\n🔍 Searching {len(queries)} queries (top_k={top_k})")
+        
+        embeddings = self.generate_query_embeddings(queries)
+        cache_params = self._cache_params(
+            top_k, category_filter, tags_filter, language_filter, repository_filter=repository_filter
+        )
+        
+        results = [[] for _ in queries]
+        pending = []
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                continue
+            cached = self.result_cache.lookup(embedding, cache_params) if self.result_cache else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        
+        if pending and self.snapshot:
+            snapshot = self._snapshot()
+            for i in pending:
+                results[i] = snapshot.search(
+                    embeddings[i], top_k, category_filter, tags_filter, language_filter, repository_filter
+                )
+        elif pending:
+            params = {'top_k': top_k}
+            occurrence_filter = self._occurrence_filter(params, category_filter, tags_filter, language_filter)
+            batch = self._batch_search(
+                [embeddings[i] for i in pending], params, occurrence_filter, repository_filter
+            )
+            for i, query_results in zip(pending, batch):
+                results[i] = query_results
+        
+        if pending and self.result_cache:
+            for i in pending:
+                self.result_cache.store(embeddings[i], cache_params, results[i])
+        
+        if self.usage_recorder:
+            elapsed_ms = (time.perf_counter() - started) * 1000 / max(len(queries), 1)
+            for query, query_results in zip(queries, results):
+                self.usage_recorder.record(query, query_results, elapsed_ms, query_type='batch_search')
+        
+        print(f"   Found results for {sum(1 for r in results if r)}/{len(queries)} queries "
+              f"({len(queries) - len(pending)} from the semantic cache)")
+        return results
+    
+    # Projectable result columns of stream_chunks
+    STREAM_COLUMNS = {
+        'content': 'COALESCE(o.linked_content, c.content) AS content',
+        'chunk_id': 'o.id AS chunk_id',
+        'file_path': 'o.file_path',
+        'repository': 'c.repository',
+        'category': 'o.category',
+        'tags': 'o.tags',
+        'language': 'o.language',
+        'chunk_index': 'o.chunk_index',
+        'char_start': 'o.char_start',
+        'char_end': 'o.char_end',
+        'quality_score': 'c.quality_score',
+    }
+    DEFAULT_STREAM_COLUMNS = ('chunk_id', 'file_path', 'chunk_index')
+    
+    def stream_chunks(
+        self,
+        query: str,
+        limit: int = 1000,
+        batch_size: int = 100,
+        columns: Sequence[str] = DEFAULT_STREAM_COLUMNS,
+        after: Optional[Tuple[float, str, str]] = None,
+        category_filter: str = None,
+        tags_filter: Optional[List[str]] = None,
+        language_filter: str = None,
+        repository_filter: str = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yield up to limit vector search results in distance order.
+        
+        Rows are read from a server-side cursor batch_size at a time, so a
+        large limit never sits in client memory at once. Every row has
+        content_hash, occurrence_hash (differs for a linked near-duplicate's
+        occurrence), repository, distance and similarity_score plus the
+        projected columns; content is left out by default, load_contents
+        fills it in for the rows a caller keeps. Passing the last row's
+        (distance, content_hash, repository) as after resumes the ranking
+        behind it (keyset pagination), e.g. across API requests.
+        
+        The cursor's transaction holds the connection until the generator
+        is exhausted or closed, so one instance runs one stream at a time.
+        Streams are not logged to query_logs.
+        """
+        unknown = set(columns) - set(self.STREAM_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown stream columns: {', '.join(sorted(unknown))}")
+        
+        query_embedding = self.generate_query_embedding(query)
+        if not query_embedding:
+            return
+        
+        params = {'embedding': self._vector_literal(query_embedding), 'limit': limit}
+        occurrence_filter = self._occurrence_filter(params, category_filter, tags_filter, language_filter)
+        content_filter = self._partition_filter(params, repository_filter)
+        if occurrence_filter:
+            content_filter += self.CONTENT_FILTER.format(filters=occurrence_filter)
+        if after is not None:
+            # Row comparison: ties on distance are ordered by content hash, then repository
+            content_filter += (
+                f" AND ({self._distance()}, c.content_hash, c.repository)"
+                " > (%(after_distance)s, %(after_hash)s, %(after_repository)s)"
+            )
+            params['after_distance'], params['after_hash'], params['after_repository'] = after
+        
+        # Without iterative scans an ANN scan stops at ef_search/probes rows and
+        # skipped rows (filters, keyset) are lost, so score every row instead
+        settings = self._search_settings(limit)
+        exact = False
+        if self.supports_iterative_scan:
+            settings.update(self.ITERATIVE_SCAN_SETTINGS)
+        elif occurrence_filter or after is not None or settings.get('hnsw.ef_search', limit) < limit:
+            exact = True
+            settings = {}
+        
+        sql = self._stream_sql(
+            self.OCCURRENCE_JOIN.format(filters=occurrence_filter), content_filter, columns, exact
+        )
+        name = "knowledge_stream"
+        cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+        finished = False
+        cursor.execute("BEGIN")
+        try:
+            for setting, value in settings.items():
+                cursor.execute("SELECT set_config(%s, %s, true)", (setting, str(value)))
+            cursor.execute(f"DECLARE {name} NO SCROLL CURSOR FOR {sql}", params)
+            while True:
+                cursor.execute(f"FETCH FORWARD %s FROM {name}", (batch_size,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                yield from rows
+            finished = True
+        finally:
+            cursor.execute("COMMIT" if finished else "ROLLBACK")
+            cursor.close()
+    
+    def load_contents(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Fill in 'content' of projected stream results with one query.
+        
+        Text is looked up by occurrence_hash, so a linked near-duplicate's
+        occurrence gets its own text, as when content is projected.
+        """
+        def key(result):
+            return result['repository'], result.get('occurrence_hash') or result['content_hash']
+        
+        missing = list({key(r) for r in results if r.get('content') is None})
+        if missing:
+            cursor = self.conn.cursor()
+            cursor.execute(f"""
+                SELECT c.repository, c.content_hash, c.content
+                FROM chunk_contents c
+                JOIN {self.KEYS_UNNEST} USING (repository, content_hash)
+            """, self._key_arrays(missing))
+            contents = {(repository, h): content for repository, h, content in cursor.fetchall()}
+            cursor.close()
+            for result in results:
+                if result.get('content') is None:
+                    result['content'] = contents.get(key(result))
+        return results
+    
+    # (repository, content_hash) keys passed as two parallel arrays
+    KEYS_UNNEST = "unnest(%(repositories)s::text[], %(hashes)s::text[]) AS k(repository, content_hash)"
+    
+    @staticmethod
+    def _key_arrays(keys: Sequence[Tuple[str, str]]) -> Dict[str, List[str]]:
+        return {'repositories': [k[0] for k in keys], 'hashes': [k[1] for k in keys]}
+    
+    def _stream_sql(
+        self,
+        occurrence_join: str,
+        content_filter: str,
+        columns: Sequence[str],
+        exact: bool
+    ) -> str:
+        """Distance-ordered query behind stream_chunks, projecting columns."""
+        projection = ''.join(
+            f"\n            {self.STREAM_COLUMNS[column]}," for column in columns if column != 'repository'
+        )
+        content = "\n                c.content," if 'content' in columns else ""
+        # MATERIALIZED keeps the planner off the ANN index for exact streams
+        return f"""
+        WITH hits AS {'MATERIALIZED ' if exact else ''}(
+            SELECT
+                c.repository,
+                c.content_hash,{content}
+                c.quality_score,
+                {self._distance()} AS distance
+            FROM chunk_contents c
+            WHERE c.embedding IS NOT NULL{content_filter}
+            {'' if exact else f'ORDER BY {self._distance()}'}
+            {'' if exact else 'LIMIT %(limit)s'}
+        )
+        SELECT 
+            c.content_hash,
+            o.content_hash AS occurrence_hash,
+            c.repository,{projection}
+            c.distance,
+            1 - c.distance AS similarity_score
+        FROM (
+            SELECT * FROM hits
+            ORDER BY distance, content_hash, repository
+            LIMIT %(limit)s
+        ) c
+        {occurrence_join}
+        ORDER BY c.distance, c.content_hash, c.repository
+        """
+    
+    @staticmethod
+    def _cache_params(
+        top_k: int,
+        category_filter: str = None,
+        tags_filter: Optional[List[str]] = None,
+        language_filter: str = None,
+        search_mode: str = 'vector',
+        vector_weight: float = 1.0,
+        text_weight: float = 1.0,
+        mmr_lambda: Optional[float] = None,
+        repository_filter: str = None
+    ) -> tuple:
+        """Semantic cache key part: everything besides the query that shapes results."""
+        return (
+            ('category_filter', category_filter),
+            ('language_filter', language_filter),
+            ('mmr_lambda', mmr_lambda),
+            ('repository_filter', repository_filter),
+            ('search_mode', search_mode),
+            ('tags_filter', tuple(sorted(tags_filter)) if tags_filter else None),
+            ('text_weight', text_weight),
+            ('top_k', top_k),
+            ('vector_weight', vector_weight)
+        )
+    
+    @staticmethod
+    def _occurrence_filter(
+        params: Dict[str, Any],
+        category_filter: str = None,
+        tags_filter: Optional[List[str]] = None,
+        language_filter: str = None
+    ) -> str:
+        """SQL conditions on chunk_occurrences o; adds their values to params."""
+        occurrence_filter = ""
+        if category_filter:
+            occurrence_filter += " AND o.category = %(category)s"
+            params['category'] = category_filter
+        if tags_filter:
+            occurrence_filter += " AND o.tags && %(tags)s::text[]"
+            params['tags'] = list(tags_filter)
+        if language_filter:
+            occurrence_filter += " AND o.language = %(language)s"
+            params['language'] = language_filter
+        return occurrence_filter
+    
+    @staticmethod
+    def _partition_filter(params: Dict[str, Any], repository_filter: str = None, alias: str = 'c') -> str:
+        """Repository condition on chunk_contents; prunes the scan to one partition."""
+        if not repository_filter:
+            return ""
+        params['repository'] = repository_filter
+        return f" AND {alias}.repository = %(repository)s"
+    
+    def _snapshot(self) -> 'VectorSnapshot':
+        """Current snapshot, switching to a newer export when one was written."""
+        self.snapshot = self.snapshot.reload_if_changed()
+        return self.snapshot
+    
+    def _vector_search(
+        self,
+        params: Dict[str, Any],
+        occurrence_filter: str,
+        repository_filter: str = None
+    ) -> List[Dict[str, Any]]:
+        """ANN search that still returns a full top_k under metadata filters.
+        
+        pgvector applies WHERE clauses after the index probe, so a plain
+        filtered ANN query runs out of candidates. Selective filters are
+        searched exactly over the matching contents; broad filters use
+        iterative index scans (pgvector 0.8+) or, on older servers, retry
+        with a wider probe/ef_search budget. Anything still short of top_k
+        falls back to the exact search. A repository filter alone is not a
+        post-filter: it selects the partition whose own index is scanned.
+        """
+        occurrence_join = self.OCCURRENCE_JOIN.format(filters=occurrence_filter)
+        partition_filter = self._partition_filter(params, repository_filter)
+        if not occurrence_filter:
+            return self._fetch(
+                self._ann_sql(occurrence_join, partition_filter), params, self._search_settings(params['top_k'])
+            )
+        
+        content_filter = partition_filter + self.CONTENT_FILTER.format(filters=occurrence_filter)
+        exact_sql = self._exact_sql(occurrence_join, content_filter)
+        
+        count_filter = occurrence_filter + self._partition_filter(params, repository_filter, alias='o')
+        if self._filtered_content_count(count_filter, params) < self.exact_filter_limit:
+            return self._fetch(exact_sql, params)
+        
+        ann_sql = self._ann_sql(occurrence_join, content_filter)
+        results = self._filtered_ann(ann_sql, params, params['top_k'])
+        if len(results) < params['top_k']:
+            print(f"   ↪️  Filtered ANN returned {len(results)}/{params['top_k']}, using exact search")
+            results = self._fetch(exact_sql, params)
+        return results
+    
+    def _filtered_ann(self, sql: str, params: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+        """Run a post-filtered ANN query with iterative scans or widening budgets.
+        
+        limit sizes the index scan; callers fall back to exact search when
+        fewer than top_k rows come back.
+        """
+        if self.supports_iterative_scan:
+            settings = dict(self._search_settings(limit), **self.ITERATIVE_SCAN_SETTINGS)
+            return self._fetch(sql, params, settings)
+        results = []
+        for widen in (1, 4, 16):
+            results = self._fetch(sql, params, self._search_settings(limit, widen))
+            if len(results) >= params['top_k']:
+                break
+        return results
+    
+    def _batch_search(
+        self,
+        embeddings: List[List[float]],
+        params: Dict[str, Any],
+        occurrence_filter: str,
+        repository_filter: str = None
+    ) -> List[List[Dict[str, Any]]]:
+        """Batched counterpart of _vector_search: one result list per embedding.
+        
+        Filtered batches follow the same exact / widened ANN / exact fallback
+        path; only the queries left short of top_k are re-run exactly.
+        """
+        occurrence_join = self.OCCURRENCE_JOIN.format(filters=occurrence_filter)
+        content_filter = self._partition_filter(params, repository_filter)
+        
+        def run(sql, vectors, settings=None):
+            rows = self._fetch(sql, dict(params, embeddings=[self._vector_literal(v) for v in vectors]), settings)
+            grouped = [[] for _ in vectors]
+            for row in rows:
+                grouped[row.pop('query_index') - 1].append(row)
+            return grouped
+        
+        if not occurrence_filter:
+            return run(
+                self._batch_sql(occurrence_join, content_filter), embeddings, self._search_settings(params['top_k'])
+            )
+        
+        content_filter += self.CONTENT_FILTER.format(filters=occurrence_filter)
+        exact_sql = self._batch_sql(occurrence_join, content_filter, exact=True)
+        
+        count_filter = occurrence_filter + self._partition_filter(params, repository_filter, alias='o')
+        if self._filtered_content_count(count_filter, params) < self.exact_filter_limit:
+            return run(exact_sql, embeddings)
+        
+        ann_sql = self._batch_sql(occurrence_join, content_filter)
+        if self.supports_iterative_scan:
+            settings = dict(self._search_settings(params['top_k']), **self.ITERATIVE_SCAN_SETTINGS)
+            results = run(ann_sql, embeddings, settings)
+        else:
+            results = [[] for _ in embeddings]
+            short = list(range(len(embeddings)))
+            for widen in (1, 4, 16):
+                rerun = run(ann_sql, [embeddings[i] for i in short], self._search_settings(params['top_k'], widen))
+                for i, rows in zip(short, rerun):
+                    results[i] = rows
+                short = [i for i in short if len(results[i]) < params['top_k']]
+                if not short:
+                    break
+        
+        short = [i for i, rows in enumerate(results) if len(rows) < params['top_k']]
+        if short:
+            print(f"   ↪️  Filtered ANN left {len(short)}/{len(embeddings)} queries short, using exact search")
+            for i, rows in zip(short, run(exact_sql, [embeddings[i] for i in short])):
+                results[i] = rows
+        return results
+    
+    def _hybrid_search(
+        self,
+        query: str,
+        params: Dict[str, Any],
+        occurrence_filter: str,
+        vector_weight: float,
+        text_weight: float,
+        repository_filter: str = None
+    ) -> List[Dict[str, Any]]:
+        """Run the fused ANN + full-text query, honouring metadata filters.
+        
+        Filters take the _vector_search path: selective ones score every
+        matching content exactly, broad ones widen the ANN branch and fall
+        back to the exact branch when fewer than top_k results are fused.
+        """
+        params = dict(params, **{
+            'query': query,
+            'candidates': max(params['top_k'] * 4, 20),
+            'vector_weight': vector_weight,
+            'text_weight': text_weight,
+        })
+        content_filter = self._partition_filter(params, repository_filter)
+        occurrence_join = self.OCCURRENCE_JOIN.format(filters=occurrence_filter)
+        if not occurrence_filter:
+            return self._fetch(
+                self._hybrid_sql(occurrence_join, content_filter), params,
+                self._search_settings(params['candidates'])
+            )
+        
+        content_filter += self.CONTENT_FILTER.format(filters=occurrence_filter)
+        exact_sql = self._hybrid_sql(occurrence_join, content_filter, exact=True)
+        
+        count_filter = occurrence_filter + self._partition_filter(params, repository_filter, alias='o')
+        if self._filtered_content_count(count_filter, params) < self.exact_filter_limit:
+            return self._fetch(exact_sql, params)
+        
+        results = self._filtered_ann(self._hybrid_sql(occurrence_join, content_filter), params, params['candidates'])
+        if len(results) < params['top_k']:
+            print(f"   ↪️  Filtered hybrid search returned {len(results)}/{params['top_k']}, using exact search")
+            results = self._fetch(exact_sql, params)
+        return results
+    
+    def _text_search(
+        self,
+        query: str,
+        params: Dict[str, Any],
+        occurrence_filter: str,
+        repository_filter: Optional[str],
+        reason: str,
+        deadline: Optional[float],
+        started: float
+    ) -> List[Dict[str, Any]]:
+        """Degraded search: search_vector full-text ranking only, no embedding.
+        
+        similarity_score is the normalized ts_rank_cd (0-1), which is not on
+        the cosine scale; results are neither MMR-diversified nor cached.
+        """
+        trace = self.trace or QueryTrace()
+        trace.degraded = reason
+        print(f"   ⚠️  Degraded to full-text search: {reason}")
+        
+        budget = self.fallback_timeout_ms
+        if deadline is not None:
+            remaining_ms = (deadline - time.perf_counter()) * 1000
+            budget = min(budget, remaining_ms) if budget > 0 else remaining_ms
+        if budget > 0 or deadline is not None:
+            self.deadline = time.perf_counter() + max(budget, 1) / 1000
+        
+        params = dict(params, query=query)
+        content_filter = self._partition_filter(params, repository_filter)
+        if occurrence_filter:
+            content_filter += self.CONTENT_FILTER.format(filters=occurrence_filter)
+        occurrence_join = self.OCCURRENCE_JOIN.format(filters=occurrence_filter)
+        try:
+            with trace.span('fallback'):
+                results = self._fetch(self._text_sql(occurrence_join, content_filter), params)
+        except (psycopg2.extensions.QueryCanceledError, TimeoutError):
+            print("   ❌ Full-text fallback ran out of time too")
+            results = []
+        finally:
+            self.deadline = None
+        
+        print(f"   Found {len(results)} full-text results")
+        self._record_usage(query, results, started)
+        return results
+    
+    def _filtered_content_count(self, occurrence_filter: str, params: Dict[str, Any]) -> int:
+        """Count contents matching the filters, capped at the exact-search limit."""
+        cursor = self.conn.cursor()
+        with (self.trace or QueryTrace()).span('filter_count'):
+            cursor.execute(f"""
+                SELECT COUNT(*) FROM (
+                    SELECT DISTINCT o.repository, o.content_hash
+                    FROM chunk_occurrences o
+                    WHERE TRUE{occurrence_filter}
+                    LIMIT %(exact_limit)s
+                ) matching
+            """, dict(params, exact_limit=self.exact_filter_limit))
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+    
+    @staticmethod
+    def _vector_literal(embedding: List[float]) -> str:
+        """pgvector text form of an embedding, rendered once per query."""
+        return '[' + ','.join(f'{value:.9g}' for value in embedding) + ']'
+    
+    PARAM_PATTERN = re.compile(r'%\((\w+)\)s')
+    
+    def _execute_prepared(self, cursor, sql: str, params: Dict[str, Any]):
+        """Execute a search query through a server-side prepared statement.
+        
+        Named placeholders become positional $n parameters, so a value used
+        several times (the query vector) is sent and parsed once per call,
+        and each statement text is parsed and planned once per session.
+        psycopg2 has no binary parameter protocol, hence PREPARE/EXECUTE.
+        """
+        statement = self.prepared.get(sql)
+        if statement is None:
+            names = []
+            
+            def positional(match):
+                if match.group(1) not in names:
+                    names.append(match.group(1))
+                return f"${names.index(match.group(1)) + 1}"
+            
+            body = self.PARAM_PATTERN.sub(positional, sql).replace('%%', '%')
+            name = f"knowledge_search_{len(self.prepared) + 1}"
+            cursor.execute(f"PREPARE {name} AS {body}")
+            statement = self.prepared[sql] = (name, names)
+        
+        name, names = statement
+        placeholders = ', '.join(['%s'] * len(names))
+        cursor.execute(f"EXECUTE {name} ({placeholders})", [params[n] for n in names])
+    
+    def _fetch(
+        self,
+        sql: str,
+        params: Dict[str, Any],
+        settings: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """Execute a search query, scoping planner/index settings to it."""
+        trace = self.trace or QueryTrace()
+        trace.statement = (sql, params, settings)
+        if self.deadline is not None:
+            # The stage's remaining budget becomes this statement's timeout
+            remaining_ms = int((self.deadline - time.perf_counter()) * 1000)
+            if remaining_ms <= 0:
+                raise TimeoutError("Search stage budget exhausted")
+            settings = dict(settings or {}, statement_timeout=remaining_ms)
+        cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            if settings:
+                cursor.execute("BEGIN")
+                for name, value in settings.items():
+                    cursor.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+            # Round trip: planning, execution and transfer of the rows
+            with trace.span('sql'):
+                self._execute_prepared(cursor, sql, params)
+            with trace.span('decode'):
+                results = cursor.fetchall()
+            if settings:
+                cursor.execute("COMMIT")
+            return results
+        except Exception:
+            if settings:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+    
+    def _ann_sql(self, occurrence_join: str, content_filter: str) -> str:
+        """ANN over distinct contents, then one matching occurrence per content.
+        
+        distance is the indexed expression (halfvec on a halfvec index), so
+        the scan order, the re-sort and similarity_score all agree.
+        """
+        # relaxed_order iterative scans may return slightly out of order: re-sort
+        return f"""
+        WITH hits AS MATERIALIZED (
+            SELECT
+                c.repository,
+                c.content_hash,
+                c.content,
+                c.quality_score,
+                {self._distance()} AS distance
+            FROM chunk_contents c
+            WHERE c.embedding IS NOT NULL{content_filter}
+            ORDER BY distance
+            LIMIT %(top_k)s
+        )
+        SELECT 
+            COALESCE(o.linked_content, c.content) AS content,
+            c.content_hash,
+            o.id AS chunk_id,
+            o.file_path,
+            o.repository,
+            o.category,
+            o.tags,
+            o.language,
+            o.chunk_index,
+            o.char_start,
+            o.char_end,
+            c.quality_score,
+            1 - c.distance AS similarity_score
+        FROM hits c
+        {occurrence_join}
+        ORDER BY c.distance
+        """
+    
+    def _exact_sql(self, occurrence_join: str, content_filter: str) -> str:
+        """Exact search over the contents matching the filters.
+        
+        The materialized candidate set keeps the planner off the ANN index,
+        so every matching content is scored (100% recall).
+        """
+        return f"""
+        WITH candidates AS MATERIALIZED (
+            SELECT
+                c.repository,
+                c.content_hash,
+                c.content,
+                c.quality_score,
+                c.embedding <=> %(embedding)s::vector AS distance
+            FROM chunk_contents c
+            WHERE c.embedding IS NOT NULL{content_filter}
+        )
+        SELECT 
+            COALESCE(o.linked_content, c.content) AS content,
+            c.content_hash,
+            o.id AS chunk_id,
+            o.file_path,
+            o.repository,
+            o.category,
+            o.tags,
+            o.language,
+            o.chunk_index,
+            o.char_start,
+            o.char_end,
+            c.quality_score,
+            1 - c.distance AS similarity_score
+        FROM (
+            SELECT * FROM candidates
+            ORDER BY distance
+            LIMIT %(top_k)s
+        ) c
+        {occurrence_join}
+        ORDER BY c.distance
+        """
+    
+    def _batch_sql(self, occurrence_join: str, content_filter: str, exact: bool = False) -> str:
+        """One ANN subquery per query vector, all in a single statement.
+        
+        exact scores every query against the materialized filtered contents
+        instead of the ANN index.
+        """
+        if exact:
+            candidates = f""",
+        candidates AS MATERIALIZED (
+            SELECT c.repository, c.content_hash, c.content, c.quality_score, c.embedding
+            FROM chunk_contents c
+            WHERE c.embedding IS NOT NULL{content_filter}
+        )"""
+            source, distance = "candidates c", "c.embedding <=> q.embedding"
+        else:
+            candidates = ""
+            source = f"chunk_contents c\n            WHERE c.embedding IS NOT NULL{content_filter}"
+            distance = self._distance('q.embedding')
+        return f"""
+        WITH queries AS (
+            SELECT query_index, embedding::vector AS embedding
+            FROM unnest(%(embeddings)s::text[]) WITH ORDINALITY AS t(embedding, query_index)
+        ){candidates}
+        SELECT 
+            q.query_index,
+            COALESCE(o.linked_content, c.content) AS content,
+            c.content_hash,
+            o.id AS chunk_id,
+            o.file_path,
+            o.repository,
+            o.category,
+            o.tags,
+            o.language,
+            o.chunk_index,
+            o.char_start,
+            o.char_end,
+            c.quality_score,
+            1 - c.distance AS similarity_score
+        FROM queries q
+        CROSS JOIN LATERAL (
+            SELECT
+                c.repository,
+                c.content_hash,
+                c.content,
+                c.quality_score,
+                {distance} AS distance
+            FROM {source}
+            ORDER BY distance
+            LIMIT %(top_k)s
+        ) c
+        {occurrence_join}
+        ORDER BY q.query_index, c.distance
+        """
+    
+    def _hybrid_sql(self, occurrence_join: str, content_filter: str = "", exact: bool = False) -> str:
+        """Hybrid ANN + full-text query fused with reciprocal rank fusion.
+        
+        Each branch keeps its own index-friendly ORDER BY ... LIMIT; ranks are
+        numbered on the small candidate sets only. Query terms are OR-ed so a
+        single exact identifier (e.g. DifyChatButton) is enough to match.
+        exact scores the vector branch over the materialized filtered contents.
+        """
+        if exact:
+            vector_source = f"""vector_candidates AS MATERIALIZED (
+            SELECT c.repository, c.content_hash, c.embedding
+            FROM chunk_contents c
+            WHERE c.embedding IS NOT NULL{content_filter}
+        ),
+        """
+            vector_from, vector_order = "vector_candidates c, q", "distance"
+        else:
+            vector_source = ""
+            vector_from = f"chunk_contents c, q\n                WHERE c.embedding IS NOT NULL{content_filter}"
+            vector_order = self._distance('q.embedding')
+        return f"""
+        WITH q AS (
+            SELECT
+                %(embedding)s::vector AS embedding,
+                NULLIF(replace(plainto_tsquery('english', %(query)s)::text, '&', '|'), '')::tsquery AS terms
+        ),
+        {vector_source}vector_hits AS (
+            SELECT repository, content_hash, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+            FROM (
+                SELECT c.repository, c.content_hash, {self._distance('q.embedding')} AS distance
+                FROM {vector_from}
+                ORDER BY {vector_order}
+                LIMIT %(candidates)s
+            ) v
+        ),
+        text_hits AS (
+            SELECT repository, content_hash, ROW_NUMBER() OVER (ORDER BY text_rank DESC) AS rank
+            FROM (
+                SELECT c.repository, c.content_hash, ts_rank_cd(c.search_vector, q.terms) AS text_rank
+                FROM chunk_contents c, q
+                WHERE c.search_vector @@ q.terms
+                AND c.embedding IS NOT NULL{content_filter}
+                ORDER BY text_rank DESC
+                LIMIT %(candidates)s
+            ) t
+        ),
+        fused AS (
+            SELECT repository, content_hash, SUM(score) AS rrf_score
+            FROM (
+                SELECT repository, content_hash, %(vector_weight)s / (60.0 + rank) AS score FROM vector_hits
+                UNION ALL
+                SELECT repository, content_hash, %(text_weight)s / (60.0 + rank) AS score FROM text_hits
+            ) ranked
+            GROUP BY repository, content_hash
+        )
+        SELECT 
+            COALESCE(o.linked_content, c.content) AS content,
+            c.content_hash,
+            o.id AS chunk_id,
+            o.file_path,
+            o.repository,
+            o.category,
+            o.tags,
+            o.language,
+            o.chunk_index,
+            o.char_start,
+            o.char_end,
+            c.quality_score,
+            1 - (c.embedding <=> q.embedding) AS similarity_score,
+            f.rrf_score
+        FROM fused f
+        JOIN chunk_contents c ON c.repository = f.repository AND c.content_hash = f.content_hash
+        CROSS JOIN q
+        {occurrence_join}
+        ORDER BY f.rrf_score DESC
+        LIMIT %(top_k)s
+        """
+    
+    def _text_sql(self, occurrence_join: str, content_filter: str = "") -> str:
+        """Full-text-only query over search_vector, terms OR-ed as in hybrid mode.
+        
+        Linked near-duplicates are matched through their canonical content,
+        as in the vector queries, so a file is not listed twice.
+        """
+        # Normalization 32 maps ts_rank_cd to rank / (rank + 1), within 0-1
+        return f"""
+        WITH q AS (
+            SELECT NULLIF(replace(plainto_tsquery('english', %(query)s)::text, '&', '|'), '')::tsquery AS terms
+        ),
+        hits AS MATERIALIZED (
+            SELECT
+                c.repository,
+                c.content_hash,
+                c.content,
+                c.quality_score,
+                ts_rank_cd(c.search_vector, q.terms, 32) AS text_rank
+            FROM chunk_contents c, q
+            WHERE c.search_vector @@ q.terms
+            AND c.duplicate_of IS NULL{content_filter}
+            ORDER BY text_rank DESC
+            LIMIT %(top_k)s
+        )
+        SELECT 
+            COALESCE(o.linked_content, c.content) AS content,
+            c.content_hash,
+            o.id AS chunk_id,
+            o.file_path,
+            o.repository,
+            o.category,
+            o.tags,
+            o.language,
+            o.chunk_index,
+            o.char_start,
+            o.char_end,
+            c.quality_score,
+            c.text_rank AS similarity_score
+        FROM hits c
+        {occurrence_join}
+        ORDER BY c.text_rank DESC
+        """
+    
+    # Relations every search reads, loaded by pg_prewarm in this order; for
+    # partitioned tables and indexes every repository's partition is loaded
+    WARM_RELATIONS = (
+        'idx_embedding',
+        'chunk_contents',
+        'chunk_occurrences',
+        'idx_occurrence_content_hash',
+        'idx_search_vector',
+    )
+    
+    def warm_up(
+        self,
+        recent_queries: int = 200,
+        probes: int = 20,
+        prewarm: bool = True,
+        search_mode: str = 'vector'
+    ) -> Dict[str, Any]:
+        """
+        Bring a cold server and a fresh instance up to steady-state latency.
+        
+        1. pg_prewarm loads the ANN index and the tables and indexes every
+           search reads into shared buffers (skipped without the extension)
+        2. the latest distinct questions in query_logs are embedded in
+           batched requests, filling the query-embedding cache
+        3. up to probes of them run as searches in search_mode, preparing
+           this session's statements and touching the index pages on real
+           query paths; stored chunk embeddings stand in when there are no
+           logged queries
+        
+        Probe searches are not logged. Returns what was warmed.
+        """
+        started = time.perf_counter()
+        self.trace = None
+        cursor = self.conn.cursor()
+        
+        prewarmed = None
+        if prewarm:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'")
+            if cursor.fetchone():
+                prewarmed = 0
+                for relation in self.WARM_RELATIONS:
+                    cursor.execute("""
+                        SELECT COALESCE(SUM(pg_prewarm(relid)), 0)
+                        FROM pg_partition_tree(to_regclass(%s))
+                        WHERE isleaf
+                    """, (relation,))
+                    prewarmed += cursor.fetchone()[0]
+            else:
+                print("⚠️  pg_prewarm is not installed, warming with probe queries only")
+        
+        queries = []
+        if recent_queries:
+            cursor.execute("""
+                SELECT query_text
+                FROM query_logs
+                WHERE query_type = 'search'
+                GROUP BY query_text
+                ORDER BY MAX(created_at) DESC
+                LIMIT %s
+            """, (recent_queries,))
+            queries = [row[0] for row in cursor.fetchall()]
+        embeddings = self.generate_query_embeddings(queries) if queries else []
+        
+        probe_set = [(q, e) for q, e in zip(queries, embeddings) if e is not None][:probes]
+        if not probe_set and probes:
+            cursor.execute(
+                "SELECT embedding::text FROM chunk_contents WHERE embedding IS NOT NULL LIMIT %s",
+                (probes,)
+            )
+            probe_set = [(None, row[0]) for row in cursor.fetchall()]
+        cursor.close()
+        
+        for query, embedding in probe_set:
+            literal = embedding if isinstance(embedding, str) else self._vector_literal(embedding)
+            params = {'embedding': literal, 'top_k': 10}
+            if search_mode == 'hybrid' and query:
+                self._hybrid_search(query, params, "", 1.0, 1.0)
+            else:
+                self._vector_search(params, "")
+        
+        stats = {
+            'prewarmed_blocks': prewarmed,
+            'cached_queries': sum(1 for e in embeddings if e is not None),
+            'probes': len(probe_set),
+            'seconds': round(time.perf_counter() - started, 2),
+        }
+        print(f"🔥 Warm-up: {stats['prewarmed_blocks'] if prewarmed is not None else 'no'} blocks prewarmed, "
+              f"{stats['cached_queries']} query embeddings cached, {stats['probes']} probe searches "
+              f"in {stats['seconds']:.1f}s")
+        return stats
+    
+    def close(self):
+        """Flush pending query logs and close database connection."""
+        if self.usage_recorder:
+            self.usage_recorder.close()
+        if self.embedding_executor:
+            self.embedding_executor.shutdown(wait=False)
+        if self.conn:
+            self.conn.close()
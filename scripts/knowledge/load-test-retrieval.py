@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+Knowledge Portal - Retrieval Load Test
+======================================
+Replays queries against KnowledgeRetrieval at a configurable concurrency
+and arrival rate, to find the load at which search latency degrades.
+
+Query sources (--source):
+- logs       search queries recorded in query_logs, in recorded order
+- synthetic  word windows sampled from stored chunk contents
+- file       one query per line (--queries-file)
+
+Load models:
+- closed loop (default): each worker sends its next query as soon as the
+  previous one returns, so throughput is whatever the workers sustain
+- open loop (--rate): queries arrive as a Poisson process at RATE per
+  second regardless of latency; latency is measured from the arrival, so
+  a saturated pool shows up as queueing delay rather than a lower rate
+
+Each worker is a KnowledgeRetrieval with its own PostgreSQL connection,
+like the retrieval service's pool. --stub-embeddings replaces the Azure
+OpenAI client with deterministic vectors (optionally delayed), so only the
+database layer is measured. --batch-window-ms makes the workers share one
+client through an EmbeddingBatcher, as in the retrieval service, to
+compare throughput and API requests with and without coalescing. Searches
+are not written to query_logs.
+
+Usage:
+    python load-test-retrieval.py --concurrency 1,4,16 --duration 60
+    python load-test-retrieval.py --stub-embeddings --rate 50 --concurrency 8 --output load.json
+"""
+
+import io
+import os
+import sys
+import math
+import json
+import time
+import queue
+import random
+import hashlib
+import argparse
+import threading
+import contextlib
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional, Iterator
+import psycopg2
+from openai import AzureOpenAI
+from knowledge_retrieval import KnowledgeRetrieval, EmbeddingBatcher
+
+
+class StubEmbeddings:
+    """Stand-in for the Azure OpenAI client's embeddings API.
+
+    Returns a unit vector derived from each input's hash, so a query always
+    maps to the same point and the query embedding cache behaves as with
+    real embeddings. latency_ms emulates the API round trip per request.
+    """
+
+    def __init__(self, dimensions: int, latency_ms: float = 0.0):
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+        self.embeddings = self
+        self.requests = 0
+
+    def vector(self, text: str) -> List[float]:
+        rnd = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+        values = [rnd.gauss(0.0, 1.0) for _ in range(self.dimensions)]
+        norm = math.sqrt(sum(v * v for v in values)) or 1.0
+        return [v / norm for v in values]
+
+    def create(self, model: str, input, dimensions: Optional[int] = None, **kwargs):
+        self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        inputs = [input] if isinstance(input, str) else list(input)
+        return SimpleNamespace(data=[
+            SimpleNamespace(index=i, embedding=self.vector(text)) for i, text in enumerate(inputs)
+        ])
+
+
+class LatencyHistogram:
+    """Latencies of one run, with log-spaced buckets for display."""
+
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.values: List[float] = []
+
+    def add(self, value_ms: float):
+        self.values.append(value_ms)
+
+    def percentile(self, p: float) -> float:
+        """Nearest-rank percentile."""
+        if not self.values:
+            return 0.0
+        ordered = sorted(self.values)
+        return ordered[max(math.ceil(p / 100 * len(ordered)), 1) - 1]
+
+    def summary(self) -> Dict[str, float]:
+        if not self.values:
+            return {}
+        return {
+            'mean': round(sum(self.values) / len(self.values), 2),
+            **{f'p{p}': round(self.percentile(p), 2) for p in (50, 90, 95, 99)},
+            'max': round(max(self.values), 2),
+        }
+
+    def buckets(self) -> List[Dict[str, Any]]:
+        """Count per bucket, '<= bound' ms; the last bucket is unbounded."""
+        counts = [0] * (len(self.BOUNDS_MS) + 1)
+        for value in self.values:
+            i = 0
+            while i < len(self.BOUNDS_MS) and value > self.BOUNDS_MS[i]:
+                i += 1
+            counts[i] += 1
+        labels = [f'<={bound}' for bound in self.BOUNDS_MS] + [f'>{self.BOUNDS_MS[-1]}']
+        return [{'le_ms': label, 'count': count} for label, count in zip(labels, counts)]
+
+    def render(self, width: int = 50) -> str:
+        buckets = self.buckets()
+        # Trim empty buckets at both ends
+        filled = [i for i, b in enumerate(buckets) if b['count']]
+        if not filled:
+            return "   (no samples)"
+        peak = max(b['count'] for b in buckets)
+        lines = []
+        for b in buckets[filled[0]:filled[-1] + 1]:
+            bar = '█' * max(round(b['count'] / peak * width), 1 if b['count'] else 0)
+            lines.append(f"   {b['le_ms']:>8} ms {b['count']:>8}  {bar}")
+        return '\n'.join(lines)
+
+
+class LoadGenerator:
+    """Drives a pool of KnowledgeRetrieval workers with a query stream."""
+
+    def __init__(
+        self,
+        queries: List[str],
+        search_args: Dict[str, Any],
+        openai_client=None,
+        report_interval: float = 5.0,
+        seed: int = 0,
+        drain_seconds: float = 10.0
+    ):
+        if not queries:
+            raise ValueError("No queries to replay")
+        self.queries = queries
+        self.search_args = search_args
+        self.openai_client = openai_client
+        self.report_interval = report_interval
+        # Open loop: arrivals still queued this long after the run are dropped
+        self.drain_seconds = drain_seconds
+        self.random = random.Random(seed)
+        self.workers = []
+        # Progress lines go to the real stdout; search chatter is discarded
+        self.out = sys.stdout
+
+    def _new_worker(self) -> KnowledgeRetrieval:
+        return KnowledgeRetrieval(openai_client=self.openai_client)
+
+    def prepare(self, concurrency: int, warm_up: bool = True):
+        """Open (and warm) workers up to concurrency; reused across runs."""
+        while len(self.workers) < concurrency:
+            worker = self._new_worker()
+            if warm_up:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    worker.warm_up(recent_queries=0, probes=5, prewarm=not self.workers)
+            self.workers.append(worker)
+
+    def _query_stream(self) -> Iterator[str]:
+        """Queries in replay order, starting over when exhausted."""
+        while True:
+            yield from self.queries
+
+    def run(
+        self,
+        concurrency: int,
+        duration: float,
+        rate: Optional[float] = None,
+        max_requests: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """One load level; returns its report."""
+        self.prepare(concurrency)
+        stream = self._query_stream()
+        stream_lock = threading.Lock()
+        results_lock = threading.Lock()
+        arrivals: queue.Queue = queue.Queue()
+        latency, wait = LatencyHistogram(), LatencyHistogram()
+        stages: Dict[str, LatencyHistogram] = {}
+        errors: Dict[str, int] = {}
+        counters = {'sent': 0, 'completed': 0, 'empty': 0, 'degraded': 0, 'dropped': 0}
+        window = []  # (finished_at, latency_ms, ok) since the last progress line
+
+        started = time.perf_counter()
+        deadline = started + duration
+        stop = threading.Event()
+
+        def next_closed_loop() -> Optional[tuple]:
+            with stream_lock:
+                now = time.perf_counter()
+                if stop.is_set() or now >= deadline or (max_requests and counters['sent'] >= max_requests):
+                    return None
+                counters['sent'] += 1
+                return now, next(stream)
+
+        def dispatch():
+            """Poisson arrivals into the queue; workers pick them up when free."""
+            arrival = started
+            sent = 0
+            while not stop.is_set():
+                arrival += self.random.expovariate(rate)
+                if arrival >= deadline or (max_requests and sent >= max_requests):
+                    break
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    stop.wait(delay)
+                arrivals.put((arrival, next(stream)))
+                sent += 1
+            for _ in range(concurrency):
+                arrivals.put(None)
+
+        def work(worker_index: int):
+            take = arrivals.get if rate else next_closed_loop
+            while True:
+                item = take()
+                if item is None:
+                    return
+                arrived_at, query = item
+                begun = time.perf_counter()
+                if begun > deadline + self.drain_seconds:
+                    with results_lock:
+                        counters['dropped'] += 1
+                    continue
+                worker = self.workers[worker_index]
+                ok, error, timings, found, degraded = True, None, {}, 0, False
+                try:
+                    results = worker.search_chunks(query=query, score_threshold=0.0, **self.search_args)
+                    found = len(results)
+                    timings = worker.trace.timings() if worker.trace else {}
+                    degraded = bool(worker.trace and worker.trace.degraded)
+                except Exception as e:
+                    ok, error = False, type(e).__name__
+                    if worker.conn.closed:
+                        self.workers[worker_index] = self._new_worker()
+                finished = time.perf_counter()
+                with results_lock:
+                    latency.add((finished - arrived_at) * 1000)
+                    wait.add((begun - arrived_at) * 1000)
+                    window.append((finished, (finished - arrived_at) * 1000, ok))
+                    if ok:
+                        counters['completed'] += 1
+                        counters['empty'] += 0 if found else 1
+                        counters['degraded'] += 1 if degraded else 0
+                        for stage, ms in timings.items():
+                            stages.setdefault(stage, LatencyHistogram()).add(ms)
+                    else:
+                        errors[error] = errors.get(error, 0) + 1
+
+        def progress():
+            """One line per interval: rate, p95 and errors of that interval."""
+            last = started
+            while not stop.wait(self.report_interval):
+                now = time.perf_counter()
+                with results_lock:
+                    recent = window[:]
+                    window.clear()
+                if not recent:
+                    continue
+                interval = LatencyHistogram()
+                for _, ms, _ in recent:
+                    interval.add(ms)
+                failed = sum(1 for _, _, ok in recent if not ok)
+                print(f"   t={now - started:6.1f}s  {len(recent) / (now - last):7.1f} req/s  "
+                      f"p50={interval.percentile(50):7.1f}ms  p95={interval.percentile(95):7.1f}ms  "
+                      f"errors={failed}", file=self.out, flush=True)
+                last = now
+
+        mode = f"open loop, {rate:g} req/s" if rate else "closed loop"
+        print(f"\n🚦 {concurrency} workers, {mode}, {duration:g}s"
+              + (f", max {max_requests} requests" if max_requests else ""), file=self.out, flush=True)
+
+        threads = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(concurrency)]
+        if rate:
+            threads.append(threading.Thread(target=dispatch, daemon=True))
+        reporter = threading.Thread(target=progress, daemon=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            reporter.start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            stop.set()
+            reporter.join()
+        elapsed = time.perf_counter() - started
+
+        failed = sum(errors.values())
+        finished = counters['completed'] + failed
+        report = {
+            'concurrency': concurrency,
+            'mode': 'open' if rate else 'closed',
+            'target_rate': rate,
+            'seconds': round(elapsed, 2),
+            'requests': finished,
+            'completed': counters['completed'],
+            'empty_results': counters['empty'],
+            'degraded': counters['degraded'],
+            'errors': failed,
+            'error_rate': round(failed / finished, 4) if finished else 0.0,
+            'errors_by_type': errors,
+            'dropped': counters['dropped'],
+            'throughput_rps': round(counters['completed'] / elapsed, 2) if elapsed else 0.0,
+            'latency_ms': latency.summary(),
+            'queue_wait_ms': wait.summary() if rate else {},
+            'stage_ms': {stage: histogram.summary() for stage, histogram in sorted(stages.items())},
+            'histogram': latency.buckets(),
+        }
+        self._print_report(report, latency)
+        return report
+
+    def _print_report(self, report: Dict[str, Any], latency: LatencyHistogram):
+        out = self.out
+        lat = report['latency_ms']
+        print(f"\n📊 {report['requests']} requests in {report['seconds']:.1f}s: "
+              f"{report['throughput_rps']:.1f} req/s, {report['errors']} errors "
+              f"({report['error_rate']:.2%})", file=out)
+        if lat:
+            print(f"   Latency ms: mean={lat['mean']:.1f} p50={lat['p50']:.1f} p90={lat['p90']:.1f} "
+                  f"p95={lat['p95']:.1f} p99={lat['p99']:.1f} max={lat['max']:.1f}", file=out)
+        if report['queue_wait_ms']:
+            print(f"   Queue wait ms: p50={report['queue_wait_ms']['p50']:.1f} "
+                  f"p95={report['queue_wait_ms']['p95']:.1f}", file=out)
+        for stage, summary in report['stage_ms'].items():
+            print(f"   {stage:<13} p50={summary['p50']:.1f} p95={summary['p95']:.1f} "
+                  f"p99={summary['p99']:.1f}", file=out)
+        for name, count in sorted(report['errors_by_type'].items()):
+            print(f"   ❌ {name}: {count}", file=out)
+        if report['degraded']:
+            print(f"   ⚠️  {report['degraded']} searches degraded to full-text only", file=out)
+        if report['dropped']:
+            print(f"   ⚠️  {report['dropped']} arrivals still queued {self.drain_seconds:g}s after the run "
+                  f"were dropped: the pool is saturated at this rate", file=out)
+        print(latency.render(), file=out, flush=True)
+
+    def close(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for worker in self.workers:
+                worker.close()
+        self.workers = []
+
+
+def print_summary(reports: List[Dict[str, Any]]):
+    """One row per load level."""
+    print("\n" + "=" * 100)
+    print(f"{'Workers':>8} {'Mode':>7} {'Req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'Max ms':>9} {'Errors':>8} {'Requests':>9}")
+    print("-" * 100)
+    for r in reports:
+        lat = r['latency_ms'] or {'p50': 0, 'p95': 0, 'p99': 0, 'max': 0}
+        print(f"{r['concurrency']:>8} {r['mode']:>7} {r['throughput_rps']:>9.1f} {lat['p50']:>9.1f} "
+              f"{lat['p95']:>9.1f} {lat['p99']:>9.1f} {lat['max']:>9.1f} {r['error_rate']:>8.2%} "
+              f"{r['requests']:>9}")
+    print("=" * 100)
+
+
+def load_queries(conn, source: str, limit: int, path: Optional[str] = None, seed: int = 0) -> List[str]:
+    """Queries to replay from query_logs, stored contents or a file."""
+    if source == 'file':
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()][:limit]
+
+    cursor = conn.cursor()
+    if source == 'logs':
+        cursor.execute("""
+            SELECT query_text FROM (
+                SELECT query_text, created_at
+                FROM query_logs
+                WHERE query_type = 'search' AND query_text IS NOT NULL
+                ORDER BY created_at DESC
+                LIMIT %s
+            ) recent
+            ORDER BY created_at
+        """, (limit,))
+        queries = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return queries
+
+    # synthetic: a 4-10 word window of a random stored chunk
+    cursor.execute("""
+        SELECT content FROM chunk_contents
+        WHERE embedding IS NOT NULL
+        ORDER BY random()
+        LIMIT %s
+    """, (limit,))
+    rnd = random.Random(seed)
+    queries = []
+    for (content,) in cursor.fetchall():
+        words = content.split()
+        if not words:
+            continue
+        size = rnd.randint(4, 10)
+        start = rnd.randrange(max(len(words) - size, 0) + 1)
+        queries.append(' '.join(words[start:start + size]))
+    cursor.close()
+    return queries
+
+
+def embedding_dimensions(conn) -> int:
+    """Dimensions the stub embedder must produce."""
+    if os.getenv('EMBEDDING_DIMENSIONS'):
+        return int(os.getenv('EMBEDDING_DIMENSIONS'))
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = 'chunk_contents'::regclass AND attname = 'embedding'
+    """)
+    dimensions = cursor.fetchone()[0]
+    cursor.close()
+    return dimensions
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Load test knowledge base retrieval')
+    parser.add_argument('--concurrency', default='4',
+                        help='Workers per run; a list like 1,2,4,8 runs one level after another')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per load level')
+    parser.add_argument('--requests', type=int, help='Stop a level after this many requests')
+    parser.add_argument('--rate', type=float, help='Open loop: Poisson arrivals per second')
+    parser.add_argument('--source', choices=['logs', 'synthetic', 'file'], default='logs',
+                        help='Where queries come from (default: logs, synthetic when none are logged)')
+    parser.add_argument('--queries-file', help='Queries for --source file, one per line')
+    parser.add_argument('--max-queries', type=int, default=1000, help='Distinct queries to load')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--mode', choices=['vector', 'hybrid'], default='vector')
+    parser.add_argument('--repository', help='Repository filter for every search')
+    parser.add_argument('--deadline-ms', type=float,
+                        help='Per-search deadline; searches that would exceed it degrade to full-text')
+    parser.add_argument('--stub-embeddings', action='store_true',
+                        help='Deterministic local vectors instead of Azure OpenAI')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0,
+                        help='Simulated embedding API latency of the stub')
+    parser.add_argument('--batch-window-ms', type=float, default=0.0,
+                        help='Coalesce concurrent query embeddings within this window (0: off)')
+    parser.add_argument('--drain-seconds', type=float, default=10.0,
+                        help='Open loop: serve queued arrivals this long after the run, drop the rest')
+    parser.add_argument('--report-interval', type=float, default=5.0, help='Seconds between progress lines')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the reports as JSON')
+    args = parser.parse_args()
+
+    if args.source == 'file' and not args.queries_file:
+        parser.error('--source file requires --queries-file')
+
+    print("\n🚀 Starting Knowledge Base Retrieval Load Test\n")
+
+    required_vars = ['POSTGRES_HOST', 'POSTGRES_USER', 'POSTGRES_PASSWORD']
+    if not args.stub_embeddings:
+        required_vars += ['AZURE_OPENAI_API_KEY', 'AZURE_OPENAI_ENDPOINT']
+    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    if missing_vars:
+        print(f"❌ Missing environment variables: {', '.join(missing_vars)}")
+        sys.exit(1)
+
+    # Load test traffic must not skew query analytics or usage counters
+    os.environ['QUERY_LOGGING'] = 'false'
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    conn = psycopg2.connect(
+        host=os.getenv('POSTGRES_HOST'),
+        port=int(os.getenv('POSTGRES_PORT', '5432')),
+        database=os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD')
+    )
+    try:
+        queries = load_queries(conn, args.source, args.max_queries, args.queries_file, args.seed)
+        if not queries and args.source == 'logs':
+            print("⚠️  No logged search queries, using synthetic queries")
+            queries = load_queries(conn, 'synthetic', args.max_queries, seed=args.seed)
+        client = None
+        if args.stub_embeddings:
+            client = StubEmbeddings(embedding_dimensions(conn), args.stub_latency_ms)
+    finally:
+        conn.close()
+
+    print(f"📋 {len(queries)} queries from {args.source}, "
+          f"embeddings: {'stub' if client else 'Azure OpenAI'}, mode={args.mode}, top_k={args.top_k}")
+
+    batcher = None
+    if args.batch_window_ms > 0:
+        if client is None:
+            client = AzureOpenAI(
+                api_key=os.getenv('AZURE_OPENAI_API_KEY'),
+                azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
+                api_version='2024-02-01'
+            )
+        client = batcher = EmbeddingBatcher(client, args.batch_window_ms)
+
+    search_args = {'top_k': args.top_k, 'search_mode': args.mode}
+    if args.repository:
+        search_args['repository_filter'] = args.repository
+    if args.deadline_ms:
+        search_args['deadline_ms'] = args.deadline_ms
+
+    generator = LoadGenerator(queries, search_args, client, args.report_interval, args.seed, args.drain_seconds)
+    reports = []
+    try:
+        for level in levels:
+            reports.append(generator.run(level, args.duration, args.rate, args.requests))
+    finally:
+        generator.close()
+
+    if batcher:
+        print(f"\n📦 Embedding batches: {batcher.summary()}")
+
+    if len(reports) > 1:
+        print_summary(reports)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'queries': len(queries), 'source': args.source, 'search': search_args,
+                       'reports': reports}, f, indent=2)
+        print(f"\n💾 Report written to {args.output}")
+
+    print("\n✅ Load test completed\n")
+
+
+if __name__ == "__main__":
+    main()
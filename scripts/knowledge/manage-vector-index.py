@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Knowledge Portal - Vector Index Management
+==========================================
+Builds and tunes the ANN index on chunk_contents.embedding
+
+Features:
+- HNSW or ivfflat, with lists/m/ef_construction sized from the row count
+  of the largest repository partition (each partition has its own graph)
+- Concurrent rebuilds (searches keep working during the build), one
+  partition at a time, or of a single repository's partition
+- halfvec expression index when the column exceeds 2000 dimensions
+- Calibration of ivfflat.probes / hnsw.ef_search against exact search
+  for a recall target and latency budget
+
+The chosen build and search settings are stored as JSON in the index
+comment; KnowledgeRetrieval reads them and applies them per query.
+"""
+
+import os
+import json
+import time
+import argparse
+from typing import Dict, List, Optional, Any
+import psycopg2
+
+
+INDEX_NAME = 'idx_embedding'
+BUILD_NAME = 'idx_embedding_rebuild'
+
+# pgvector indexes vector columns up to 2000 dimensions and halfvec up to 4000
+MAX_VECTOR_INDEX_DIMENSIONS = 2000
+MAX_HALFVEC_INDEX_DIMENSIONS = 4000
+
+
+class VectorIndexManager:
+    """Creates, rebuilds and calibrates the embedding ANN index"""
+
+    def __init__(self):
+        self.conn = psycopg2.connect(
+            host=os.getenv('POSTGRES_HOST'),
+            port=os.getenv('POSTGRES_PORT', '5432'),
+            database=os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
+            user=os.getenv('POSTGRES_USER'),
+            password=os.getenv('POSTGRES_PASSWORD')
+        )
+        # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+
+    # ------------------------------------------------------------------
+    # Inspection
+    # ------------------------------------------------------------------
+
+    def row_count(self) -> int:
+        """Number of contents carrying an embedding."""
+        self.cursor.execute("SELECT COUNT(*) FROM chunk_contents WHERE embedding IS NOT NULL")
+        return self.cursor.fetchone()[0]
+
+    def partition_rows(self) -> Dict[str, int]:
+        """Contents carrying an embedding, per repository partition."""
+        self.cursor.execute("""
+            SELECT repository, COUNT(*) FROM chunk_contents
+            WHERE embedding IS NOT NULL
+            GROUP BY repository
+        """)
+        return dict(self.cursor.fetchall())
+
+    def dimensions(self) -> int:
+        """Declared dimensions of chunk_contents.embedding."""
+        self.cursor.execute("""
+            SELECT atttypmod FROM pg_attribute
+            WHERE attrelid = 'chunk_contents'::regclass AND attname = 'embedding'
+        """)
+        return self.cursor.fetchone()[0]
+
+    def current_index(self) -> Optional[Dict[str, Any]]:
+        """Definition and stored settings of the live index, None when missing."""
+        self.cursor.execute("""
+            SELECT indexdef, obj_description(indexname::text::regclass, 'pg_class')
+            FROM pg_indexes
+            WHERE tablename = 'chunk_contents' AND indexname = %s
+        """, (INDEX_NAME,))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        indexdef, comment = row
+        try:
+            settings = json.loads(comment) if comment else {}
+        except ValueError:
+            settings = {}
+        settings['definition'] = indexdef
+        settings.setdefault('method', 'hnsw' if 'USING hnsw' in indexdef else 'ivfflat')
+        return settings
+
+    # ------------------------------------------------------------------
+    # Sizing
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def recommend_build(method: str, rows: int) -> Dict[str, int]:
+        """Build parameters for the corpus size (pgvector guidance)."""
+        if method == 'ivfflat':
+            # rows / 1000 up to 1M rows, sqrt(rows) beyond
+            if rows <= 1_000_000:
+                lists = max(rows // 1000, 10)
+            else:
+                lists = int(rows ** 0.5)
+            return {'lists': lists}
+
+        if rows <= 100_000:
+            return {'m': 16, 'ef_construction': 64}
+        if rows <= 1_000_000:
+            return {'m': 16, 'ef_construction': 128}
+        return {'m': 24, 'ef_construction': 200}
+
+    @staticmethod
+    def index_target(dimensions: int) -> Dict[str, str]:
+        """Indexed expression and opclass; halfvec above the vector limit."""
+        if dimensions <= MAX_VECTOR_INDEX_DIMENSIONS:
+            return {'expression': 'embedding', 'opclass': 'vector_cosine_ops', 'halfvec': None}
+        if dimensions <= MAX_HALFVEC_INDEX_DIMENSIONS:
+            return {
+                'expression': f'(embedding::halfvec({dimensions}))',
+                'opclass': 'halfvec_cosine_ops',
+                'halfvec': dimensions,
+            }
+        raise ValueError(f"{dimensions} dimensions exceed the pgvector index limit")
+
+    # ------------------------------------------------------------------
+    # Build
+    # ------------------------------------------------------------------
+
+    def leaf_partitions(self) -> List[str]:
+        """Partitions of chunk_contents, one per repository."""
+        self.cursor.execute("""
+            SELECT relid::regclass::text FROM pg_partition_tree('chunk_contents')
+            WHERE isleaf ORDER BY 1
+        """)
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def _set_build_memory(self):
+        self.cursor.execute(
+            "SELECT set_config('maintenance_work_mem', %s, false)",
+            (os.getenv('INDEX_BUILD_MEMORY', '1GB'),)
+        )
+        self.cursor.execute(
+            "SELECT set_config('max_parallel_maintenance_workers', %s, false)",
+            (str(int(os.getenv('INDEX_BUILD_WORKERS', '2'))),)
+        )
+
+    def build(self, method: str, concurrently: bool = True) -> Dict[str, Any]:
+        """(Re)build the index under a temporary name, then swap it in.
+
+        chunk_contents is partitioned and CREATE INDEX CONCURRENTLY does not
+        recurse, so a concurrent build creates the new parent index ON ONLY
+        the partitioned table, builds each partition's index concurrently
+        and attaches it; the parent becomes valid with the last partition.
+        """
+        rows = self.row_count()
+        largest = max(self.partition_rows().values(), default=0)
+        dimensions = self.dimensions()
+        params = self.recommend_build(method, largest)
+        target = self.index_target(dimensions)
+        partitions = self.leaf_partitions()
+
+        print(f"\n🏗️  Building {method} index: {rows} vectors in {len(partitions)} partitions "
+              f"(largest {largest}), {dimensions} dimensions")
+        print(f"   Parameters: {params}" + (" (halfvec)" if target['halfvec'] else ""))
+
+        using = (
+            f"USING {method} ({target['expression']} {target['opclass']}) "
+            f"WITH ({', '.join(f'{name} = {value}' for name, value in params.items())})"
+        )
+
+        # Leftovers of an interrupted build are INVALID or unattached: drop them
+        self.cursor.execute(f"DROP INDEX IF EXISTS {BUILD_NAME}")
+        self.cursor.execute(
+            "SELECT indexname FROM pg_indexes WHERE indexname LIKE %s", (f"{BUILD_NAME}\\_%",)
+        )
+        for (leftover,) in self.cursor.fetchall():
+            self.cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {leftover}")
+
+        self._set_build_memory()
+
+        start = time.time()
+        if concurrently:
+            self.cursor.execute(f"CREATE INDEX {BUILD_NAME} ON ONLY chunk_contents {using}")
+            for i, partition in enumerate(partitions, 1):
+                child = f"{BUILD_NAME}_{i}"
+                self.cursor.execute(f"CREATE INDEX CONCURRENTLY {child} ON {partition} {using}")
+                self.cursor.execute(f"ALTER INDEX {BUILD_NAME} ATTACH PARTITION {child}")
+                print(f"   ✓ {partition}")
+        else:
+            self.cursor.execute(f"CREATE INDEX {BUILD_NAME} ON chunk_contents {using}")
+        print(f"   ✓ Built in {time.time() - start:.1f}s")
+
+        # Swap in one transaction so searches never run without an index.
+        # A partitioned index cannot be dropped concurrently; the drop itself is quick
+        settings = {'method': method, 'rows': largest, 'halfvec': target['halfvec'], **params}
+        self.cursor.execute("BEGIN")
+        try:
+            self.cursor.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+            self.cursor.execute(f"ALTER INDEX {BUILD_NAME} RENAME TO {INDEX_NAME}")
+            if concurrently:
+                for i in range(1, len(partitions) + 1):
+                    self.cursor.execute(f"ALTER INDEX {BUILD_NAME}_{i} RENAME TO {INDEX_NAME}_{i}")
+            self.save_settings(settings)
+        except Exception:
+            self.cursor.execute("ROLLBACK")
+            raise
+        self.cursor.execute("COMMIT")
+        return settings
+
+    def rebuild_repository(self, repository: str):
+        """Rebuild one repository's partition of the index concurrently.
+
+        Keeps the build parameters of the live index, e.g. after bulk
+        loading a single repository; other partitions are not touched.
+        """
+        self.cursor.execute("""
+            SELECT t.relid::regclass::text
+            FROM pg_partition_tree(%s::regclass) t
+            JOIN pg_index i ON i.indexrelid = t.relid
+            WHERE t.isleaf
+            AND i.indrelid = to_regclass('chunk_contents_' || repository_partition_suffix(%s))
+        """, (INDEX_NAME, repository))
+        row = self.cursor.fetchone()
+        if not row:
+            raise ValueError(f"No {INDEX_NAME} partition for repository {repository}")
+
+        print(f"\n🏗️  Rebuilding {row[0]} ({repository})")
+        self._set_build_memory()
+        start = time.time()
+        self.cursor.execute(f"REINDEX INDEX CONCURRENTLY {row[0]}")
+        print(f"   ✓ Rebuilt in {time.time() - start:.1f}s")
+
+    def needs_rebuild(self, method: str, growth: float) -> Optional[str]:
+        """Reason to rebuild, None when the live index still fits the corpus."""
+        current = self.current_index()
+        if current is None:
+            return "index missing"
+        if current['method'] != method:
+            return f"method changes from {current['method']} to {method}"
+        if 'rows' not in current:
+            return "index was not built by this tool"
+
+        rows = max(self.partition_rows().values(), default=0)
+        built_rows = max(current['rows'], 1)
+        if rows >= built_rows * growth or rows * growth <= built_rows:
+            return f"largest partition changed from {current['rows']} to {rows} vectors"
+        return None
+
+    def save_settings(self, settings: Dict[str, Any]):
+        """Persist build/search settings in the index comment."""
+        self.cursor.execute(
+            f"COMMENT ON INDEX {INDEX_NAME} IS %s", (json.dumps(settings, sort_keys=True),)
+        )
+
+    # ------------------------------------------------------------------
+    # Search tuning
+    # ------------------------------------------------------------------
+
+    def calibrate(
+        self,
+        recall_target: float,
+        latency_ms: float,
+        samples: int = 50,
+        top_k: int = 5
+    ) -> Optional[Dict[str, Any]]:
+        """Pick the cheapest probes/ef_search meeting the recall target.
+
+        Stored embeddings serve as queries; exact top_k (index disabled)
+        is the ground truth. Settings whose p95 exceeds the latency budget
+        are skipped unless none meets the target.
+        """
+        current = self.current_index()
+        if current is None:
+            print("⚠️  No index to calibrate")
+            return None
+
+        method = current['method']
+        distance = self.distance_sql(current.get('halfvec'))
+        if method == 'ivfflat':
+            lists = current.get('lists', 100)
+            name = 'ivfflat.probes'
+            candidates = sorted({p for p in (1, 2, 4, 8, 16, 32, 64, 128, 256) if p < lists} | {lists})
+        else:
+            name = 'hnsw.ef_search'
+            candidates = [c for c in (10, 20, 40, 80, 160, 320, 640, 1000) if c >= top_k]
+
+        self.cursor.execute("""
+            SELECT embedding::text FROM chunk_contents
+            WHERE embedding IS NOT NULL
+            ORDER BY random()
+            LIMIT %s
+        """, (samples,))
+        queries = [row[0] for row in self.cursor.fetchall()]
+        if not queries:
+            print("⚠️  No embeddings to calibrate with")
+            return None
+
+        print(f"\n🎯 Calibrating {name}: recall@{top_k} ≥ {recall_target}, p95 ≤ {latency_ms}ms, {len(queries)} queries")
+
+        truth = [set(self._top_k(q, distance, top_k, {'enable_indexscan': 'off'})) for q in queries]
+
+        measured = []
+        for value in candidates:
+            recalls, latencies = [], []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                found = self._top_k(query, distance, top_k, {name: value})
+                latencies.append((time.perf_counter() - start) * 1000)
+                recalls.append(len(expected & set(found)) / max(len(expected), 1))
+            latencies.sort()
+            recall = sum(recalls) / len(recalls)
+            p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+            measured.append((value, recall, p95))
+            print(f"   {name}={value}: recall={recall:.3f}, p95={p95:.1f}ms")
+            if recall >= recall_target and p95 <= latency_ms:
+                break
+
+        meeting = [m for m in measured if m[1] >= recall_target]
+        within_budget = [m for m in meeting if m[2] <= latency_ms]
+        if within_budget:
+            value, recall, p95 = within_budget[0]
+        elif meeting:
+            value, recall, p95 = meeting[0]
+            print(f"   ⚠️  Recall target needs {p95:.1f}ms p95, over the {latency_ms}ms budget")
+        else:
+            value, recall, p95 = max(measured, key=lambda m: m[1])
+            print(f"   ⚠️  Recall target not reached, best recall {recall:.3f}")
+
+        search = {
+            'probes' if method == 'ivfflat' else 'ef_search': value,
+            'recall': round(recall, 4),
+            'recall_target': recall_target,
+            'p95_ms': round(p95, 2),
+        }
+        current.pop('definition', None)
+        current.update(search)
+        self.save_settings(current)
+        print(f"   ✓ {name}={value} stored with the index")
+        return search
+
+    @staticmethod
+    def distance_sql(halfvec: Optional[int]) -> str:
+        """Distance expression matching the indexed expression."""
+        if halfvec:
+            return f"embedding::halfvec({halfvec}) <=> %(query)s::halfvec({halfvec})"
+        return "embedding <=> %(query)s::vector"
+
+    def _top_k(self, query: str, distance: str, top_k: int, settings: Dict[str, Any]) -> List[str]:
+        """Content hashes of the nearest contents under transaction-local settings."""
+        self.cursor.execute("BEGIN")
+        try:
+            for name, value in settings.items():
+                self.cursor.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+            self.cursor.execute(f"""
+                SELECT content_hash FROM chunk_contents
+                WHERE embedding IS NOT NULL
+                ORDER BY {distance}
+                LIMIT %(top_k)s
+            """, {'query': query, 'top_k': top_k})
+            return [row[0] for row in self.cursor.fetchall()]
+        finally:
+            self.cursor.execute("COMMIT")
+
+    def close(self):
+        """Close database connection"""
+        self.cursor.close()
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the knowledge base vector index')
+    parser.add_argument('command', choices=['status', 'build', 'auto', 'calibrate'],
+                        help='status: show index; build: rebuild now; auto: rebuild if the '
+                             'corpus outgrew the index; calibrate: tune search settings')
+    parser.add_argument('--method', choices=['hnsw', 'ivfflat'],
+                        default=os.getenv('VECTOR_INDEX_METHOD', 'hnsw'),
+                        help='Index type (default: VECTOR_INDEX_METHOD or hnsw)')
+    parser.add_argument('--growth', type=float, default=2.0,
+                        help='Rebuild in auto mode when the corpus grew or shrank by this factor')
+    parser.add_argument('--recall-target', type=float,
+                        default=float(os.getenv('SEARCH_RECALL_TARGET', '0.95')),
+                        help='Recall@k the search settings must reach')
+    parser.add_argument('--latency-ms', type=float,
+                        default=float(os.getenv('SEARCH_LATENCY_MS', '50')),
+                        help='p95 latency budget for one ANN query')
+    parser.add_argument('--samples', type=int, default=50,
+                        help='Number of stored embeddings used as calibration queries')
+    parser.add_argument('--blocking', action='store_true',
+                        help='Build without CONCURRENTLY (faster, blocks writes)')
+    parser.add_argument('--repository', type=str,
+                        help="With build, rebuild only this repository's partition of the index")
+
+    args = parser.parse_args()
+
+    manager = VectorIndexManager()
+    try:
+        if args.command == 'status':
+            current = manager.current_index()
+            print(f"\n📊 Vectors: {manager.row_count()}, dimensions: {manager.dimensions()}")
+            if current is None:
+                print("❌ No vector index")
+            else:
+                print(f"📇 {current.pop('definition')}")
+                print(f"⚙️  {json.dumps(current, sort_keys=True)}")
+            return
+
+        if args.command == 'build' and args.repository:
+            manager.rebuild_repository(args.repository)
+            return
+        if args.command == 'build':
+            manager.build(args.method, concurrently=not args.blocking)
+        elif args.command == 'auto':
+            reason = manager.needs_rebuild(args.method, args.growth)
+            if reason is None:
+                print("✅ Vector index matches the corpus, nothing to do")
+                return
+            print(f"🔁 Rebuilding: {reason}")
+            manager.build(args.method, concurrently=not args.blocking)
+
+        manager.calibrate(args.recall_target, args.latency_ms, samples=args.samples)
+    finally:
+        manager.close()
+
+
+if __name__ == '__main__':
+    main()
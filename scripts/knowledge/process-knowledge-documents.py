@@ -6,20 +6,26 @@ Processes documentation files, generates embeddings, and stores in PostgreSQL
 
 Features:
 - Smart chunking by file type (markdown, code, yaml)
-- Deduplication by content hash
+- Content-addressed chunk store (each distinct chunk is embedded once)
 - Git metadata extraction
 - Batch embedding generation
 - Progress tracking
+- Configurable source body storage (plain text, zstd, or chunk-rebuilt)
+- SimHash near-duplicate detection (skip or link instead of re-embedding)
+- Incremental sync from the last indexed commit (per repository/branch watermark)
 """
 
 import os
+import re
 import sys
+import base64
 import hashlib
 import json
 import argparse
+from array import array
 from pathlib import Path
 from typing import List, Dict, Tuple, Optional
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from datetime import datetime
 
 # Third-party imports
@@ -31,6 +37,7 @@ try:
         MarkdownTextSplitter
     )
     import psycopg2
+    from psycopg2.extensions import AsIs, register_adapter
     from psycopg2.extras import execute_values
     import git
     from tqdm import tqdm
@@ -39,12 +46,16 @@ except ImportError as e:
     print("Install with: pip install openai langchain-text-splitters psycopg2-binary gitpython tqdm")
     sys.exit(1)
 
+# Optional: only needed for --source-storage zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-@dataclass
-class DocumentChunk:
-    """Represents a chunk of processed document"""
-    content: str
-    content_hash: str
+
+@dataclass(slots=True)
+class FileMetadata:
+    """Source metadata shared by every chunk of one file"""
     source_type: str
     source_url: str
     file_path: str
@@ -56,13 +67,192 @@ class DocumentChunk:
     commit_sha: str
     branch: str
     author: str
-    embedding: Optional[List[float]] = None
+
+
+@dataclass(slots=True)
+class DocumentChunk:
+    """Represents a chunk of processed document
+    
+    Metadata is a reference to the file's FileMetadata, and the embedding is a
+    float32 array (4 bytes per dimension) rather than a list of Python floats.
+    """
+    content: str
+    content_hash: str
+    meta: FileMetadata
+    chunk_index: int = 0
+    total_chunks: int = 0
+    char_start: Optional[int] = None  # position in the source file, None if not located
+    char_end: Optional[int] = None
+    embedding: Optional[array] = None
     quality_score: float = 0.0
+    in_store: bool = False  # embedding already present in chunk_contents
+    simhash: Optional[int] = None
+    duplicate_of: Optional[str] = None  # near-duplicate whose embedding is reused
+
+
+def decode_embedding(encoded: str) -> array:
+    """Decode a base64 embedding from the API into a float32 array"""
+    values = array('f', base64.b64decode(encoded))
+    if sys.byteorder == 'big':
+        values.byteswap()  # API sends little-endian floats
+    return values
+
+
+def adapt_vector(values: array) -> AsIs:
+    """Render a float32 array as a pgvector literal (9 digits round-trip float32)"""
+    return AsIs("'[%s]'::vector" % ','.join(map('{:.9g}'.format, values)))
+
+
+register_adapter(array, adapt_vector)
+
+
+def git_blob_sha(data: bytes) -> str:
+    """Git object ID of a blob with this content"""
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+class NearDuplicateDetector:
+    """SimHash near-duplicate lookup backed by the chunk_signatures table
+    
+    Signatures are 64-bit SimHashes of word shingles over normalized text, so
+    chunks that differ only in whitespace, numbers, versions or dates collide.
+    Lookups split each signature into 4 bands of 16 bits: two signatures within
+    Hamming distance 3 always share at least one band, which is what the
+    expression indexes on chunk_signatures are for. Matches stay within one
+    repository, whose partition holds the embedding being reused.
+    """
+    
+    BANDS = 4
+    BAND_BITS = 16
+    SHINGLE_SIZE = 3
+    
+    _NORMALIZE_PATTERNS = [
+        (re.compile(r'\b\d{4}-\d{2}-\d{2}(?:[t ]\d{2}:\d{2}(?::\d{2})?)?\b'), ' <date> '),
+        (re.compile(r'\bv?\d+(?:\.\d+)+(?:[-+][\w.]+)?\b'), ' <version> '),
+        (re.compile(r'\b[0-9a-f]{7,40}\b'), ' <sha> '),
+        (re.compile(r'\d+'), ' <num> '),
+        (re.compile(r'\s+'), ' '),
+    ]
+    
+    def __init__(self, db_conn, repository: str, max_distance: int = 3):
+        if not 0 <= max_distance < self.BANDS:
+            raise ValueError(f"max_distance must be between 0 and {self.BANDS - 1}")
+        self.db_conn = db_conn
+        self.repository = repository
+        self.max_distance = max_distance
+        self.run_signatures: Dict[str, int] = {}  # registered during this run
+    
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        """Lowercase and mask volatile tokens"""
+        text = text.lower()
+        for pattern, replacement in cls._NORMALIZE_PATTERNS:
+            text = pattern.sub(replacement, text)
+        return text.strip()
+    
+    @classmethod
+    def signature(cls, text: str) -> int:
+        """64-bit SimHash, as a signed integer ready for a BIGINT column"""
+        words = cls.normalize(text).split(' ')
+        size = min(cls.SHINGLE_SIZE, len(words))
+        weights = [0] * 64
+        for i in range(len(words) - size + 1):
+            shingle = ' '.join(words[i:i + size]).encode()
+            value = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'big')
+            for bit in range(64):
+                weights[bit] += 1 if value >> bit & 1 else -1
+        unsigned = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+        return unsigned - (1 << 64) if unsigned >= 1 << 63 else unsigned
+    
+    @classmethod
+    def bands(cls, signature: int) -> List[int]:
+        """Split a signature into its lookup bands"""
+        unsigned = signature & ((1 << 64) - 1)
+        mask = (1 << cls.BAND_BITS) - 1
+        return [(unsigned >> (band * cls.BAND_BITS)) & mask for band in range(cls.BANDS)]
+    
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        """Hamming distance between two signatures"""
+        return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+    
+    def find_matches(self, signatures: Dict[str, int]) -> Dict[str, str]:
+        """Map each content hash to the closest stored or registered near-duplicate"""
+        if not signatures:
+            return {}
+        
+        band_values = [set() for _ in range(self.BANDS)]
+        for signature in signatures.values():
+            for band, value in enumerate(self.bands(signature)):
+                band_values[band].add(value)
+        
+        cursor = self.db_conn.cursor()
+        cursor.execute("""
+            SELECT content_hash, simhash FROM chunk_signatures
+            WHERE repository = %s
+            AND ((simhash & 65535) = ANY(%s)
+            OR ((simhash >> 16) & 65535) = ANY(%s)
+            OR ((simhash >> 32) & 65535) = ANY(%s)
+            OR ((simhash >> 48) & 65535) = ANY(%s))
+        """, [self.repository] + [list(values) for values in band_values])
+        candidates = dict(cursor.fetchall())
+        cursor.close()
+        candidates.update(self.run_signatures)
+        
+        matches = {}
+        for content_hash, signature in signatures.items():
+            match = self.closest(content_hash, signature, candidates)
+            if match:
+                matches[content_hash] = match
+        return matches
+    
+    def closest(self, content_hash: str, signature: int, candidates: Dict[str, int]) -> Optional[str]:
+        """Closest candidate within max_distance, if any"""
+        best = None
+        for candidate_hash, candidate in candidates.items():
+            if candidate_hash == content_hash:
+                continue
+            d = self.distance(signature, candidate)
+            if d <= self.max_distance and (best is None or d < best[1]):
+                best = (candidate_hash, d)
+        return best[0] if best else None
+    
+    def register(self, content_hash: str, signature: int):
+        """Make a saved canonical chunk matchable by the rest of this run"""
+        self.run_signatures[content_hash] = signature
+    
+    def backfill(self, batch_size: int = 500) -> int:
+        """Compute signatures for embedded contents that have none yet"""
+        cursor = self.db_conn.cursor()
+        cursor.execute("""
+            SELECT c.content_hash, c.content FROM chunk_contents c
+            WHERE c.repository = %s
+            AND c.embedding IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM chunk_signatures s
+                WHERE s.repository = c.repository AND s.content_hash = c.content_hash
+            )
+        """, (self.repository,))
+        rows = cursor.fetchall()
+        for i in range(0, len(rows), batch_size):
+            execute_values(cursor, """
+                INSERT INTO chunk_signatures (repository, content_hash, simhash) VALUES %s
+                ON CONFLICT (repository, content_hash) DO NOTHING
+            """, [(self.repository, h, self.signature(text)) for h, text in rows[i:i + batch_size]])
+        self.db_conn.commit()
+        cursor.close()
+        return len(rows)
 
 
 class KnowledgeProcessor:
     """Main processor for knowledge documents"""
     
+    # Repository indexed when none is configured (--repository / KNOWLEDGE_REPOSITORY)
+    DEFAULT_REPOSITORY = 'DXC_PoC_Nirvana'
+    
+    # File types picked up by incremental (watermark) sync
+    SYNC_EXTENSIONS = ('.md', '.py', '.ts', '.tsx', '.yaml', '.yml')
+    
     # Chunking configurations by file type
     CHUNK_CONFIGS = {
         'markdown': {
@@ -92,12 +282,40 @@ class KnowledgeProcessor:
         },
     }
     
+    # How source_documents.content is stored
+    #   text: plain TEXT column (compressed by TOAST, lz4 if configured in the schema)
+    #   zstd: zstd-compressed bytes in content_compressed, content left NULL
+    #   none: no body at all, rebuilt on demand from knowledge_chunks
+    SOURCE_STORAGE_MODES = ('text', 'zstd', 'none')
+    
+    # What to do with a chunk whose SimHash is close to an already embedded one
+    #   off:  embed it like any other chunk
+    #   link: store the text but reuse the near-duplicate's embedding (not indexed)
+    #   skip: drop the chunk entirely
+    NEAR_DUPLICATE_MODES = ('off', 'link', 'skip')
+    
     def __init__(self, config: Dict):
         """Initialize processor with configuration"""
         self.config = config
+        self.repository = config.get('repository') or self.DEFAULT_REPOSITORY
+        self.source_storage = config.get('source_storage') or 'text'
+        if self.source_storage not in self.SOURCE_STORAGE_MODES:
+            raise ValueError(f"Unknown source storage mode: {self.source_storage}")
+        if self.source_storage == 'zstd' and zstandard is None:
+            raise ValueError("Source storage 'zstd' requires: pip install zstandard")
+        self.near_duplicate_mode = config.get('near_duplicate_mode') or 'off'
+        if self.near_duplicate_mode not in self.NEAR_DUPLICATE_MODES:
+            raise ValueError(f"Unknown near-duplicate mode: {self.near_duplicate_mode}")
+        self.last_embedding_tokens = 0
         self.repo = self._init_git_repo()
         self.openai_client = self._init_openai()
         self.db_conn = self._init_database()
+        self._ensure_repository_partitions()
+        self.near_duplicates = None
+        if self.near_duplicate_mode != 'off':
+            self.near_duplicates = NearDuplicateDetector(
+                self.db_conn, self.repository, int(config.get('near_duplicate_distance', 3))
+            )
         
     def _init_git_repo(self) -> Optional[git.Repo]:
         """Initialize Git repository"""
@@ -132,14 +350,20 @@ class KnowledgeProcessor:
         print(f"✓ Database connected: {self.config['postgres_db']}")
         return conn
     
+    def _ensure_repository_partitions(self):
+        """Create this repository's chunk table partitions if missing"""
+        cursor = self.db_conn.cursor()
+        cursor.execute("SELECT create_repository_partitions(%s)", (self.repository,))
+        self.db_conn.commit()
+        cursor.close()
+    
     def process_file(self, file_path: str) -> List[DocumentChunk]:
         """Process a single file and return chunks"""
         print(f"\n📄 Processing: {file_path}")
         
         # Read file content
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content, blob_sha = self._read_source(file_path)
         except Exception as e:
             print(f"  ✗ Error reading file: {e}")
             return []
@@ -148,7 +372,7 @@ class KnowledgeProcessor:
         content_hash = hashlib.sha256(content.encode()).hexdigest()
         
         # Check if already processed
-        if self._is_already_processed(file_path, content_hash):
+        if self._is_already_processed(file_path, content_hash, blob_sha):
             print(f"  ↷ Skipping (already processed)")
             return []
         
@@ -159,31 +383,59 @@ class KnowledgeProcessor:
         chunks_text = self._chunk_content(file_path, content)
         print(f"  ✓ Created {len(chunks_text)} chunks")
         
-        # Create DocumentChunk objects
+        # Create DocumentChunk objects sharing one metadata record
+        meta = FileMetadata(
+            source_type=metadata['source_type'],
+            source_url=metadata['source_url'],
+            file_path=file_path,
+            repository=metadata['repository'],
+            category=metadata['category'],
+            tags=metadata['tags'],
+            language=metadata['language'],
+            version=metadata.get('version', ''),
+            commit_sha=metadata.get('commit_sha', ''),
+            branch=metadata.get('branch', 'master'),
+            author=metadata.get('author', '')
+        )
         chunks = []
-        for chunk_text in chunks_text:
+        offsets = self._locate_chunks(content, chunks_text)
+        for chunk_index, chunk_text in enumerate(chunks_text):
             chunk_hash = hashlib.sha256(chunk_text.encode()).hexdigest()
+            char_start, char_end = offsets[chunk_index]
             
             chunk = DocumentChunk(
                 content=chunk_text,
                 content_hash=chunk_hash,
-                source_type=metadata['source_type'],
-                source_url=metadata['source_url'],
-                file_path=file_path,
-                repository=metadata['repository'],
-                category=metadata['category'],
-                tags=metadata['tags'],
-                language=metadata['language'],
-                version=metadata.get('version', ''),
-                commit_sha=metadata.get('commit_sha', ''),
-                branch=metadata.get('branch', 'master'),
-                author=metadata.get('author', ''),
+                meta=meta,
+                chunk_index=chunk_index,
+                total_chunks=len(chunks_text),
+                char_start=char_start,
+                char_end=char_end,
                 quality_score=self._calculate_quality_score(chunk_text)
             )
             chunks.append(chunk)
         
         return chunks
     
+    @staticmethod
+    def _locate_chunks(content: str, chunks_text: List[str]) -> List[tuple]:
+        """(start, end) character offsets of each chunk in the source
+        
+        Chunks are searched in order from just after the previous chunk's
+        start, so overlapping neighbours resolve to the right occurrence.
+        Chunks the splitter altered (stripped or rejoined) get (None, None).
+        """
+        offsets = []
+        search_from = 0
+        for chunk_text in chunks_text:
+            start = content.find(chunk_text, search_from)
+            if start < 0:
+                offsets.append((None, None))
+                continue
+            offsets.append((start, start + len(chunk_text)))
+            search_from = start + 1
+        return offsets
+    
     def _chunk_content(self, file_path: str, content: str) -> List[str]:
         """Chunk content based on file type"""
         ext = Path(file_path).suffix.lstrip('.')
@@ -230,7 +482,7 @@ class KnowledgeProcessor:
         metadata = {
             'source_type': 'github',
             'source_url': '',
-            'repository': 'DXC_PoC_Nirvana',
+            'repository': self.repository,
             'category': self._categorize_file(file_path),
             'tags': self._extract_tags(file_path),
             'language': self._detect_language(file_path),
@@ -352,26 +604,151 @@ class KnowledgeProcessor:
         # Clamp between 0 and 1
         return max(0.0, min(1.0, score))
     
-    def _is_already_processed(self, file_path: str, content_hash: str) -> bool:
-        """Check if file with this hash is already processed"""
+    @staticmethod
+    def _read_source(file_path: str) -> Tuple[str, str]:
+        """Read a file as text (universal newlines) plus its git blob ID"""
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        content = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        return content, git_blob_sha(raw)
+    
+    def _is_already_processed(self, file_path: str, content_hash: str, blob_sha: Optional[str] = None) -> bool:
+        """Check if file with this hash is already processed
+        
+        Also records the blob ID on matching rows that predate blob tracking.
+        """
         cursor = self.db_conn.cursor()
         cursor.execute(
-            "SELECT 1 FROM source_documents WHERE file_path = %s AND content_hash = %s",
-            (file_path, content_hash)
+            "SELECT blob_sha FROM source_documents "
+            "WHERE repository = %s AND file_path = %s AND content_hash = %s",
+            (self.repository, file_path, content_hash)
         )
         result = cursor.fetchone()
+        if result is not None and blob_sha and result[0] != blob_sha:
+            cursor.execute(
+                "UPDATE source_documents SET blob_sha = %s WHERE repository = %s AND file_path = %s",
+                (blob_sha, self.repository, file_path)
+            )
+            self.db_conn.commit()
         cursor.close()
         return result is not None
     
+    def _existing_content_hashes(self, content_hashes: set) -> set:
+        """Return the hashes already embedded with the current model
+        
+        Contents embedded in another repository's partition are copied into
+        this repository's first, so shared texts are never embedded twice.
+        """
+        if not content_hashes:
+            return set()
+        cursor = self.db_conn.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO chunk_contents (
+                    repository, content_hash, content, embedding, embedding_model, quality_score
+                )
+                SELECT DISTINCT ON (content_hash)
+                    %(repository)s, content_hash, content, embedding, embedding_model, quality_score
+                FROM chunk_contents
+                WHERE content_hash = ANY(%(hashes)s)
+                AND repository <> %(repository)s
+                AND embedding IS NOT NULL
+                AND embedding_model = %(model)s
+                ON CONFLICT (repository, content_hash) DO NOTHING
+            """, {
+                'repository': self.repository,
+                'hashes': list(content_hashes),
+                'model': self.config['embedding_model'],
+            })
+            if cursor.rowcount:
+                print(f"  ↷ Copied {cursor.rowcount} embeddings from other repositories")
+            cursor.execute("""
+                SELECT content_hash FROM chunk_contents
+                WHERE repository = %s
+                AND content_hash = ANY(%s)
+                AND embedding IS NOT NULL
+                AND embedding_model = %s
+            """, (self.repository, list(content_hashes), self.config['embedding_model']))
+            result = {row[0] for row in cursor.fetchall()}
+            self.db_conn.commit()
+        except Exception:
+            self.db_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return result
+    
+    def _resolve_near_duplicates(self, chunks: List[DocumentChunk], pending: Dict[str, str]) -> List[DocumentChunk]:
+        """Link or drop chunks that are near-duplicates of embedded ones
+        
+        Removes matched hashes from pending (so they are not embedded) and
+        returns the chunks to keep.
+        """
+        signatures = {h: NearDuplicateDetector.signature(text) for h, text in pending.items()}
+        for chunk in chunks:
+            chunk.simhash = signatures.get(chunk.content_hash)
+        
+        # Match against the store first, then within this file in order
+        matches = self.near_duplicates.find_matches(signatures)
+        local = {}
+        for content_hash in pending:
+            if content_hash in matches:
+                continue
+            match = self.near_duplicates.closest(content_hash, signatures[content_hash], local)
+            if match:
+                matches[content_hash] = match
+            else:
+                local[content_hash] = signatures[content_hash]
+        
+        if not matches:
+            return chunks
+        
+        for content_hash in matches:
+            del pending[content_hash]
+        
+        if self.near_duplicate_mode == 'skip':
+            kept = [chunk for chunk in chunks if chunk.content_hash not in matches]
+            print(f"  ↷ Skipping {len(chunks) - len(kept)} near-duplicate chunks")
+            return kept
+        
+        linked = 0
+        for chunk in chunks:
+            if chunk.content_hash in matches:
+                chunk.duplicate_of = matches[chunk.content_hash]
+                linked += 1
+        print(f"  ↷ Linking {linked} near-duplicate chunks to existing embeddings")
+        return chunks
+    
     def generate_embeddings(self, chunks: List[DocumentChunk]) -> List[DocumentChunk]:
         """Generate embeddings for chunks"""
         if not chunks:
             return chunks
         
-        print(f"  🔮 Generating embeddings for {len(chunks)} chunks...")
+        # Only embed distinct texts that are not already in the content store
+        existing = self._existing_content_hashes({chunk.content_hash for chunk in chunks})
+        pending = {}
+        for chunk in chunks:
+            if chunk.content_hash in existing:
+                chunk.in_store = True
+            else:
+                pending.setdefault(chunk.content_hash, chunk.content)
+        
+        reused = sum(1 for chunk in chunks if chunk.in_store)
+        if reused:
+            print(f"  ↷ Reusing {reused} stored embeddings")
+        
+        if self.near_duplicates and pending:
+            chunks = self._resolve_near_duplicates(chunks, pending)
+        
+        self.last_embedding_tokens = 0
+        if not pending:
+            return chunks
+        
+        print(f"  🔮 Generating embeddings for {len(pending)} distinct chunks...")
         
         # Extract texts
-        texts = [chunk.content for chunk in chunks]
+        hashes = list(pending)
+        texts = [pending[h] for h in hashes]
         
         # Batch processing (Azure OpenAI has limits)
         batch_size = 100
@@ -380,123 +757,548 @@ class KnowledgeProcessor:
         for i in range(0, len(texts), batch_size):
             batch = texts[i:i+batch_size]
             try:
-                response = self.openai_client.embeddings.create(
-                    model=self.config['embedding_model'],
-                    input=batch
-                )
-                embeddings = [item.embedding for item in response.data]
+                params = {
+                    'model': self.config['embedding_model'],
+                    'input': batch,
+                    'encoding_format': 'base64',
+                }
+                if self.config.get('embedding_dimensions'):
+                    params['dimensions'] = self.config['embedding_dimensions']
+                response = self.openai_client.embeddings.create(**params)
+                embeddings = [decode_embedding(item.embedding) for item in response.data]
                 all_embeddings.extend(embeddings)
+                if getattr(response, 'usage', None):
+                    self.last_embedding_tokens += response.usage.total_tokens
             except Exception as e:
                 print(f"  ✗ Embedding generation failed: {e}")
                 # Fill with None for failed batches
                 all_embeddings.extend([None] * len(batch))
         
-        # Assign embeddings to chunks
-        for chunk, embedding in zip(chunks, all_embeddings):
-            chunk.embedding = embedding
+        # Assign embeddings to every chunk sharing the text
+        embeddings_by_hash = dict(zip(hashes, all_embeddings))
+        for chunk in chunks:
+            if not chunk.in_store:
+                chunk.embedding = embeddings_by_hash.get(chunk.content_hash)
         
         print(f"  ✓ Embeddings generated")
         return chunks
     
-    def save_to_database(self, chunks: List[DocumentChunk], file_path: str):
-        """Save chunks to PostgreSQL"""
+    def save_to_database(self, chunks: List[DocumentChunk], file_path: str,
+                         total_tokens: Optional[int] = None) -> bool:
+        """Save chunks to PostgreSQL, returning False on database or embedding errors"""
         if not chunks:
-            return
+            return True
         
         print(f"  💾 Saving {len(chunks)} chunks to database...")
         
         cursor = self.db_conn.cursor()
+        meta = chunks[0].meta
         
         try:
-            # Insert chunks
-            insert_query = """
-            INSERT INTO knowledge_chunks (
-                content, content_hash, embedding,
-                source_type, source_url, file_path, repository,
-                category, tags, language, version, commit_sha, branch, author,
-                quality_score
-            ) VALUES %s
-            ON CONFLICT (content_hash, file_path) DO UPDATE SET
-                updated_at = NOW(),
-                usage_count = knowledge_chunks.usage_count
-            """
+            # Insert distinct new contents; re-embedded rows replace stale models
+            contents = {}
+            for chunk in chunks:
+                if chunk.embedding is not None:
+                    contents.setdefault(chunk.content_hash, (
+                        meta.repository,
+                        chunk.content_hash,
+                        chunk.content,
+                        chunk.embedding,
+                        self.config['embedding_model'],
+                        chunk.quality_score,
+                        None
+                    ))
+            
+            # Near-duplicates reuse their target's embedding; a target from this
+            # file whose embedding failed takes the duplicate down with it
+            file_hashes = {chunk.content_hash for chunk in chunks}
+            for chunk in chunks:
+                if chunk.duplicate_of and chunk.embedding is None and chunk.content_hash not in contents:
+                    if chunk.duplicate_of in contents or chunk.duplicate_of not in file_hashes:
+                        contents[chunk.content_hash] = (
+                            meta.repository,
+                            chunk.content_hash,
+                            chunk.content,
+                            None,
+                            None,
+                            chunk.quality_score,
+                            chunk.duplicate_of
+                        )
+                    else:
+                        chunk.duplicate_of = None
+            
+            # A chunk without an embedding would silently drop out of the index;
+            # leave the file (and its blob_sha) untouched so the next sync retries it
+            missing = [
+                chunk for chunk in chunks
+                if not (chunk.in_store or chunk.embedding is not None or chunk.duplicate_of)
+            ]
+            if missing:
+                print(f"  ✗ {len(missing)} chunks have no embedding, file not saved")
+                return False
+            
+            if contents:
+                execute_values(cursor, """
+                INSERT INTO chunk_contents (
+                    repository, content_hash, content, embedding, embedding_model, quality_score, duplicate_of
+                ) VALUES %s
+                ON CONFLICT (repository, content_hash) DO UPDATE SET
+                    embedding = EXCLUDED.embedding,
+                    embedding_model = EXCLUDED.embedding_model,
+                    duplicate_of = EXCLUDED.duplicate_of
+                WHERE chunk_contents.embedding_model IS DISTINCT FROM EXCLUDED.embedding_model
+                """, list(contents.values()))
+            
+            signatures = [
+                (chunk.content_hash, chunk.simhash)
+                for chunk in chunks
+                if chunk.simhash is not None and chunk.embedding is not None
+            ]
+            if signatures:
+                execute_values(cursor, """
+                INSERT INTO chunk_signatures (repository, content_hash, simhash) VALUES %s
+                ON CONFLICT (repository, content_hash) DO UPDATE SET simhash = EXCLUDED.simhash
+                """, [(meta.repository, h, simhash) for h, simhash in dict(signatures).items()])
+            
+            # Replace this file's occurrences
+            cursor.execute(
+                "DELETE FROM chunk_occurrences WHERE repository = %s AND file_path = %s",
+                (meta.repository, file_path)
+            )
             
             values = [
                 (
-                    chunk.content,
                     chunk.content_hash,
-                    chunk.embedding,
-                    chunk.source_type,
-                    chunk.source_url,
-                    chunk.file_path,
-                    chunk.repository,
-                    chunk.category,
-                    chunk.tags,
-                    chunk.language,
-                    chunk.version,
-                    chunk.commit_sha,
-                    chunk.branch,
-                    chunk.author,
-                    chunk.quality_score
+                    meta.file_path,
+                    chunk.chunk_index,
+                    chunk.total_chunks,
+                    chunk.char_start,
+                    chunk.char_end,
+                    meta.source_type,
+                    meta.source_url,
+                    meta.repository,
+                    meta.category,
+                    meta.tags,
+                    meta.language,
+                    meta.version,
+                    meta.commit_sha,
+                    meta.branch,
+                    meta.author
                 )
-                for chunk in chunks if chunk.embedding is not None
+                for chunk in chunks
             ]
             
             if values:
-                execute_values(cursor, insert_query, values)
+                execute_values(cursor, """
+                INSERT INTO chunk_occurrences (
+                    content_hash, file_path, chunk_index, total_chunks, char_start, char_end,
+                    source_type, source_url, repository,
+                    category, tags, language, version, commit_sha, branch, author
+                ) VALUES %s
+                """, values)
             
             # Update source_documents
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            content_hash = hashlib.sha256(content.encode()).hexdigest()
+            content, blob_sha = self._read_source(file_path)
+            content_bytes = content.encode()
+            content_hash = hashlib.sha256(content_bytes).hexdigest()
+            stored_text, stored_compressed, chunk_layout = self._encode_source(content, chunks)
             
             cursor.execute("""
                 INSERT INTO source_documents (
-                    file_path, repository, content, content_hash,
-                    chunks_count, sync_status
-                ) VALUES (%s, %s, %s, %s, %s, 'synced')
-                ON CONFLICT (file_path) DO UPDATE SET
+                    file_path, repository, content, content_compressed,
+                    content_encoding, chunk_layout, content_hash, blob_sha,
+                    file_size, file_type, language,
+                    chunks_count, total_tokens, commit_sha, branch, sync_status
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'synced')
+                ON CONFLICT (repository, file_path) DO UPDATE SET
                     content = EXCLUDED.content,
+                    content_compressed = EXCLUDED.content_compressed,
+                    content_encoding = EXCLUDED.content_encoding,
+                    chunk_layout = EXCLUDED.chunk_layout,
                     content_hash = EXCLUDED.content_hash,
+                    blob_sha = EXCLUDED.blob_sha,
+                    file_size = EXCLUDED.file_size,
+                    file_type = EXCLUDED.file_type,
+                    language = EXCLUDED.language,
                     chunks_count = EXCLUDED.chunks_count,
+                    total_tokens = EXCLUDED.total_tokens,
+                    commit_sha = EXCLUDED.commit_sha,
+                    branch = EXCLUDED.branch,
                     last_synced = NOW(),
                     sync_status = 'synced'
             """, (
                 file_path,
-                chunks[0].repository,
-                content,
+                meta.repository,
+                stored_text,
+                psycopg2.Binary(stored_compressed) if stored_compressed is not None else None,
+                self.source_storage,
+                json.dumps(chunk_layout) if chunk_layout is not None else None,
                 content_hash,
-                len(chunks)
+                blob_sha,
+                len(content_bytes),
+                Path(file_path).suffix.lstrip('.') or None,
+                meta.language,
+                len(chunks),
+                total_tokens,
+                meta.commit_sha or None,
+                meta.branch
             ))
             
+            self._notify_sync(cursor, file_path, [meta.category])
             self.db_conn.commit()
+            if self.near_duplicates:
+                for content_hash, simhash in signatures:
+                    self.near_duplicates.register(content_hash, simhash)
             print(f"  ✓ Saved to database")
+            return True
             
         except Exception as e:
             self.db_conn.rollback()
             print(f"  ✗ Database error: {e}")
+            return False
+        finally:
+            cursor.close()
+    
+    def _encode_source(self, content: str, chunks: List[DocumentChunk]) -> Tuple[Optional[str], Optional[bytes], Optional[Dict]]:
+        """Encode a source body according to the storage mode
+        
+        Returns (content, content_compressed, chunk_layout); unused slots are None.
+        """
+        if self.source_storage == 'zstd':
+            return None, zstandard.ZstdCompressor(level=10).compress(content.encode()), None
+        
+        if self.source_storage == 'none':
+            layout = self._build_chunk_layout(content, chunks)
+            if layout is not None:
+                return None, None, layout
+            print("  ⚠ Chunks do not cover the document, storing body as text")
+        
+        return content, None, None
+    
+    def _build_chunk_layout(self, content: str, chunks: List[DocumentChunk]) -> Optional[Dict]:
+        """Describe how to rebuild content from its chunks
+        
+        Each entry is [content_hash, start, end] in document order; 'gaps' holds the
+        text found between consecutive chunks (usually whitespace dropped by the
+        splitter) plus the trailing remainder. Returns None if a chunk cannot be
+        located, in which case the body must be stored.
+        """
+        entries = []
+        gaps = []
+        covered = 0
+        for chunk in chunks:
+            if chunk.char_start is None:
+                return None
+            start, end = chunk.char_start, chunk.char_end
+            gaps.append(content[covered:start] if start > covered else '')
+            entries.append([chunk.content_hash, start, end])
+            covered = max(covered, end)
+        gaps.append(content[covered:])
+        return {'chunks': entries, 'gaps': gaps}
+    
+    def load_source_content(self, file_path: str) -> Optional[str]:
+        """Return the stored body of a source document, whatever the storage mode"""
+        cursor = self.db_conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT content, content_compressed, content_encoding, chunk_layout, content_hash
+                FROM source_documents WHERE repository = %s AND file_path = %s
+            """, (self.repository, file_path))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            content, compressed, encoding, layout, content_hash = row
+            
+            if content is not None:
+                return content
+            if compressed is not None:
+                if zstandard is None:
+                    raise RuntimeError("zstd-compressed source requires: pip install zstandard")
+                return zstandard.ZstdDecompressor().decompress(bytes(compressed)).decode()
+            if layout is None:
+                return None
+            
+            # Rebuild from chunks ('none' storage)
+            if isinstance(layout, str):
+                layout = json.loads(layout)
+            cursor.execute("""
+                SELECT c.content_hash, c.content
+                FROM chunk_occurrences o
+                JOIN chunk_contents c ON c.repository = o.repository AND c.content_hash = o.content_hash
+                WHERE o.repository = %s AND o.file_path = %s
+            """, (self.repository, file_path))
+            texts = dict(cursor.fetchall())
+            parts = []
+            covered = 0
+            for (chunk_hash, start, end), gap in zip(layout['chunks'], layout['gaps']):
+                text = texts.get(chunk_hash)
+                if text is None:
+                    print(f"  ✗ Cannot rebuild {file_path}: chunk {chunk_hash[:12]} missing")
+                    return None
+                parts.append(gap)
+                if end > covered:
+                    parts.append(text[max(covered - start, 0):])
+                    covered = end
+            parts.append(layout['gaps'][-1])
+            rebuilt = ''.join(parts)
+            
+            if hashlib.sha256(rebuilt.encode()).hexdigest() != content_hash:
+                print(f"  ⚠ Rebuilt body of {file_path} does not match its content hash")
+            return rebuilt
+        finally:
+            cursor.close()
+    
+    # Referencing partitions first, as drop_repository_partitions() does
+    PARTITIONED_TABLES = ('chunk_occurrences', 'chunk_signatures', 'chunk_contents')
+    
+    def drop_repository(self, repository: str):
+        """Remove a repository's chunks, sources and watermarks at once
+        
+        Its partitions are detached CONCURRENTLY (no transaction block allowed),
+        so other repositories' searches and ingests are never blocked; a detach
+        left pending by an interrupted run is finalized. Dropping the detached
+        tables and the sync state then happens in one transaction.
+        """
+        self.db_conn.commit()
+        cursor = self.db_conn.cursor()
+        try:
+            self.db_conn.autocommit = True
+            try:
+                cursor.execute("SELECT repository_partition_suffix(%s)", (repository,))
+                suffix = cursor.fetchone()[0]
+                for parent in self.PARTITIONED_TABLES:
+                    partition = f"{parent}_{suffix}"
+                    cursor.execute(
+                        "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(%s)",
+                        (partition,)
+                    )
+                    row = cursor.fetchone()
+                    if row is not None:
+                        mode = 'FINALIZE' if row[0] else 'CONCURRENTLY'
+                        cursor.execute(f'ALTER TABLE {parent} DETACH PARTITION "{partition}" {mode}')
+            finally:
+                self.db_conn.autocommit = False
+            
+            cursor.execute("SELECT drop_repository_partitions(%s)", (repository,))
+            self.db_conn.commit()
+            print(f"🗑️  Dropped partitions of repository {repository}")
+        except Exception:
+            self.db_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    
+    def remove_orphan_contents(self) -> int:
+        """Delete stored contents no longer referenced by any file"""
+        cursor = self.db_conn.cursor()
+        try:
+            cursor.execute("""
+                DELETE FROM chunk_contents c
+                WHERE c.repository = %(repository)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM chunk_occurrences o
+                    WHERE o.repository = c.repository AND o.content_hash = c.content_hash
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM chunk_contents d
+                    WHERE d.repository = c.repository AND d.duplicate_of = c.content_hash
+                )
+            """, {'repository': self.repository})
+            removed = cursor.rowcount
+            self.db_conn.commit()
+            return removed
+        except Exception as e:
+            self.db_conn.rollback()
+            print(f"  ✗ Orphan cleanup failed: {e}")
+            return 0
+        finally:
+            cursor.close()
+    
+    def remove_file(self, file_path: str) -> bool:
+        """Remove a deleted file's occurrences and source document"""
+        cursor = self.db_conn.cursor()
+        try:
+            cursor.execute(
+                "DELETE FROM chunk_occurrences WHERE repository = %s AND file_path = %s RETURNING category",
+                (self.repository, file_path)
+            )
+            categories = sorted({row[0] for row in cursor.fetchall() if row[0]})
+            cursor.execute(
+                "DELETE FROM source_documents WHERE repository = %s AND file_path = %s",
+                (self.repository, file_path)
+            )
+            self._notify_sync(cursor, file_path, categories)
+            self.db_conn.commit()
+            print(f"  🗑 Removed: {file_path}")
+            return True
+        except Exception as e:
+            self.db_conn.rollback()
+            print(f"  ✗ Failed to remove {file_path}: {e}")
+            return False
         finally:
             cursor.close()
     
-    def process_files(self, file_paths: List[str]):
-        """Process multiple files"""
+    @staticmethod
+    def _notify_sync(cursor, file_path: str, categories: List[str]):
+        """Tell retrieval processes (SemanticResultCache) that a file changed
+        
+        Delivered on commit, so listeners never see uncommitted changes.
+        """
+        payload = json.dumps({'file_path': file_path, 'categories': categories})
+        cursor.execute("SELECT pg_notify('knowledge_sync', %s)", (payload,))
+    
+    def current_branch(self) -> str:
+        """Branch being indexed (falls back to CI env when HEAD is detached)"""
+        if self.config.get('branch'):
+            return self.config['branch']
+        try:
+            return self.repo.active_branch.name
+        except TypeError:
+            return os.getenv('GITHUB_REF_NAME', 'master')
+    
+    def _get_watermark(self, branch: str) -> Optional[str]:
+        """Last fully indexed commit for this repository/branch"""
+        cursor = self.db_conn.cursor()
+        cursor.execute(
+            "SELECT commit_sha FROM sync_watermarks WHERE repository = %s AND branch = %s",
+            (self.repository, branch)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+    
+    def _set_watermark(self, branch: str, commit_sha: str):
+        """Record commit_sha as fully indexed"""
+        cursor = self.db_conn.cursor()
+        cursor.execute("""
+            INSERT INTO sync_watermarks (repository, branch, commit_sha)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (repository, branch) DO UPDATE SET
+                commit_sha = EXCLUDED.commit_sha,
+                updated_at = NOW()
+        """, (self.repository, branch, commit_sha))
+        self.db_conn.commit()
+        cursor.close()
+    
+    def changes_since_watermark(self, branch: str) -> Tuple[List[str], List[str], str]:
+        """Files to (re)index and files to remove between the watermark and HEAD
+        
+        Uses the diff between the two commits when the watermark is an ancestor
+        of HEAD, otherwise the whole HEAD tree (first run, force push). Either
+        way, files whose blob ID matches source_documents.blob_sha are skipped
+        without being read. Returns (changed, deleted, head_sha), with paths
+        relative to the current directory.
+        """
+        head = self.repo.head.commit
+        watermark = self._get_watermark(branch)
+        
+        base = None
+        if watermark:
+            try:
+                base = self.repo.commit(watermark)
+                if not self.repo.is_ancestor(base, head):
+                    print(f"⚠ Watermark {watermark[:10]} is not an ancestor of HEAD, scanning full tree")
+                    base = None
+            except Exception:
+                print(f"⚠ Watermark {watermark[:10]} not found in history, scanning full tree")
+        
+        candidates = {}  # repo-relative path -> blob sha at HEAD
+        deleted = []
+        if base is not None:
+            if base == head:
+                return [], [], head.hexsha
+            print(f"✓ Diffing {base.hexsha[:10]}..{head.hexsha[:10]}")
+            for diff in base.diff(head):
+                if diff.deleted_file or diff.renamed_file:
+                    deleted.append(diff.a_path)
+                if not diff.deleted_file:
+                    candidates[diff.b_path] = diff.b_blob.hexsha
+        else:
+            for item in head.tree.traverse():
+                if item.type == 'blob':
+                    candidates[item.path] = item.hexsha
+        
+        candidates = {p: sha for p, sha in candidates.items() if p.endswith(self.SYNC_EXTENSIONS)}
+        deleted = [p for p in deleted if p.endswith(self.SYNC_EXTENSIONS)]
+        
+        def local(path: str) -> str:
+            return os.path.relpath(os.path.join(self.repo.working_dir, path))
+        
+        cursor = self.db_conn.cursor()
+        cursor.execute(
+            "SELECT file_path, blob_sha FROM source_documents WHERE repository = %s",
+            (self.repository,)
+        )
+        stored = dict(cursor.fetchall())
+        cursor.close()
+        
+        if base is None:
+            # Full scan: anything indexed but no longer in the tree is gone
+            present = {local(p) for p in candidates}
+            deleted = [p for p in stored if p not in present and p.endswith(self.SYNC_EXTENSIONS)]
+        else:
+            deleted = [local(p) for p in deleted]
+        
+        changed = [local(p) for p, sha in candidates.items() if stored.get(local(p)) != sha]
+        print(f"✓ {len(changed)} changed, {len(deleted)} deleted, "
+              f"{len(candidates) - len(changed)} unchanged blobs skipped")
+        return changed, [p for p in deleted if p not in changed], head.hexsha
+    
+    def sync_since_watermark(self, changed_list: Optional[str] = None) -> bool:
+        """Index exactly what changed since the last indexed commit
+        
+        The watermark only advances when every file was processed, so failed
+        files are retried on the next run.
+        """
+        if not self.repo:
+            print("✗ Watermark sync requires a git repository")
+            return False
+        
+        branch = self.current_branch()
+        changed, deleted, head_sha = self.changes_since_watermark(branch)
+        
+        if changed_list:
+            with open(changed_list, 'w') as f:
+                f.writelines(f"{path}\n" for path in changed + deleted)
+        
+        failed = [path for path in deleted if not self.remove_file(path)]
+        failed += self.process_files(changed)
+        
+        if failed:
+            print(f"⚠ {len(failed)} files failed, watermark stays at previous commit")
+            return False
+        
+        self._set_watermark(branch, head_sha)
+        print(f"✓ Watermark for {self.repository}@{branch} set to {head_sha[:10]}")
+        return True
+    
+    def process_files(self, file_paths: List[str]) -> List[str]:
+        """Process multiple files, returning the paths that failed"""
         print(f"\n{'='*60}")
         print(f"Processing {len(file_paths)} files")
         print(f"{'='*60}")
         
+        failed = []
         for file_path in tqdm(file_paths, desc="Processing files"):
             try:
                 chunks = self.process_file(file_path)
                 if chunks:
                     chunks = self.generate_embeddings(chunks)
-                    self.save_to_database(chunks, file_path)
+                    if not self.save_to_database(chunks, file_path, self.last_embedding_tokens or None):
+                        failed.append(file_path)
             except Exception as e:
                 print(f"\n✗ Error processing {file_path}: {e}")
+                failed.append(file_path)
                 continue
         
+        removed = self.remove_orphan_contents()
+        if removed:
+            print(f"\n🧹 Removed {removed} unreferenced chunk contents")
+        
         print(f"\n{'='*60}")
         print(f"✓ Processing complete!")
         print(f"{'='*60}")
+        return failed
     
     def close(self):
         """Close connections"""
@@ -511,6 +1313,27 @@ def main():
     parser.add_argument('--files', type=str, help='File with list of files to process')
     parser.add_argument('--pattern', type=str, help='Glob pattern for files')
     parser.add_argument('--output', type=str, help='Output JSON file (optional)')
+    parser.add_argument('--since-watermark', action='store_true',
+                        help='Index changes since the last indexed commit of this branch')
+    parser.add_argument('--branch', type=str, help='Branch name for the watermark (default: current)')
+    parser.add_argument('--changed-list', type=str,
+                        help='With --since-watermark, write the changed/removed files here')
+    parser.add_argument('--near-duplicates', type=str, choices=KnowledgeProcessor.NEAR_DUPLICATE_MODES,
+                        default=os.getenv('NEAR_DUPLICATE_MODE', 'off'),
+                        help='Handling of SimHash near-duplicate chunks (default: off)')
+    parser.add_argument('--near-duplicate-distance', type=int,
+                        default=int(os.getenv('NEAR_DUPLICATE_DISTANCE', '3')),
+                        help='Max Hamming distance between 64-bit SimHashes (0-3, default: 3)')
+    parser.add_argument('--backfill-signatures', action='store_true',
+                        help='Compute SimHash signatures for already stored chunks')
+    parser.add_argument('--source-storage', type=str, choices=KnowledgeProcessor.SOURCE_STORAGE_MODES,
+                        default=os.getenv('SOURCE_STORAGE', 'text'),
+                        help='How to store source document bodies (default: text)')
+    parser.add_argument('--repository', type=str,
+                        default=os.getenv('KNOWLEDGE_REPOSITORY', KnowledgeProcessor.DEFAULT_REPOSITORY),
+                        help='Repository the files belong to; selects its chunk partitions and watermark')
+    parser.add_argument('--drop-repository', type=str, metavar='NAME',
+                        help="Drop every indexed chunk of a repository by dropping its partitions")
     
     args = parser.parse_args()
     
@@ -519,11 +1342,18 @@ def main():
         'azure_openai_key': os.getenv('AZURE_OPENAI_API_KEY'),
         'azure_openai_endpoint': os.getenv('AZURE_OPENAI_ENDPOINT'),
         'embedding_model': os.getenv('EMBEDDING_MODEL', 'text-embedding-3-large'),
+        # Must match the retrieval side (same variable) and the embedding column
+        'embedding_dimensions': int(os.getenv('EMBEDDING_DIMENSIONS')) if os.getenv('EMBEDDING_DIMENSIONS') else None,
         'postgres_host': os.getenv('POSTGRES_HOST'),
         'postgres_port': os.getenv('POSTGRES_PORT', '5432'),
         'postgres_db': os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
         'postgres_user': os.getenv('POSTGRES_USER'),
         'postgres_password': os.getenv('POSTGRES_PASSWORD'),
+        'source_storage': args.source_storage,
+        'near_duplicate_mode': args.near_duplicates,
+        'near_duplicate_distance': args.near_duplicate_distance,
+        'branch': args.branch,
+        'repository': args.repository,
     }
     
     # Validate configuration
@@ -540,14 +1370,27 @@ def main():
     elif args.pattern:
         from glob import glob
         file_paths = glob(args.pattern, recursive=True)
+    elif args.since_watermark or args.backfill_signatures or args.drop_repository:
+        file_paths = []
     else:
-        print("✗ Either --files or --pattern must be specified")
+        print("✗ Either --files, --pattern or --since-watermark must be specified")
         sys.exit(1)
     
     # Process files
     processor = KnowledgeProcessor(config)
     try:
-        processor.process_files(file_paths)
+        if args.drop_repository:
+            processor.drop_repository(args.drop_repository)
+        if args.backfill_signatures:
+            detector = processor.near_duplicates or NearDuplicateDetector(
+                processor.db_conn, processor.repository, args.near_duplicate_distance
+            )
+            print(f"✓ Backfilled {detector.backfill()} chunk signatures")
+        if args.since_watermark:
+            if not processor.sync_since_watermark(args.changed_list):
+                sys.exit(1)
+        elif file_paths:
+            processor.process_files(file_paths)
     finally:
         processor.close()
 
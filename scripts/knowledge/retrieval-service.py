@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Knowledge Portal - Retrieval Service
+====================================
+Long-running HTTP service implementing Dify's external knowledge API
+
+Endpoints:
+- POST /retrieval   Dify external knowledge retrieval
+- GET  /healthz     liveness (process is up)
+- GET  /readyz      readiness (workers connected and warm, not shutting down)
+
+Each worker is a KnowledgeRetrieval with its own PostgreSQL connection,
+caches and prepared statements; the workers form the connection pool and
+share one Azure OpenAI client. Query embeddings requested by several
+workers within EMBEDDING_BATCH_WINDOW_MS are sent as one batched request,
+which keeps concurrent traffic well inside the Azure RPM quota.
+
+Every search gets the rest of RETRIEVAL_TIMEOUT as its deadline. When the
+query embedding or the vector SQL would not finish in time (Azure OpenAI
+throttled or slow, statement_timeout hit), the search falls back to
+full-text ranking only; the response then carries "degraded": true and
+the reason, and its scores are full-text ranks, so the request's
+score_threshold is not applied. Searches run in a thread pool so the event
+loop keeps serving health checks while queries are in flight.
+
+At startup the service warms up before reporting ready: pg_prewarm loads
+the ANN index and tables, recent query_logs questions fill the query
+embedding caches and probe searches prepare every worker's statements.
+A failed warm-up is logged and retried; /readyz stays 503 with the error
+until one succeeds.
+
+Errors answer {"error_code", "error_msg"}. Dify documents 1001 (invalid
+Authorization header), 1002 (authorization failed) and 2001 (knowledge does
+not exist); conditions Dify has no code for use this service's own 3xxx
+(bad request) and 5xxx (service side) codes, never the HTTP status.
+
+Dify knowledge ids:
+- <DIFY_KNOWLEDGE_ID>             whole knowledge base
+- <DIFY_KNOWLEDGE_ID>/<category>  one category
+
+Environment:
+- RETRIEVAL_API_KEY       bearer token Dify sends (required)
+- DIFY_KNOWLEDGE_ID       knowledge id served (default: nirvana-knowledge)
+- RETRIEVAL_WORKERS       pooled connections (default: 4)
+- RETRIEVAL_TIMEOUT       seconds per request (default: 10)
+- RETRIEVAL_SEARCH_MODE   vector | hybrid (default: hybrid)
+- RETRIEVAL_MMR_LAMBDA    MMR relevance/diversity trade-off (default: off)
+- RETRIEVAL_WARMUP        warm up before reporting ready (default: true)
+- RETRIEVAL_WARMUP_QUERIES  recent logged queries to pre-embed (default: 200)
+- RETRIEVAL_WARMUP_PROBES   probe searches per worker (default: 20)
+- RETRIEVAL_WARMUP_RETRY_SECONDS  delay before retrying a failed warm-up (default: 10)
+- EMBEDDING_BATCH_WINDOW_MS   wait for concurrent query embeddings, 0 disables (default: 5)
+- SEARCH_EMBEDDING_TIMEOUT_MS / SEARCH_SQL_TIMEOUT_MS   per-stage budgets (default: rest of the deadline)
+- SEARCH_FALLBACK_TIMEOUT_MS  reserved for the full-text fallback (default: 1000)
+- RETRIEVAL_PORT          listen port (default: 8080)
+"""
+
+import os
+import sys
+import hmac
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from aiohttp import web
+from openai import AzureOpenAI
+from knowledge_retrieval import KnowledgeRetrieval, UsageRecorder, EmbeddingBatcher
+
+
+# Dify external knowledge API error codes
+ERROR_INVALID_AUTH_HEADER = 1001
+ERROR_AUTH_FAILED = 1002
+ERROR_KNOWLEDGE_NOT_FOUND = 2001
+
+# Service error codes for conditions the Dify API does not define
+ERROR_INVALID_REQUEST = 3001
+ERROR_NOT_READY = 5001
+ERROR_RETRIEVAL_TIMEOUT = 5002
+ERROR_RETRIEVAL_FAILED = 5003
+
+
+class RetrievalService:
+    """Pool of KnowledgeRetrieval workers behind an aiohttp application"""
+
+    def __init__(self):
+        self.api_key = os.getenv('RETRIEVAL_API_KEY')
+        self.knowledge_id = os.getenv('DIFY_KNOWLEDGE_ID', 'nirvana-knowledge')
+        self.worker_count = int(os.getenv('RETRIEVAL_WORKERS', '4'))
+        self.timeout = float(os.getenv('RETRIEVAL_TIMEOUT', '10'))
+        self.search_mode = os.getenv('RETRIEVAL_SEARCH_MODE', 'hybrid')
+        mmr_lambda = os.getenv('RETRIEVAL_MMR_LAMBDA')
+        self.mmr_lambda = float(mmr_lambda) if mmr_lambda else None
+        self.warm_up_enabled = os.getenv('RETRIEVAL_WARMUP', 'true').lower() == 'true'
+        self.warm_up_queries = int(os.getenv('RETRIEVAL_WARMUP_QUERIES', '200'))
+        self.warm_up_probes = int(os.getenv('RETRIEVAL_WARMUP_PROBES', '20'))
+        self.warm_up_retry = float(os.getenv('RETRIEVAL_WARMUP_RETRY_SECONDS', '10'))
+        self.batch_window_ms = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '5'))
+
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix='retrieval')
+        self.workers: Optional[asyncio.Queue] = None
+        self.all_workers: List[KnowledgeRetrieval] = []
+        self.ready = False
+        self.warming: Optional[asyncio.Task] = None
+        self.warm_up_error: Optional[str] = None
+        self.stopping = False
+        self.in_flight = 0
+        self.embedding_batcher: Optional[EmbeddingBatcher] = None
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    async def start(self, app: web.Application):
+        """Open the worker connections; readiness flips once they are warm."""
+        loop = asyncio.get_running_loop()
+        openai_client = AzureOpenAI(
+            api_key=os.getenv('AZURE_OPENAI_API_KEY'),
+            azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
+            api_version='2024-02-01',
+            timeout=self.timeout
+        )
+        # Concurrent query embeddings of all workers share batched requests
+        if self.batch_window_ms > 0:
+            openai_client = self.embedding_batcher = EmbeddingBatcher(openai_client, self.batch_window_ms)
+        # One background writer for the query logs of all workers
+        usage_recorder = None
+        if os.getenv('QUERY_LOGGING', 'true').lower() == 'true':
+            usage_recorder = UsageRecorder(
+                flush_interval=float(os.getenv('QUERY_LOG_FLUSH_SECONDS', '5')),
+                source=os.getenv('QUERY_LOG_SOURCE', 'api')
+            )
+
+        def open_worker() -> KnowledgeRetrieval:
+            return KnowledgeRetrieval(openai_client=openai_client, usage_recorder=usage_recorder)
+
+        self.workers = asyncio.Queue()
+        self.all_workers = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, open_worker) for _ in range(self.worker_count)
+        ])
+        for worker in self.all_workers:
+            self.workers.put_nowait(worker)
+        # In the background, so /healthz answers while the server warms up
+        self.warming = asyncio.ensure_future(self.warm_up())
+    
+    async def warm_up(self):
+        """Warm the database and every worker, then report ready.
+
+        Readiness stays off while warm-up fails; it is retried every
+        RETRIEVAL_WARMUP_RETRY_SECONDS until it succeeds or shutdown starts.
+        """
+        attempt = 0
+        while not self.stopping:
+            attempt += 1
+            try:
+                await self.warm_up_workers()
+                break
+            except Exception as e:
+                self.warm_up_error = str(e)
+                print(f"❌ Warm-up failed (attempt {attempt}), not ready, retrying in "
+                      f"{self.warm_up_retry:.0f}s: {e}")
+                await asyncio.sleep(self.warm_up_retry)
+
+        if not self.stopping:
+            self.warm_up_error = None
+            self.ready = True
+            print(f"✅ Retrieval service ready: {self.worker_count} workers, mode={self.search_mode}")
+
+    async def warm_up_workers(self):
+        """One warm-up attempt over every worker; raises on the first failure."""
+        loop = asyncio.get_running_loop()
+        if self.warm_up_enabled:
+            first, others = self.all_workers[0], self.all_workers[1:]
+            # One worker prewarms the server and embeds the logged queries...
+            await loop.run_in_executor(self.executor, lambda: first.warm_up(
+                self.warm_up_queries, self.warm_up_probes, prewarm=True, search_mode=self.search_mode
+            ))
+            # ...the others reuse its embeddings and only run their probes
+            for worker in others:
+                worker.query_cache.preload(first.query_cache.entries)
+            await asyncio.gather(*[
+                loop.run_in_executor(self.executor, lambda w=worker: w.warm_up(
+                    self.warm_up_queries, self.warm_up_probes, prewarm=False, search_mode=self.search_mode
+                ))
+                for worker in others
+            ])
+
+        # Set after warm-up, which may take longer than one request (pg_prewarm)
+        await asyncio.gather(*[
+            loop.run_in_executor(self.executor, self.set_statement_timeout, worker)
+            for worker in self.all_workers
+        ])
+
+    def set_statement_timeout(self, worker: KnowledgeRetrieval):
+        """A query the client gave up on must not keep the connection busy."""
+        cursor = worker.conn.cursor()
+        cursor.execute("SELECT set_config('statement_timeout', %s, false)", (str(int(self.timeout * 1000)),))
+        cursor.close()
+
+    async def stop_accepting(self, app: web.Application):
+        """Report not ready so the load balancer drains this instance."""
+        self.stopping = True
+        self.ready = False
+        print(f"🛑 Shutting down, {self.in_flight} requests in flight")
+
+    async def close(self, app: web.Application):
+        """Let in-flight searches finish, then close the connections."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while self.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.warming and not self.warming.done():
+            self.warming.cancel()
+        self.executor.shutdown(wait=True)
+        for worker in self.all_workers:
+            worker.close()
+        if self.embedding_batcher:
+            print(f"📦 Embedding batches: {self.embedding_batcher.summary()}")
+        print("✓ Connections closed")
+
+    # ------------------------------------------------------------------
+    # Handlers
+    # ------------------------------------------------------------------
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        return web.json_response({'status': 'ok'})
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        if not self.ready:
+            if self.warm_up_error:
+                return web.json_response({'status': 'warm-up failed', 'error': self.warm_up_error}, status=503)
+            warming = self.warming is not None and not self.warming.done()
+            return web.json_response({'status': 'warming' if warming else 'not ready'}, status=503)
+        return web.json_response({'status': 'ready', 'idle_workers': self.workers.qsize()})
+
+    @staticmethod
+    def error(status: int, code: int, message: str) -> web.Response:
+        return web.json_response({'error_code': code, 'error_msg': message}, status=status)
+
+    async def retrieval(self, request: web.Request) -> web.Response:
+        """Dify external knowledge retrieval endpoint."""
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            return self.error(403, ERROR_INVALID_AUTH_HEADER,
+                              'Invalid Authorization header format. Expected \'Bearer <api-key>\' format.')
+        # Constant-time comparison: response timing must not reveal the key
+        token = header[len('Bearer '):].encode()
+        if not self.api_key or not hmac.compare_digest(token, self.api_key.encode()):
+            return self.error(403, ERROR_AUTH_FAILED, 'Authorization failed')
+        if not self.ready:
+            return self.error(503, ERROR_NOT_READY, 'Service is not ready')
+
+        try:
+            body = await request.json()
+            query = body['query']
+            setting = body.get('retrieval_setting') or {}
+            top_k = int(setting.get('top_k', 5))
+            score_threshold = float(setting.get('score_threshold', 0.0))
+        except (ValueError, KeyError, TypeError) as e:
+            return self.error(400, ERROR_INVALID_REQUEST, f'Invalid request body: {e}')
+
+        filters = self.parse_knowledge_id(body.get('knowledge_id', ''))
+        if filters is None:
+            return self.error(404, ERROR_KNOWLEDGE_NOT_FOUND, 'The knowledge does not exist')
+        filters.update(self.parse_metadata_condition(body.get('metadata_condition')))
+
+        self.in_flight += 1
+        try:
+            results, degraded = await self.search(query, top_k, filters)
+        except asyncio.TimeoutError:
+            return self.error(504, ERROR_RETRIEVAL_TIMEOUT, f'Retrieval timed out after {self.timeout:.0f}s')
+        except Exception as e:
+            print(f"❌ Retrieval failed: {e}")
+            return self.error(500, ERROR_RETRIEVAL_FAILED, 'Retrieval failed')
+        finally:
+            self.in_flight -= 1
+
+        records = [
+            {
+                'content': r['content'],
+                'score': float(r['similarity_score']),
+                'title': os.path.basename(r['file_path']),
+                'metadata': {
+                    'path': r['file_path'],
+                    'repository': r['repository'],
+                    'category': r['category'],
+                    'tags': r['tags'],
+                    'language': r['language'],
+                },
+            }
+            for r in results
+            if degraded or r['similarity_score'] >= score_threshold
+        ]
+        if degraded:
+            return web.json_response({'records': records, 'degraded': True, 'degraded_reason': degraded})
+        return web.json_response({'records': records})
+
+    def parse_knowledge_id(self, knowledge_id: str) -> Optional[Dict[str, Any]]:
+        """Search filters for a knowledge id, None when it is not served."""
+        if knowledge_id == self.knowledge_id:
+            return {}
+        prefix = f"{self.knowledge_id}/"
+        if knowledge_id.startswith(prefix) and len(knowledge_id) > len(prefix):
+            return {'category_filter': knowledge_id[len(prefix):]}
+        return None
+
+    @staticmethod
+    def parse_metadata_condition(condition: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Map Dify metadata conditions onto repository/category/language/tags filters.
+
+        Only 'is' on repository/category/language and 'contains' on tags
+        have an equivalent; other conditions are ignored. A repository
+        condition searches that repository's partition only.
+        """
+        filters = {}
+        for item in (condition or {}).get('conditions', []):
+            names = item.get('name') or []
+            names = [names] if isinstance(names, str) else names
+            operator, value = item.get('comparison_operator'), item.get('value')
+            for name in names:
+                if name in ('repository', 'category', 'language') and operator == 'is' and value:
+                    filters[f'{name}_filter'] = value
+                elif name == 'tags' and operator == 'contains' and value:
+                    filters['tags_filter'] = [value] if isinstance(value, str) else list(value)
+        return filters
+
+    async def search(
+        self, query: str, top_k: int, filters: Dict[str, Any]
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Run one search on a pooled worker within the request timeout.
+
+        Returns the results and, for a degraded full-text-only search, why.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        worker = await asyncio.wait_for(self.workers.get(), timeout=self.timeout)
+
+        def run():
+            results = worker.search_chunks(
+                query=query,
+                top_k=top_k,
+                score_threshold=0.0,
+                search_mode=self.search_mode,
+                mmr_lambda=self.mmr_lambda,
+                # Margin for handing the results back to the event loop
+                deadline_ms=max((deadline - loop.time()) * 1000 - 50, 1),
+                **filters
+            )
+            return results, worker.trace.degraded
+
+        future = loop.run_in_executor(self.executor, run)
+        # The worker returns to the pool when its search ends, even after a timeout
+        future.add_done_callback(lambda _: self.workers.put_nowait(worker))
+        return await asyncio.wait_for(asyncio.shield(future), timeout=max(deadline - loop.time(), 0))
+
+    def application(self) -> web.Application:
+        app = web.Application(client_max_size=1024 * 1024)
+        app.router.add_post('/retrieval', self.retrieval)
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/readyz', self.readyz)
+        app.on_startup.append(self.start)
+        app.on_shutdown.append(self.stop_accepting)
+        app.on_cleanup.append(self.close)
+        return app
+
+
+def main():
+    """Main entry point."""
+    required_vars = [
+        'POSTGRES_HOST', 'POSTGRES_USER', 'POSTGRES_PASSWORD',
+        'AZURE_OPENAI_API_KEY', 'AZURE_OPENAI_ENDPOINT', 'RETRIEVAL_API_KEY'
+    ]
+    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    if missing_vars:
+        print(f"❌ Missing environment variables: {', '.join(missing_vars)}")
+        sys.exit(1)
+
+    service = RetrievalService()
+    # SIGTERM/SIGINT trigger on_shutdown; shutdown_timeout bounds open requests
+    web.run_app(
+        service.application(),
+        port=int(os.getenv('RETRIEVAL_PORT', '8080')),
+        shutdown_timeout=service.timeout
+    )
+
+
+if __name__ == '__main__':
+    main()
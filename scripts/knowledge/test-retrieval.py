@@ -5,115 +5,16 @@ This script performs vector similarity search using pgvector.
 """
 
 import os
+import math
 import sys
-from typing import List, Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from openai import AzureOpenAI
+import json
+import time
+import argparse
+from typing import List, Dict, Any, Optional
+from knowledge_retrieval import KnowledgeRetrieval
 
-class KnowledgeRetrieval:
-    def __init__(self):
-        """Initialize connections to PostgreSQL and Azure OpenAI."""
-        # PostgreSQL connection
-        self.conn = psycopg2.connect(
-            host=os.getenv('POSTGRES_HOST'),
-            port=int(os.getenv('POSTGRES_PORT', '5432')),
-            database=os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
-            user=os.getenv('POSTGRES_USER'),
-            password=os.getenv('POSTGRES_PASSWORD')
-        )
-        
-        # Azure OpenAI client for generating query embeddings
-        self.openai_client = AzureOpenAI(
-            api_key=os.getenv('AZURE_OPENAI_API_KEY'),
-            azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
-            api_version='2024-02-01'
-        )
-        
-        self.embedding_model = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-large')
-        
-    def generate_query_embedding(self, query: str) -> List[float]:
-        """Generate embedding for search query."""
-        try:
-            response = self.openai_client.embeddings.create(
-                model=self.embedding_model,
-                input=query
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"❌ Error generating embedding: {e}")
-            return None
-    
-    def search_chunks(
-        self, 
-        query: str, 
-        top_k: int = 5, 
-        score_threshold: float = 0.70,
-        category_filter: str = None
-    ) -> List[Dict[str, Any]]:
-        """
-        Search for relevant chunks using vector similarity.
-        
-        Args:
-            query: Search query text
-            top_k: Number of results to return
-            score_threshold: Minimum similarity score (0-1)
-            category_filter: Optional category to filter by
-        """
-        print(f"\n🔍 Searching for: '{query}'")
-        print(f"   Parameters: top_k={top_k}, threshold={score_threshold}")
-        
-        # Generate query embedding
-        query_embedding = self.generate_query_embedding(query)
-        if not query_embedding:
-            return []
-        
-        # Build SQL query
-        sql = """
-        SELECT 
-            content,
-            file_path,
-            repository,
-            category,
-            tags,
-            language,
-            quality_score,
-            1 - (embedding <=> %s::vector) AS similarity_score
-        FROM knowledge_chunks
-        WHERE embedding IS NOT NULL
-        """
-        
-        params = [query_embedding]
-        
-        if category_filter:
-            sql += " AND category = %s"
-            params.append(category_filter)
-        
-        sql += """
-        ORDER BY embedding <=> %s::vector
-        LIMIT %s
-        """
-        params.append(query_embedding)
-        params.append(top_k)
-        
-        # Execute query
-        cursor = self.conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(sql, params)
-        results = cursor.fetchall()
-        cursor.close()
-        
-        # Filter by score threshold
-        filtered_results = [r for r in results if r['similarity_score'] >= score_threshold]
-        
-        print(f"   Found {len(results)} results, {len(filtered_results)} above threshold")
-        
-        # Show top scores even if below threshold for debugging
-        if results and not filtered_results:
-            top_scores = [r['similarity_score'] for r in results[:3]]
-            print(f"   ⚠️  Top scores: {', '.join([f'{s:.4f}' for s in top_scores])}")
-        
-        # Return all results for display (threshold filter for production use)
-        return results
+class RetrievalTestSuite(KnowledgeRetrieval):
+    """KnowledgeRetrieval with readable output and the canned test queries."""
     
     def display_results(self, results: List[Dict[str, Any]], threshold: float = 0.70):
         """Display search results in a readable format."""
@@ -147,6 +48,8 @@ class KnowledgeRetrieval:
         for i, result in enumerate(results, 1):
             print(f"\n{i}. 📄 {result['file_path']}")
             print(f"   📊 Score: {result['similarity_score']:.4f}")
+            if result.get('rrf_score') is not None:
+                print(f"   🔀 Fused rank score: {result['rrf_score']:.4f}")
             print(f"   🏷️  Category: {result['category'] or 'N/A'}")
             print(f"   🔖 Tags: {', '.join(result['tags']) if result['tags'] else 'N/A'}")
             print(f"   📝 Language: {result['language'] or 'N/A'}")
@@ -180,7 +83,8 @@ class KnowledgeRetrieval:
             {
                 "query": "Muestra código del componente DifyChatButton",
                 "category": None,
-                "description": "DifyChatButton component code"
+                "description": "DifyChatButton component code",
+                "mode": "hybrid"
             },
             {
                 "query": "¿Cómo se configura el drift detection?",
@@ -202,22 +106,166 @@ class KnowledgeRetrieval:
                 query=test['query'],
                 top_k=3,
                 score_threshold=0.70,
-                category_filter=test['category']
+                category_filter=test['category'],
+                search_mode=test.get('mode', 'vector')
             )
             
             self.display_results(results, threshold=0.70)
+            
+            context = self.assemble_context(results, token_budget=1500)
+            print(f"   🧩 Context: {len(results)} chunks -> {len(context['sources'])} blocks, "
+                  f"{context['tokens']} tokens ({context['dropped']} blocks over budget)")
+        
+        # Same questions through the batched API: one embedding call, one query
+        batch = self.search_many([test['query'] for test in test_queries], top_k=3)
+        for test, results in zip(test_queries, batch):
+            best = f"{results[0]['similarity_score']:.4f}" if results else "N/A"
+            print(f"   📦 {test['description']}: {len(results)} results, best score {best}")
         
         print("\n\n" + "=" * 120)
         print("✅ TEST SUITE COMPLETED".center(120))
         print("=" * 120)
+        print(f"\n🗄️  Query embedding cache: {self.query_cache.summary()}")
+        if self.result_cache:
+            print(f"♻️  Semantic result cache: {self.result_cache.summary()}")
+        if self.usage_recorder:
+            print(f"📝 Query log writer: {self.usage_recorder.summary()}")
+
+class RetrievalEvaluator:
+    """Measures retrieval quality and latency against a golden query set.
+    
+    For every search-settings variant it reports, over all golden queries:
+    - recall@k of the ANN results against exact (brute-force) search
+    - MRR and hit rate of the expected files
+    - p50/p95/p99 latency of the embedding call and of the SQL search
+    """
+    
+    def __init__(self, retrieval: KnowledgeRetrieval, golden_path: str, top_k: int = 5):
+        self.retrieval = retrieval
+        self.top_k = top_k
+        with open(golden_path, 'r', encoding='utf-8') as f:
+            self.queries = json.load(f)['queries']
+    
+    @staticmethod
+    def percentile(values: List[float], p: float) -> float:
+        """Nearest-rank percentile."""
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[max(math.ceil(p / 100 * len(ordered)), 1) - 1]
     
-    def close(self):
-        """Close database connection."""
-        if self.conn:
-            self.conn.close()
+    def _embed(self) -> List[Dict[str, Any]]:
+        """Embed the golden queries once, timing the API call (cache bypassed)."""
+        retrieval = self.retrieval
+        prepared = []
+        for item in self.queries:
+            request = {'model': retrieval.embedding_model, 'input': item['query']}
+            if retrieval.embedding_dimensions:
+                request['dimensions'] = retrieval.embedding_dimensions
+            start = time.perf_counter()
+            try:
+                embedding = retrieval.openai_client.embeddings.create(**request).data[0].embedding
+            except Exception as e:
+                print(f"   ⚠️  Skipping '{item['query']}': {e}")
+                continue
+            embed_ms = (time.perf_counter() - start) * 1000
+            params = {'embedding': retrieval._vector_literal(embedding), 'top_k': self.top_k}
+            occurrence_filter = retrieval._occurrence_filter(
+                params, item.get('category'), item.get('tags'), item.get('language')
+            )
+            prepared.append({
+                'item': item,
+                'params': params,
+                'filter': occurrence_filter,
+                'embed_ms': embed_ms,
+                'exact': self._exact(params, occurrence_filter),
+            })
+        return prepared
+    
+    def _exact(self, params: Dict[str, Any], occurrence_filter: str) -> List[Dict[str, Any]]:
+        """Brute-force ground truth for one query."""
+        retrieval = self.retrieval
+        content_filter = retrieval.CONTENT_FILTER.format(filters=occurrence_filter) if occurrence_filter else ""
+        occurrence_join = retrieval.OCCURRENCE_JOIN.format(filters=occurrence_filter)
+        return retrieval._fetch(retrieval._exact_sql(occurrence_join, content_filter), params)
+    
+    def evaluate(self, variants: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run every golden query under each variant of the index search settings."""
+        retrieval = self.retrieval
+        print(f"\n📐 Evaluating {len(self.queries)} golden queries, top_k={self.top_k}")
+        print(f"   Index: {json.dumps(retrieval.index_settings, sort_keys=True)}")
+        
+        prepared = self._embed()
+        embed_times = [p['embed_ms'] for p in prepared]
+        
+        baseline = dict(retrieval.index_settings)
+        reports = []
+        try:
+            for variant in variants:
+                retrieval.index_settings = dict(baseline, **variant)
+                recalls, reciprocal_ranks, hits, sql_times = [], [], [], []
+                for p in prepared:
+                    start = time.perf_counter()
+                    results = retrieval._vector_search(dict(p['params']), p['filter'])
+                    sql_times.append((time.perf_counter() - start) * 1000)
+                    
+                    exact = {r['content'] for r in p['exact']}
+                    found = [r['content'] for r in results]
+                    recalls.append(len(exact & set(found)) / len(exact) if exact else 1.0)
+                    
+                    expected = set(p['item']['expected_files'])
+                    rank = next((i for i, r in enumerate(results, 1) if r['file_path'] in expected), None)
+                    reciprocal_ranks.append(1 / rank if rank else 0.0)
+                    hits.append(1.0 if rank else 0.0)
+                
+                count = max(len(prepared), 1)
+                reports.append({
+                    'settings': variant,
+                    'queries': len(prepared),
+                    f'recall@{self.top_k}': sum(recalls) / count,
+                    'mrr': sum(reciprocal_ranks) / count,
+                    f'hit_rate@{self.top_k}': sum(hits) / count,
+                    'embed_ms': {f'p{p}': self.percentile(embed_times, p) for p in (50, 95, 99)},
+                    'sql_ms': {f'p{p}': self.percentile(sql_times, p) for p in (50, 95, 99)},
+                })
+        finally:
+            retrieval.index_settings = baseline
+        
+        self._print_report(reports)
+        return reports
+    
+    def _print_report(self, reports: List[Dict[str, Any]]):
+        """Tabular summary, one row per settings variant."""
+        k = self.top_k
+        print("\n" + "=" * 120)
+        print(f"{'Settings':<30} {f'Recall@{k}':>10} {'MRR':>8} {f'Hit@{k}':>8} "
+              f"{'Embed p50/p95/p99 ms':>24} {'SQL p50/p95/p99 ms':>24}")
+        print("-" * 120)
+        for report in reports:
+            settings = ', '.join(f"{name}={value}" for name, value in report['settings'].items()) or 'index defaults'
+            embed = '/'.join(f"{report['embed_ms'][p]:.1f}" for p in ('p50', 'p95', 'p99'))
+            sql = '/'.join(f"{report['sql_ms'][p]:.1f}" for p in ('p50', 'p95', 'p99'))
+            print(f"{settings:<30} {report[f'recall@{k}']:>10.3f} {report['mrr']:>8.3f} "
+                  f"{report[f'hit_rate@{k}']:>8.3f} {embed:>24} {sql:>24}")
+        print("=" * 120)
+
+def parse_grid(grid: Optional[str]) -> List[Dict[str, Any]]:
+    """'ef_search=40,100,200' -> [{'ef_search': 40}, ...]; None -> index defaults."""
+    if not grid:
+        return [{}]
+    name, values = grid.split('=', 1)
+    return [{name.strip(): int(value)} for value in values.split(',')]
 
 def main():
     """Main entry point."""
+    parser = argparse.ArgumentParser(description='Test and evaluate knowledge base retrieval')
+    parser.add_argument('--evaluate', metavar='GOLDEN_JSON',
+                        help='Evaluate recall/MRR/latency against a golden query set')
+    parser.add_argument('--top-k', type=int, default=5, help='Results per query in evaluate mode')
+    parser.add_argument('--grid', help="Search settings to compare, e.g. 'probes=1,4,16' or 'ef_search=40,100'")
+    parser.add_argument('--output', help='Write the evaluation report as JSON')
+    args = parser.parse_args()
+    
     print("\n🚀 Starting Knowledge Base Retrieval Test\n")
     
     # Check required environment variables
@@ -232,8 +280,16 @@ def main():
         sys.exit(1)
     
     try:
-        retrieval = KnowledgeRetrieval()
-        retrieval.run_test_queries()
+        retrieval = RetrievalTestSuite()
+        if args.evaluate:
+            evaluator = RetrievalEvaluator(retrieval, args.evaluate, top_k=args.top_k)
+            reports = evaluator.evaluate(parse_grid(args.grid))
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    json.dump({'index': retrieval.index_settings, 'reports': reports}, f, indent=2)
+                print(f"\n💾 Report written to {args.output}")
+        else:
+            retrieval.run_test_queries()
         retrieval.close()
         
         print("\n✅ All tests completed successfully!\n")
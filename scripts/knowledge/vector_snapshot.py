@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Knowledge Portal - Local Vector Snapshot
+========================================
+Memory-mapped copy of the chunk_contents embeddings for in-process search
+
+Layout of a snapshot directory:
+- manifest.json          current version, dimensions, row count
+- v<N>/embeddings.f32    contiguous float32 rows, L2-normalized (cosine = dot)
+- v<N>/contents.bin      UTF-8 chunk texts, addressed by offsets
+- v<N>/rows.json         content hashes, models, quality, text offsets and
+                         occurrences (file, position, repository, category,
+                         tags, language)
+
+chunk_contents is partitioned by repository, so a text indexed in several
+repositories is stored once per repository; the snapshot keeps one row per
+content hash with the occurrences of every repository. Occurrences of a
+linked near-duplicate (no embedding, duplicate_of set) are listed under the
+content it links to, after its own occurrences, and carry their own text.
+
+Exports are incremental: rows whose content hash and embedding model are
+unchanged are copied from the previous version, only new embeddings are
+read from PostgreSQL. Each export writes a new version directory and then
+swaps manifest.json, so readers never see a half-written snapshot.
+
+Usage:
+    python vector_snapshot.py export /var/lib/knowledge/snapshot
+"""
+
+import os
+import sys
+import json
+import mmap
+import shutil
+import argparse
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+import numpy as np
+import psycopg2
+
+
+class VectorSnapshot:
+    """Read-only, memory-mapped embedding snapshot with exact top-k search"""
+
+    FETCH_BATCH = 1000
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # Stat before reading: an export swapping the manifest afterwards changes it
+        self.manifest_mtime_ns = os.stat(os.path.join(directory, 'manifest.json')).st_mtime_ns
+        with open(os.path.join(directory, 'manifest.json'), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        version_dir = os.path.join(directory, f"v{self.manifest['version']}")
+
+        with open(os.path.join(version_dir, 'rows.json'), 'r', encoding='utf-8') as f:
+            rows = json.load(f)
+        self.hashes = rows['hashes']
+        self.models = rows['models']
+        self.quality = rows['quality']
+        self.offsets = rows['offsets']
+        self.occurrences = rows['occurrences']
+        self.row_of = {content_hash: i for i, content_hash in enumerate(self.hashes)}
+
+        count, dimensions = self.manifest['count'], self.manifest['dimensions']
+        self.vectors = (
+            np.memmap(os.path.join(version_dir, 'embeddings.f32'), dtype=np.float32,
+                      mode='r', shape=(count, dimensions))
+            if count else np.zeros((0, dimensions), dtype=np.float32)
+        )
+        # Mapped like the vectors: processes share the page cache, not copies
+        with open(os.path.join(version_dir, 'contents.bin'), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        self._build_filter_index()
+
+    @property
+    def version(self) -> int:
+        return self.manifest['version']
+
+    def reload_if_changed(self) -> 'VectorSnapshot':
+        """Newer snapshot when an export swapped the manifest, else self.
+
+        Called on every search: only a changed manifest mtime is read.
+        """
+        path = os.path.join(self.directory, 'manifest.json')
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if mtime_ns == self.manifest_mtime_ns:
+                return self
+            with open(path, 'r', encoding='utf-8') as f:
+                version = json.load(f)['version']
+        except (OSError, ValueError, KeyError):
+            return self
+        if version == self.version:
+            self.manifest_mtime_ns = mtime_ns
+            return self
+        return VectorSnapshot(self.directory)
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+
+    def _build_filter_index(self):
+        """Row ids per repository, category, language and tag (any occurrence)."""
+        index = {'repository': {}, 'category': {}, 'language': {}, 'tags': {}}
+        for row, occurrences in enumerate(self.occurrences):
+            for occurrence in occurrences:
+                for field in ('repository', 'category', 'language'):
+                    if occurrence[field]:
+                        index[field].setdefault(occurrence[field], set()).add(row)
+                for tag in occurrence['tags'] or []:
+                    index['tags'].setdefault(tag, set()).add(row)
+        self.filter_index = {
+            field: {value: np.fromiter(sorted(rows), dtype=np.int64) for value, rows in values.items()}
+            for field, values in index.items()
+        }
+
+    def _candidate_rows(
+        self,
+        category: Optional[str],
+        tags: Optional[List[str]],
+        language: Optional[str],
+        repository: Optional[str] = None
+    ) -> Optional[np.ndarray]:
+        """Rows that may match the filters (None = all rows).
+
+        Each filter is resolved on its own, so this is a superset; the
+        single-occurrence check happens when results are assembled.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        candidates = None
+        if repository:
+            candidates = self.filter_index['repository'].get(repository, empty)
+        if category:
+            rows = self.filter_index['category'].get(category, empty)
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows)
+        if language:
+            rows = self.filter_index['language'].get(language, empty)
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows)
+        if tags:
+            rows = np.unique(np.concatenate(
+                [self.filter_index['tags'].get(tag, empty) for tag in tags]
+            ))
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows)
+        return candidates
+
+    def _matching_occurrence(
+        self,
+        row: int,
+        category: Optional[str],
+        tags: Optional[List[str]],
+        language: Optional[str],
+        repository: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """First occurrence (by file and position) satisfying every filter."""
+        for occurrence in self.occurrences[row]:
+            if repository and occurrence['repository'] != repository:
+                continue
+            if category and occurrence['category'] != category:
+                continue
+            if language and occurrence['language'] != language:
+                continue
+            if tags and not set(tags) & set(occurrence['tags'] or []):
+                continue
+            return occurrence
+        return None
+
+    def search(
+        self,
+        embedding: List[float],
+        top_k: int = 5,
+        category_filter: str = None,
+        tags_filter: Optional[List[str]] = None,
+        language_filter: str = None,
+        repository_filter: str = None
+    ) -> List[Dict[str, Any]]:
+        """Exact cosine top-k, same result shape and filters as search_chunks."""
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        rows = self._candidate_rows(category_filter, tags_filter, language_filter, repository_filter)
+        if rows is None:
+            scores = self.vectors @ query
+            rows = np.arange(len(scores))
+        else:
+            scores = self.vectors[rows] @ query if len(rows) else np.zeros(0, dtype=np.float32)
+
+        results = []
+        taken = 0
+        want = top_k
+        while len(results) < top_k and taken < len(scores):
+            # Widen the partial sort until enough rows pass the occurrence check
+            want = min(max(want, top_k) * 2, len(scores))
+            best = np.argpartition(-scores, want - 1)[:want] if want < len(scores) else np.arange(len(scores))
+            best = best[np.argsort(-scores[best], kind='stable')][taken:]
+            for i in best:
+                row = int(rows[i])
+                occurrence = self._matching_occurrence(
+                    row, category_filter, tags_filter, language_filter, repository_filter
+                )
+                if occurrence is None:
+                    continue
+                results.append(self._result(row, occurrence, float(scores[i])))
+                if len(results) == top_k:
+                    break
+            taken = want
+        return results
+
+    def _result(self, row: int, occurrence: Dict[str, Any], score: float) -> Dict[str, Any]:
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return {
+            'content': occurrence.get('content') or self.contents[start:end].decode('utf-8'),
+            'content_hash': self.hashes[row],
+            'chunk_id': occurrence.get('id'),
+            'file_path': occurrence['file_path'],
+            'repository': occurrence['repository'],
+            'category': occurrence['category'],
+            'tags': occurrence['tags'],
+            'language': occurrence['language'],
+            'chunk_index': occurrence.get('chunk_index'),
+            'char_start': occurrence.get('char_start'),
+            'char_end': occurrence.get('char_end'),
+            'quality_score': self.quality[row],
+            'similarity_score': score,
+        }
+
+    # ------------------------------------------------------------------
+    # Export
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def export(cls, conn, directory: str) -> Dict[str, Any]:
+        """Write a new snapshot version, reusing rows of the current one."""
+        os.makedirs(directory, exist_ok=True)
+        previous = None
+        if os.path.exists(os.path.join(directory, 'manifest.json')):
+            previous = cls(directory)
+
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT ON (content_hash)
+                content_hash, embedding_model, quality_score, vector_dims(embedding)
+            FROM chunk_contents
+            WHERE embedding IS NOT NULL
+            ORDER BY content_hash, repository
+        """)
+        live = cursor.fetchall()
+        dimensions = live[0][3] if live else (previous.manifest['dimensions'] if previous else 0)
+
+        def reusable(content_hash, model):
+            row = previous.row_of.get(content_hash) if previous else None
+            return row if row is not None and previous.models[row] == model else None
+
+        missing = [content_hash for content_hash, model, _, _ in live if reusable(content_hash, model) is None]
+        fetched = cls._fetch_embeddings(conn, missing)
+
+        cursor.execute("""
+            SELECT COALESCE(c.duplicate_of, o.content_hash), o.id, o.file_path, o.chunk_index,
+                   o.char_start, o.char_end, o.repository, o.category, o.tags, o.language,
+                   CASE WHEN c.duplicate_of IS NOT NULL THEN c.content END
+            FROM chunk_occurrences o
+            JOIN chunk_contents c ON c.repository = o.repository AND c.content_hash = o.content_hash
+            ORDER BY 1, c.duplicate_of IS NOT NULL, o.file_path, o.chunk_index, o.repository
+        """)
+        occurrences = {}
+        for (content_hash, chunk_id, file_path, chunk_index, char_start, char_end,
+             repository, category, tags, language, linked_content) in cursor.fetchall():
+            occurrences.setdefault(content_hash, []).append({
+                'id': str(chunk_id),
+                'file_path': file_path,
+                'chunk_index': chunk_index,
+                'char_start': char_start,
+                'char_end': char_end,
+                'repository': repository,
+                'category': category,
+                'tags': tags,
+                'language': language,
+                **({'content': linked_content} if linked_content is not None else {}),
+            })
+        cursor.close()
+
+        version = previous.version + 1 if previous else 1
+        version_dir = os.path.join(directory, f"v{version}")
+        os.makedirs(version_dir, exist_ok=True)
+
+        vectors = np.memmap(os.path.join(version_dir, 'embeddings.f32'), dtype=np.float32,
+                            mode='w+', shape=(max(len(live), 1), max(dimensions, 1)))
+        rows = {'hashes': [], 'models': [], 'quality': [], 'offsets': [0], 'occurrences': []}
+        with open(os.path.join(version_dir, 'contents.bin'), 'wb') as contents:
+            for i, (content_hash, model, quality, _) in enumerate(live):
+                old_row = reusable(content_hash, model)
+                if old_row is not None:
+                    vectors[i] = previous.vectors[old_row]
+                    start, end = previous.offsets[old_row], previous.offsets[old_row + 1]
+                    text = previous.contents[start:end]
+                else:
+                    content, embedding = fetched[content_hash]
+                    vector = np.asarray(embedding, dtype=np.float32)
+                    norm = np.linalg.norm(vector)
+                    vectors[i] = vector / norm if norm else vector
+                    text = content.encode('utf-8')
+                contents.write(text)
+                rows['hashes'].append(content_hash)
+                rows['models'].append(model)
+                rows['quality'].append(quality)
+                rows['offsets'].append(rows['offsets'][-1] + len(text))
+                rows['occurrences'].append(occurrences.get(content_hash, []))
+        vectors.flush()
+        del vectors
+
+        with open(os.path.join(version_dir, 'rows.json'), 'w', encoding='utf-8') as f:
+            json.dump(rows, f, separators=(',', ':'))
+
+        manifest = {
+            'version': version,
+            'dimensions': dimensions,
+            'count': len(live),
+            'exported_at': datetime.now(timezone.utc).isoformat(),
+            'reused': len(live) - len(missing),
+            'fetched': len(missing),
+        }
+        manifest_tmp = os.path.join(directory, 'manifest.json.tmp')
+        with open(manifest_tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_tmp, os.path.join(directory, 'manifest.json'))
+
+        # Keep the previous version for readers that still have it mapped
+        for name in os.listdir(directory):
+            if name.startswith('v') and name[1:].isdigit() and int(name[1:]) < version - 1:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        return manifest
+
+    @classmethod
+    def _fetch_embeddings(cls, conn, content_hashes: List[str]) -> Dict[str, tuple]:
+        """Content and embedding for the given hashes, in batches."""
+        fetched = {}
+        cursor = conn.cursor()
+        for start in range(0, len(content_hashes), cls.FETCH_BATCH):
+            batch = content_hashes[start:start + cls.FETCH_BATCH]
+            cursor.execute("""
+                SELECT DISTINCT ON (content_hash) content_hash, content, embedding::real[]
+                FROM chunk_contents
+                WHERE content_hash = ANY(%s)
+                AND embedding IS NOT NULL
+                ORDER BY content_hash, repository
+            """, (batch,))
+            for content_hash, content, embedding in cursor.fetchall():
+                fetched[content_hash] = (content, embedding)
+        cursor.close()
+        return fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the local vector snapshot')
+    parser.add_argument('command', choices=['export'], help='export: write/refresh the snapshot')
+    parser.add_argument('directory', help='Snapshot directory')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('POSTGRES_HOST'),
+        port=int(os.getenv('POSTGRES_PORT', '5432')),
+        database=os.getenv('POSTGRES_DB', 'nirvana_knowledge'),
+        user=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD')
+    )
+    try:
+        manifest = VectorSnapshot.export(conn, args.directory)
+    except Exception as e:
+        print(f"❌ Snapshot export failed: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    print(f"✅ Snapshot v{manifest['version']}: {manifest['count']} vectors, "
+          f"{manifest['dimensions']} dimensions "
+          f"({manifest['reused']} reused, {manifest['fetched']} fetched)")
+
+
+if __name__ == '__main__':
+    main()
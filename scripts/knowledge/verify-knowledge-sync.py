@@ -75,12 +75,14 @@ class KnowledgeVerifier:
             SELECT table_name 
             FROM information_schema.tables 
             WHERE table_schema = 'public' 
-            AND table_name IN ('knowledge_chunks', 'source_documents', 'query_logs')
+            AND table_name IN ('knowledge_chunks', 'chunk_contents', 'chunk_occurrences',
+                               'source_documents', 'query_logs')
         """)
         
         tables = [row[0] for row in self.cursor.fetchall()]
         
-        expected_tables = ['knowledge_chunks', 'source_documents', 'query_logs']
+        expected_tables = ['knowledge_chunks', 'chunk_contents', 'chunk_occurrences',
+                           'source_documents', 'query_logs']
         missing = set(expected_tables) - set(tables)
         
         if not missing:
@@ -109,9 +111,14 @@ class KnowledgeVerifier:
         self.cursor.execute("SELECT COUNT(*) FROM knowledge_chunks WHERE embedding IS NOT NULL")
         embedded_count = self.cursor.fetchone()[0]
         
+        # Distinct contents (one embedding each)
+        self.cursor.execute("SELECT COUNT(*) FROM chunk_contents")
+        unique_count = self.cursor.fetchone()[0]
+        
         print(f"  ✓ Source documents: {doc_count}")
         print(f"  ✓ Total chunks: {chunk_count}")
         print(f"  ✓ Chunks with embeddings: {embedded_count}")
+        print(f"  ✓ Distinct chunk contents: {unique_count}")
         
         if chunk_count > 0:
             embedding_coverage = (embedded_count / chunk_count) * 100
@@ -169,7 +176,7 @@ class KnowledgeVerifier:
                 indexdef
             FROM pg_indexes
             WHERE schemaname = 'public'
-            AND tablename IN ('knowledge_chunks', 'source_documents')
+            AND tablename IN ('chunk_contents', 'chunk_occurrences', 'source_documents')
             ORDER BY tablename, indexname
         """)
         